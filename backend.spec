@@ -39,7 +39,27 @@ a = Analysis(
         # 'fastapi.encoders', 'pydantic.v1', etc.
         # Попробуйте добавить явно модули вашего API:
         'backend.api.api',
+        'backend.api.openai_compat',
         'backend.model_manager',
+        'backend.hardware',
+        'backend.model_preloader',
+        'backend.inference_tuning',
+        'backend.response_cache',
+        'backend.speculative',
+        'backend.generation',
+        'backend.embeddings',
+        'backend.gateway',
+        'backend.model_worker',
+        'backend.quant_selection',
+        'backend.chat_transfer',
+        'backend.tracing',
+        'backend.profiler',
+        'backend.json_responses',
+        'backend.scheduler',
+        'backend.client_limits',
+        'backend.lora',
+        'backend.research',
+        'backend.chat_cache',
         # Если llama_cpp использует какие-то специфичные бэкенды, их тоже может понадобиться добавить.
         # Также соберем данные для некоторых часто проблемных пакетов:
         *collect_submodules('fastapi'),
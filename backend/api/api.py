@@ -1,12 +1,32 @@
 import os
+import json
+import asyncio
 import logging
+import threading
+import time
 
 import GPUtil
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from backend.model_manager import ModelManager
+from backend.model_manager import (ModelManager, ModelUsageLog, ModelStoreQuotaError, get_model_fingerprint,
+                                   get_model_store)
+from backend.response_cache import ResponseCache, create_embedder, normalize_prompt
+from backend.chat_cache import ChatCache
+from backend import model_preloader, inference_tuning, quant_selection, chat_transfer, tracing, research
+from backend.json_responses import json_response, make_etag, etag_matches
+from backend.generation import CancellationToken, CancellationStats, DEFAULT_STOP, generate_on_llm
+from backend.speculative import SpeculativeConfigStore, SPECULATIVE_MODES, create_llama_with_draft
+from backend.model_worker import WorkerPool, WorkerCrashedError, WorkerNotRunningError
+from backend.scheduler import GenerationScheduler, BackgroundJobs, INTERACTIVE, BACKGROUND, PREEMPTED
+from backend.client_limits import ClientLimiter, ClientLease, ClientRejected
+from backend import lora
+from backend.hardware import get_available_memory_bytes
+from backend.profiler import SamplingProfiler, ProfilerBusyError
 from llama_cpp import Llama
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Optional, List, Tuple
 import uuid
 from dotenv import load_dotenv
 import sqlite3
@@ -57,6 +77,8 @@ def init_db():
     try:
         conn = sqlite3.connect(DATABASE_PATH)
         cursor = conn.cursor()
+        # WAL: долгое чтение (например, потоковый /export) не блокирует запись новых сообщений
+        cursor.execute("PRAGMA journal_mode=WAL;")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS chats (
                 chat_id TEXT PRIMARY KEY,
@@ -84,6 +106,26 @@ def init_db():
                 UPDATE chats SET last_modified_at = CURRENT_TIMESTAMP WHERE chat_id = NEW.chat_id;
             END;
         """)
+        # Сообщения чата и его версия для ETag (MAX(message_id)) читаются по индексу, без обхода таблицы
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id);")
+        # LoRA-адаптер базовой модели, выбранный для чата (старые базы — без этой колонки)
+        chat_columns = {row[1] for row in cursor.execute("PRAGMA table_info(chats)").fetchall()}
+        if "lora_adapter" not in chat_columns:
+            cursor.execute("ALTER TABLE chats ADD COLUMN lora_adapter TEXT;")
+        # Использование модели клиентами (X-API-Key, без ключа — IP) по дням
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS client_usage (
+                client_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                rejected INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                queue_wait_seconds REAL NOT NULL DEFAULT 0,
+                generation_seconds REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (client_id, day)
+            );
+        """)
         conn.commit()
         logger.info(f"База данных инициализирована: {DATABASE_PATH}")
     except sqlite3.Error as e:
@@ -111,6 +153,17 @@ def get_db_connection():
 
 # --- Хелперы для работы с БД ---
 
+# Список чатов и последние сообщения чатов в памяти; db_* хелперы ниже обновляют его после каждой записи
+chat_cache = ChatCache(
+    max_bytes=int(os.getenv("CHAT_CACHE_MAX_MB", "64")) * 1024 * 1024,
+    window_size=int(os.getenv("CHAT_CACHE_WINDOW", "200")),
+    enabled=os.getenv("CHAT_CACHE_ENABLED", "1") == "1",
+)
+
+# Удаление чата и смена его модели не двигают MAX(last_modified_at), поэтому для ETag списка чатов
+# считаем их отдельно. Начинаем со времени запуска, чтобы счетчик не повторился после рестарта
+chat_list_changes = time.time_ns()
+
 def db_add_chat(chat_id: str, title: str, model_used: Optional[str] = None):
     conn = get_db_connection()
     try:
@@ -120,6 +173,9 @@ def db_add_chat(chat_id: str, title: str, model_used: Optional[str] = None):
             (chat_id, title, model_used, datetime.datetime.now(), datetime.datetime.now())
         )
         conn.commit()
+        row = cursor.execute("SELECT chat_id, title, model_used, last_modified_at FROM chats WHERE chat_id = ?",
+                             (chat_id,)).fetchone()
+        chat_cache.add_chat(dict(row))
         logger.info(f"Чат '{title}' (ID: {chat_id}) добавлен в БД.")
     except sqlite3.IntegrityError:
         logger.warning(f"Чат с ID {chat_id} уже существует.")
@@ -151,6 +207,15 @@ def db_add_message(chat_id: str, sender: str, content: str):
             logger.info(f"Название чата {chat_id} обновлено на: {content[:50]}")
 
         conn.commit()
+        # Время сообщения и чата ставит SQLite (DEFAULT и триггер) — читаем их обратно для кеша
+        row = cursor.execute(
+            """SELECT m.message_id, m.sender, m.content, m.timestamp, c.title, c.last_modified_at
+               FROM messages m JOIN chats c ON c.chat_id = m.chat_id WHERE m.message_id = ?""",
+            (cursor.lastrowid,)
+        ).fetchone()
+        if row:
+            chat_cache.add_message(chat_id, {key: row[key] for key in ("message_id", "sender", "content", "timestamp")},
+                                   title=row["title"], last_modified_at=row["last_modified_at"])
         logger.info(f"Сообщение от '{sender}' добавлено в чат {chat_id}.")
     except sqlite3.Error as e:
         logger.error(f"Ошибка добавления сообщения в чат {chat_id}: {e}")
@@ -162,11 +227,147 @@ def db_add_message(chat_id: str, sender: str, content: str):
             conn.close()
 
 
+def db_replace_chat_title(chat_id: str, title: str, expected_title: str) -> bool:
+    """Меняет название, только если оно все еще expected_title (например, не переименовано вручную)."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE chats SET title = ? WHERE chat_id = ? AND title = ?", (title, chat_id, expected_title))
+        conn.commit()
+        if cursor.rowcount:
+            chat_cache.update_chat(chat_id, title=title)
+            note_chat_list_change()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка обновления названия чата {chat_id}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+
+def db_get_chat_lora(chat_id: str) -> Optional[str]:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT lora_adapter FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row["lora_adapter"] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка чтения адаптера чата {chat_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка чтения настроек чата.")
+    finally:
+        conn.close()
+
+
+def db_set_chat_lora(chat_id: str, adapter: Optional[str]) -> bool:
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE chats SET lora_adapter = ? WHERE chat_id = ?", (adapter, chat_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка сохранения адаптера чата {chat_id}: {e}")
+        conn.rollback()
+        raise HTTPException(status_code=500, detail="Ошибка сохранения настроек чата.")
+    finally:
+        conn.close()
+
+
+def db_set_chat_model(chat_id: str, model_used: str):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE chats SET model_used = ? WHERE chat_id = ?", (model_used, chat_id))
+        conn.commit()
+        if cursor.rowcount:
+            chat_cache.update_chat(chat_id, model_used=model_used)
+            note_chat_list_change()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка обновления модели чата {chat_id}: {e}")
+        conn.rollback()
+        raise HTTPException(status_code=500, detail="Ошибка сохранения модели чата.")
+    finally:
+        if conn:
+            conn.close()
+
+
+def db_record_client_usage(client_id: str, requests: int = 0, rejected: int = 0, prompt_tokens: int = 0,
+                           completion_tokens: int = 0, queue_wait_seconds: float = 0.0,
+                           generation_seconds: float = 0.0):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            """INSERT INTO client_usage (client_id, day, requests, rejected, prompt_tokens, completion_tokens,
+                                          queue_wait_seconds, generation_seconds)
+               VALUES (?, date('now'), ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (client_id, day) DO UPDATE SET
+                   requests = requests + excluded.requests,
+                   rejected = rejected + excluded.rejected,
+                   prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                   completion_tokens = completion_tokens + excluded.completion_tokens,
+                   queue_wait_seconds = queue_wait_seconds + excluded.queue_wait_seconds,
+                   generation_seconds = generation_seconds + excluded.generation_seconds""",
+            (client_id, requests, rejected, prompt_tokens, completion_tokens, queue_wait_seconds, generation_seconds)
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        # Статистика не должна ломать ответ пользователю
+        logger.error(f"Ошибка записи использования клиента {client_id}: {e}")
+    finally:
+        conn.close()
+
+
+def db_get_client_usage(days: int) -> List[Dict]:
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(
+            """SELECT client_id, SUM(requests) AS requests, SUM(rejected) AS rejected,
+                      SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens,
+                      ROUND(SUM(queue_wait_seconds), 3) AS queue_wait_seconds,
+                      ROUND(SUM(generation_seconds), 3) AS generation_seconds,
+                      MIN(day) AS first_day, MAX(day) AS last_day
+               FROM client_usage WHERE day >= date('now', ?)
+               GROUP BY client_id ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC""",
+            (f"-{days - 1} days",)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка чтения использования клиентов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка чтения статистики клиентов.")
+    finally:
+        conn.close()
+
+
+def db_get_recent_chat_models(limit: int) -> List[str]:
+    """Модели из chats.model_used, начиная с последней использованной."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT model_used FROM chats WHERE model_used IS NOT NULL
+               GROUP BY model_used ORDER BY MAX(last_modified_at) DESC LIMIT ?""",
+            (limit,)
+        )
+        return [row["model_used"] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения недавних моделей из БД: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+
 def db_get_chats() -> List[Dict]:
+    return chat_cache.chats(db_load_chats)
+
+
+def db_load_chats() -> List[Dict]:
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT chat_id, title, model_used, last_modified_at FROM chats ORDER BY last_modified_at DESC")
+        cursor.execute("SELECT chat_id, title, model_used, last_modified_at FROM chats "
+                       "ORDER BY last_modified_at DESC, chat_id ASC")
         chats = [dict(row) for row in cursor.fetchall()]
         return chats
     except sqlite3.Error as e:
@@ -177,7 +378,55 @@ def db_get_chats() -> List[Dict]:
             conn.close()
 
 
-def db_get_messages(chat_id: str) -> List[Dict]:
+def note_chat_list_change():
+    global chat_list_changes
+    chat_list_changes += 1
+
+
+def db_get_chats_version() -> Tuple:
+    """Версия списка чатов для ETag: дешевый агрегат вместо чтения всех строк."""
+    return (*chat_cache.chats_version(db_load_chats_version), chat_list_changes)
+
+
+def db_load_chats_version() -> Tuple:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT COUNT(*), MAX(last_modified_at) FROM chats").fetchone()
+        return row[0], row[1]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения версии списка чатов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка чтения списка чатов.")
+    finally:
+        conn.close()
+
+
+def db_get_messages_version(chat_id: str) -> Optional[Tuple]:
+    """Версия истории чата для ETag: last_modified_at и последний message_id (None — чата нет)."""
+    return chat_cache.messages_version(chat_id, lambda: db_load_messages_version(chat_id))
+
+
+def db_load_messages_version(chat_id: str) -> Optional[Tuple]:
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            """SELECT last_modified_at, (SELECT MAX(message_id) FROM messages WHERE chat_id = ?)
+               FROM chats WHERE chat_id = ?""",
+            (chat_id, chat_id)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения версии чата {chat_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка чтения сообщений чата.")
+    finally:
+        conn.close()
+
+
+def db_get_messages(chat_id: str, limit: Optional[int] = None) -> Optional[List[Dict]]:
+    """История чата (или последние limit сообщений) по возрастанию времени; None — чата нет."""
+    return chat_cache.messages(chat_id, lambda load_limit: db_load_messages(chat_id, load_limit), limit)
+
+
+def db_load_messages(chat_id: str, limit: Optional[int] = None) -> Optional[List[Dict]]:
     conn = get_db_connection()
     # Сначала проверим, существует ли чат
     cursor = conn.cursor()
@@ -191,12 +440,20 @@ def db_get_messages(chat_id: str) -> List[Dict]:
         return None
 
     try:
+        # Порядок — по message_id (порядок вставки, его сохраняет и импорт): так строки идут прямо
+        # по индексу (chat_id, message_id), а окна кеша совпадают с тем, что отдала бы БД
+        if limit is None:
+            cursor.execute(
+                "SELECT message_id, sender, content, timestamp FROM messages WHERE chat_id = ? ORDER BY message_id ASC",
+                (chat_id,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
         cursor.execute(
-            "SELECT message_id, sender, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp ASC",
-            (chat_id,)
+            "SELECT message_id, sender, content, timestamp FROM messages WHERE chat_id = ? "
+            "ORDER BY message_id DESC LIMIT ?",
+            (chat_id, limit)
         )
-        messages = [dict(row) for row in cursor.fetchall()]
-        return messages
+        return [dict(row) for row in reversed(cursor.fetchall())]
     except sqlite3.Error as e:
         logger.error(f"Ошибка получения сообщений для чата {chat_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка чтения сообщений чата.")
@@ -212,7 +469,9 @@ def db_delete_chat(chat_id: str) -> bool:
         cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
         deleted_rows = cursor.rowcount
         conn.commit()
+        chat_cache.delete_chat(chat_id)
         if deleted_rows > 0:
+            note_chat_list_change()
             logger.info(f"Чат {chat_id} и его сообщения удалены из БД.")
             return True
         else:
@@ -237,6 +496,57 @@ if not HF_TOKEN:
 
 model_manager = None  # Инициализируем при первом запросе, требующем токен
 llm_instance = None
+# Загрузка/смена модели идет и из запросов, и из фонового прогрева при старте
+llm_lock = threading.RLock()
+# Очередь генераций с приоритетами: интерактивные ходы вытесняют фоновые задачи на границе токена
+generation_scheduler = GenerationScheduler()
+background_jobs = BackgroundJobs()
+lora_stats = lora.LoraStats()
+# Клиенты общего сервера: ключи, веса в справедливой очереди и лимиты (CLIENT_* в .env)
+client_limiter = ClientLimiter.from_env()
+# Название чата после первого ответа придумывает модель (в фоне); до этого — начало первого сообщения
+LLM_CHAT_TITLES = os.getenv("LLM_CHAT_TITLES", "1") == "1"
+model_usage_log = ModelUsageLog()
+tuning_store = inference_tuning.TuningStore()
+
+# Кеш ответов: используется при temperature == 0 или если клиент явно попросил (use_cache).
+# Семантический уровень (похожий, а не тот же вопрос) — только с моделью эмбеддингов
+# RESPONSE_CACHE_EMBED_MODEL или по явному use_cache: хеш триграмм путает вопросы, различающиеся одним словом
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_MB", "32")) * 1024 * 1024,
+    similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95")),
+    embedder=create_embedder(os.getenv("RESPONSE_CACHE_EMBED_MODEL")),
+)
+speculative_store = SpeculativeConfigStore()
+# Статистика генерации по (файл модели, режим спекулятивного декодирования) — чтобы сравнивать ускорение
+generation_stats: Dict[str, Dict] = {}
+generation_stats_lock = threading.Lock()
+# Текущие генерации по chat_id — для POST /chats/{id}/stop
+active_generations: Dict[str, CancellationToken] = {}
+active_generations_lock = threading.Lock()
+cancellation_stats = CancellationStats()
+DISCONNECT_POLL_INTERVAL = 0.25  # Как часто проверяем, не ушел ли клиент во время /query
+calibration_status = {"state": "idle", "model": None, "trials": 0, "current": None, "result": None, "error": None,
+                      "preemptions": 0}
+
+# Прогрев недавних моделей при старте (см. start_model_preload)
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1") == "1"
+PRELOAD_MAX_MODELS = int(os.getenv("PRELOAD_MAX_MODELS", "2"))
+PRELOAD_MEMORY_BUDGET_MB = os.getenv("PRELOAD_MEMORY_BUDGET_MB")  # По умолчанию половина доступной памяти
+preload_status = {"state": "idle", "loaded": None, "prefetched": [], "warmup_seconds": None}
+
+# "process" — каждая модель в своем процессе-воркере (backend/model_worker.py): падение llama.cpp
+# не роняет API, а несколько моделей могут быть загружены одновременно.
+# "inprocess" — одна модель в процессе API (llm_instance), как раньше.
+WORKER_MODE = os.getenv("NEURABOX_WORKER_MODE", "inprocess")
+WORKER_MAX_MODELS = int(os.getenv("WORKER_MAX_MODELS", "2"))
+
+# Админские эндпоинты; если ADMIN_TOKEN задан, запрос должен передать его в X-Admin-Token
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = 120
+profiler = SamplingProfiler()
 # Убрали: conversation_histories: Dict[str, deque] = {}
 
 global_model_settings = {
@@ -287,6 +597,12 @@ def get_gpu_layers():
 
 class ModelRequestBody(BaseModel):
     model: str
+    quant: Optional[str] = None  # Например "Q4_K_M"; по умолчанию подбирается под память машины
+
+
+class ModelPinRequestBody(BaseModel):
+    model: str
+    pinned: bool = True  # Закрепленные модели не вытесняются из хранилища по квоте
 
 
 class ModelSettingsRequestBody(BaseModel):
@@ -295,11 +611,109 @@ class ModelSettingsRequestBody(BaseModel):
     top_p: float = Field(default=global_model_settings["top_p"], ge=0.0, le=1.0)
 
 
+class SpeculativeConfigRequestBody(BaseModel):
+    model: str
+    mode: str = "off"  # off | prompt_lookup | draft_model
+    num_pred_tokens: int = Field(default=10, ge=1, le=64)
+    max_ngram_size: int = Field(default=2, ge=1, le=8)  # Только для prompt_lookup
+    draft_model: Optional[str] = None  # Имя GGUF-файла в MODELS_DIR, только для draft_model
+
+
+class CalibrationRequestBody(BaseModel):
+    model: str
+    quick: bool = True  # Быстрая сетка (~6 загрузок модели) или полная
+
+
 class QueryRequestBody(ModelSettingsRequestBody):  # Настройки можно переопределять в запросе
     text: str
     model: str
     chat_id: str  # ID чата теперь обязателен от фронтенда
-    use_internet: bool = False  # Оставляем, если используется
+    use_internet: bool = False  # Deep research: план подзапросов, поиск в сети и ответ со ссылками на источники
+    research_budget_seconds: Optional[float] = Field(default=None, gt=0, le=600)  # По умолчанию RESEARCH_BUDGET_SECONDS
+    use_cache: bool = False  # Разрешить ответ из кеша, в том числе на похожий вопрос, даже при temperature > 0
+    lora: Optional[str] = None  # LoRA-адаптер на этот запрос; None — адаптер чата, "" — чистая база
+    lora_scale: float = Field(default=1.0, ge=0.0, le=4.0)
+
+
+def get_base_llama_kwargs() -> Dict:
+    return {
+        "n_ctx": 4096,
+        "n_gpu_layers": get_gpu_layers(),
+        "use_mmap": True,
+        "verbose": False,
+    }
+
+
+def get_llama_kwargs(model_path: str) -> Dict:
+    """Параметры Llama для модели: откалиброванные для этой машины или значения по умолчанию."""
+    kwargs = {**get_base_llama_kwargs(), "n_threads": os.cpu_count() // 2, "use_mlock": False}
+    tuned = tuning_store.get(model_path)
+    if tuned:
+        kwargs.update(tuned["params"])
+        logger.info(f"Применены откалиброванные параметры для {os.path.basename(model_path)}: {tuned['params']}")
+    return kwargs
+
+
+def get_worker_config(model_path: str) -> Tuple[Dict, Dict, Dict]:
+    """Параметры запуска воркера; вызывается при каждом (пере)запуске процесса."""
+    return (get_llama_kwargs(model_path), speculative_store.get(os.path.basename(model_path)),
+            get_base_llama_kwargs())
+
+
+worker_pool = WorkerPool(get_worker_config, ModelManager.MODELS_DIR, max_workers=WORKER_MAX_MODELS)
+
+
+def use_worker_processes() -> bool:
+    return WORKER_MODE == "process"
+
+
+def generation_resource(model_path: str) -> str:
+    """Ресурс generation_scheduler: воркеры разных моделей генерируют параллельно, в процессе API модель одна."""
+    return model_path if use_worker_processes() else "inprocess"
+
+
+def create_llama(model_path: str) -> Llama:
+    kwargs = get_llama_kwargs(model_path)
+    logger.info(f"Параметры Llama: {kwargs}")
+    return create_llama_with_draft(model_path, kwargs, speculative_store.get(os.path.basename(model_path)),
+                                   ModelManager.MODELS_DIR, get_base_llama_kwargs())
+
+
+def record_generation_stats(model_path: str, result: Dict) -> Dict:
+    """Накопительная статистика скорости генерации; возвращает сводку по одному запросу."""
+    mode = speculative_store.get(os.path.basename(model_path))["mode"] if result["speculative"] else "off"
+    completion_tokens, seconds = result["completion_tokens"], result["seconds"]
+    proposed, accepted = result["draft_proposed"], result["draft_accepted"]
+    stats_key = f"{os.path.basename(model_path)}|{mode}"
+    with generation_stats_lock:
+        stats = generation_stats.setdefault(stats_key, {
+            "requests": 0, "completion_tokens": 0, "seconds": 0.0, "proposed": 0, "accepted": 0})
+        stats["requests"] += 1
+        stats["completion_tokens"] += completion_tokens
+        stats["seconds"] += seconds
+        stats["proposed"] += proposed
+        stats["accepted"] += accepted
+    return {
+        "mode": mode,
+        "tokens_per_second": round(completion_tokens / seconds, 2) if seconds > 0 else 0.0,
+        "draft_tokens_proposed": proposed,
+        "draft_tokens_accepted": accepted,
+        "acceptance_rate": round(accepted / proposed, 4) if proposed else None,
+    }
+
+
+def get_generation_metrics() -> Dict[str, Dict]:
+    with generation_stats_lock:
+        return {
+            key: {
+                **stats,
+                "seconds": round(stats["seconds"], 3),
+                "tokens_per_second": round(stats["completion_tokens"] / stats["seconds"], 2)
+                if stats["seconds"] > 0 else 0.0,
+                "acceptance_rate": round(stats["accepted"] / stats["proposed"], 4) if stats["proposed"] else None,
+            }
+            for key, stats in generation_stats.items()
+        }
 
 
 def load_model(model_name: str):
@@ -313,34 +727,172 @@ def load_model(model_name: str):
             logger.error(f"Путь к модели не найден или не существует: {model_path} для {model_name}")
             raise HTTPException(status_code=404, detail=f"Файл модели {model_name} не найден. Установите ее.")
 
-        gpu_layers = get_gpu_layers()
-        n_ctx = 4096
-        logger.info(f"Загрузка модели: {model_name} (Путь: {model_path})")
-        logger.info(f"Параметры Llama: n_ctx={n_ctx}, n_gpu_layers={gpu_layers}")
+        with llm_lock:
+            logger.info(f"Загрузка модели: {model_name} (Путь: {model_path})")
 
-        # Освобождаем ресурсы предыдущей модели
-        if llm_instance:
-            logger.info("Освобождаем ресурсы предыдущей модели...")
-            del llm_instance
-            llm_instance = None
-            logger.info("Ресурсы освобождены.")
-
-        llm_instance = Llama(
-            model_path=model_path,
-            n_ctx=n_ctx,
-            n_threads=os.cpu_count() // 2,
-            n_gpu_layers=gpu_layers,
-            use_mmap=True,
-            use_mlock=False,
-            verbose=False
-        )
+            # Освобождаем ресурсы предыдущей модели
+            if llm_instance:
+                logger.info("Освобождаем ресурсы предыдущей модели...")
+                lora.release_adapters(llm_instance)
+                del llm_instance
+                llm_instance = None
+                logger.info("Ресурсы освобождены.")
+
+            with tracing.span("model.load", model=model_name):
+                llm_instance = create_llama(model_path)
         logger.info(f"Модель {model_name} успешно загружена.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(
             f"Поймано исключение при загрузке модели: Model={model_name}, Type={type(e).__name__}, Error={e}")
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки модели: {str(e)}")
 
 
+def ensure_model_loaded(model_name: str, model_path: str):
+    """Загружает модель, если сейчас загружена другая (или никакая).
+
+    Держит llm_lock, поэтому если фоновый прогрев как раз грузит эту же модель,
+    запрос дождется его и не будет загружать ее второй раз. В режиме воркеров
+    поднимает процесс модели (или ждет, пока он поднимется).
+    """
+    if use_worker_processes():
+        try:
+            worker_pool.get(model_path)
+        except Exception as e:
+            logger.exception(f"Не удалось запустить воркер модели {model_name}: {e}")
+            raise HTTPException(status_code=500, detail=f"Ошибка загрузки модели: {str(e)}")
+        return
+    with llm_lock:
+        if not llm_instance or llm_instance.model_path != model_path:
+            logger.info(f"Требуется загрузка/перезагрузка модели {model_name}...")
+            load_model(model_name)
+        else:
+            logger.info(f"Модель {model_name} уже загружена.")
+
+
+def resident_llm(model_path: str) -> Optional[Llama]:
+    """Загруженный в процессе экземпляр model_path или None — без llm_lock.
+
+    llm_lock держит генерация на все время ответа, поэтому подготовка хода не должна его ждать:
+    иначе интерактивный запрос стоит за фоновой генерацией в потоке пула и до очереди
+    generation_scheduler не доходит. Ссылка держит экземпляр живым, даже если модель тут же сменят.
+    """
+    llm = llm_instance
+    return llm if llm is not None and llm.model_path == model_path else None
+
+
+def load_model_for_turn(model_name: str, model_path: str):
+    """Модель для интерактивного хода: если ее нет в памяти, грузим в слоте очереди.
+
+    Слот с приоритетом INTERACTIVE вытесняет фоновую генерацию, как и сам ход.
+    """
+    if resident_llm(model_path) is not None or model_path in worker_pool.resident_model_paths():
+        logger.info(f"Модель {model_name} уже загружена.")
+        return
+    with generation_scheduler.slot(generation_resource(model_path), INTERACTIVE, cost=0):
+        ensure_model_loaded(model_name, model_path)
+
+
+def tokenize_prompt(model_name: str, model_path: str, text: str) -> List[int]:
+    llm = resident_llm(model_path)
+    if llm is not None:
+        return llm.tokenize(text.encode("utf-8"))  # Токенизация читает только словарь модели
+    with generation_scheduler.slot(generation_resource(model_path), INTERACTIVE, cost=0):
+        if use_worker_processes():
+            # Воркер обслуживает запросы по одному, так что токенизация все равно ждала бы генерацию
+            return worker_pool.tokenize(model_path, text)
+        with llm_lock:
+            ensure_model_loaded(model_name, model_path)
+            return llm_instance.tokenize(text.encode("utf-8"))
+
+
+def get_or_create_model_manager() -> ModelManager:
+    """ModelManager для эндпоинтов без UI (например, /v1): создаем с токеном из .env, если его еще нет."""
+    global model_manager
+    if model_manager is None:
+        logger.info(f"Инициализация ModelManager с токеном {'(есть)' if HF_TOKEN else '(нет)'}")
+        model_manager = ModelManager(hf_token=HF_TOKEN)
+    return model_manager
+
+
+def resolve_model_path(model_name: str) -> str:
+    model_path = get_or_create_model_manager().get_model_path(model_name)
+    if not model_path or not os.path.exists(model_path):
+        logger.warning(f"Модель {model_name} не найдена локально.")
+        raise HTTPException(status_code=404, detail=f"Модель {model_name} не установлена.")
+    return model_path
+
+
+def get_preload_candidates() -> List[Dict]:
+    """Недавние модели из журнала использования и chats.model_used, от свежих к старым."""
+    candidates = model_usage_log.recent()
+    known_names = {c["name"] for c in candidates}
+    for model_name in db_get_recent_chat_models(limit=PRELOAD_MAX_MODELS * 2):
+        if model_name in known_names:
+            continue
+        # Без журнала путь известен только для локальных моделей (имя == имя файла).
+        # Идти за путем в Hugging Face при старте не хотим — это медленно и требует сети.
+        local_path = os.path.join(ModelManager.MODELS_DIR, model_name)
+        if model_name.endswith(".gguf") and os.path.exists(local_path):
+            candidates.append({"name": model_name, "model_path": local_path})
+    return candidates
+
+
+def preload_recent_models():
+    """Фоновый прогрев: самая свежая модель загружается и прогревается, остальные подкачиваются в page cache."""
+    global llm_instance
+    preload_status["state"] = "running"
+    try:
+        if PRELOAD_MEMORY_BUDGET_MB:
+            budget_bytes = int(PRELOAD_MEMORY_BUDGET_MB) * 1024 * 1024
+        else:
+            budget_bytes = (get_available_memory_bytes() or 0) // 2
+        selected = model_preloader.select_preload_candidates(
+            get_preload_candidates(), budget_bytes, PRELOAD_MAX_MODELS)
+        if not selected:
+            logger.info("Нет недавних моделей для предзагрузки.")
+            return
+
+        for entry in selected:
+            elapsed = sum(model_preloader.prefetch_file(part)
+                          for part in quant_selection.shard_file_names(entry["model_path"]) if os.path.exists(part))
+            preload_status["prefetched"].append(entry["name"])
+            logger.info(f"Файл модели {entry['name']} подкачан в page cache за {elapsed:.1f} c.")
+
+        primary = selected[0]
+        if use_worker_processes():
+            start = time.perf_counter()
+            worker_pool.get(primary["model_path"], warm_up=True)
+            warmup_seconds = time.perf_counter() - start
+            preload_status["loaded"] = primary["name"]
+            preload_status["warmup_seconds"] = round(warmup_seconds, 3)
+            logger.info(f"Воркер модели {primary['name']} запущен и прогрет за {warmup_seconds:.2f} c.")
+            return
+        with llm_lock:
+            # Если пользователь успел отправить запрос и загрузил модель сам, не перебиваем ее
+            if llm_instance is not None:
+                logger.info("Модель уже загружена запросом, пропускаем предзагрузку.")
+                return
+            logger.info(f"Предзагрузка модели {primary['name']} (Путь: {primary['model_path']})")
+            llm_instance = create_llama(primary["model_path"])
+            warmup_seconds = model_preloader.warm_up(llm_instance)
+        preload_status["loaded"] = primary["name"]
+        preload_status["warmup_seconds"] = round(warmup_seconds, 3)
+        logger.info(f"Модель {primary['name']} предзагружена и прогрета за {warmup_seconds:.2f} c.")
+    except Exception as e:
+        logger.exception(f"Ошибка предзагрузки моделей: {e}")
+    finally:
+        preload_status["state"] = "done"
+
+
+def start_model_preload():
+    if not PRELOAD_MODELS:
+        logger.info("Предзагрузка моделей отключена (PRELOAD_MODELS=0).")
+        return
+    threading.Thread(target=preload_recent_models, name="model-preload", daemon=True).start()
+
+
 # --- Существующие эндпоинты (некоторые с изменениями) ---
 
 @router.get("/models")
@@ -356,7 +908,8 @@ async def list_available_models(request: Request):
             logger.error(f"Ошибка инициализации ModelManager: {e}")
             raise HTTPException(status_code=500, detail=f"Ошибка инициализации менеджера моделей: {e}")
     try:
-        return model_manager.get_available_models()
+        models = model_manager.get_available_models()
+        return json_response(request, models, etag=make_etag("models", model_manager.catalog_version))
     except Exception as e:
         logger.error(f"Ошибка при получении списка моделей: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении списка моделей.")
@@ -369,14 +922,242 @@ async def install_model(request: ModelRequestBody):
                             detail="Менеджер моделей не инициализирован. Сначала выполните GET /models.")
     try:
         logger.info(f"Начало установки модели: {request.model}")
-        local_path = model_manager.download_model(request.model)
+        # Загруженные сейчас модели не вытесняем, даже если они давно не использовались
+        protected = [get_model_store().file_name_for(path) for path in get_resident_model_paths()]
+        local_path = await run_in_threadpool(model_manager.download_model, request.model, protected, request.quant)
         logger.info(f"Модель {request.model} успешно установлена в: {local_path}")
         return {"message": f"Модель {request.model} установлена", "local_path": local_path}
+    except ModelStoreQuotaError as e:
+        logger.warning(f"Установка модели {request.model} отклонена: {e}")
+        raise HTTPException(status_code=507, detail={"message": str(e), "eviction_suggestions": e.suggestions})
     except Exception as e:
         logger.error(f"Ошибка установки модели {request.model}: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка установки модели: {str(e)}")
 
 
+def get_resident_model_paths() -> set:
+    """Файлы моделей, загруженные сейчас в память (в процессе API или в воркерах)."""
+    llm = llm_instance
+    resident_paths = set(worker_pool.resident_model_paths())
+    if llm is not None:
+        resident_paths.add(llm.model_path)
+    return resident_paths
+
+
+def unload_model_path(model_path: str):
+    global llm_instance
+    with llm_lock:
+        if llm_instance and llm_instance.model_path == model_path:
+            lora.release_adapters(llm_instance)
+            del llm_instance
+            llm_instance = None
+    worker_pool.stop(model_path)
+
+
+def unload_in_process_model():
+    """Освобождает модель процесса API, какой бы она ни была (вызывать в слоте generation_scheduler)."""
+    global llm_instance
+    with llm_lock:
+        if llm_instance:
+            logger.info("Освобождаем ресурсы модели процесса API...")
+            lora.release_adapters(llm_instance)
+            del llm_instance
+            llm_instance = None
+
+
+@router.get("/models/store")
+async def get_model_store_status():
+    return await run_in_threadpool(get_model_store().stats)
+
+
+@router.post("/models/pin")
+async def pin_model(request: ModelPinRequestBody):
+    model_path = await run_in_threadpool(resolve_model_path, request.model)
+    if not get_model_store().set_pinned(get_model_store().file_name_for(model_path), request.pinned):
+        raise HTTPException(status_code=404, detail=f"Модель {request.model} не найдена в хранилище.")
+    return {"model": request.model, "pinned": request.pinned}
+
+
+@router.delete("/models/{model_name:path}")
+async def delete_model(model_name: str):
+    model_path = await run_in_threadpool(resolve_model_path, model_name)
+    # Сначала выгружаем модель, иначе на Windows файл не удалить, пока он отображен в память
+    await run_in_threadpool(unload_model_path, model_path)
+    if not await run_in_threadpool(get_or_create_model_manager().delete_model,
+                                   get_model_store().file_name_for(model_path)):
+        raise HTTPException(status_code=500, detail=f"Не удалось удалить модель {model_name}.")
+    logger.info(f"Модель {model_name} удалена ({model_path}).")
+    return {"message": f"Модель {model_name} удалена"}
+
+
+def calibrate_model(model_name: str, model_path: str, quick: bool):
+    """Калибровка — фоновая задача в очереди generation_scheduler, а не захват модели в обход нее.
+
+    Она ждет, пока модель освободится, и держит слот только на время замеров: интерактивный
+    запрос вытесняет ее (PREEMPTED) после текущего замера. Потом калибровка снова встает в очередь
+    и продолжает с того же места (finished_trials). Пока она держит слот, ходы к этой модели
+    ждут в очереди, поэтому ни загрузить модель, ни перезапустить воркер в обход нее не могут.
+    """
+    global llm_instance
+    calibration_status.update({"state": "running", "model": model_name, "trials": 0,
+                               "current": None, "result": None, "error": None, "preemptions": 0})
+    finished_trials: Dict[str, Dict] = {}
+    try:
+        while True:
+            cancel_token = CancellationToken()
+            with generation_scheduler.slot(generation_resource(model_path), BACKGROUND, cancel_token):
+                # Калибровка сама много раз грузит модель — освобождаем текущую,
+                # чтобы замеры не делили память и потоки с простаивающим экземпляром
+                with llm_lock:
+                    if llm_instance:
+                        lora.release_adapters(llm_instance)
+                        del llm_instance
+                        llm_instance = None
+                worker_pool.stop(model_path)
+                base_kwargs = get_base_llama_kwargs()
+                try:
+                    result = inference_tuning.run_calibration(
+                        Llama, model_path, base_kwargs, quick=quick, use_gpu=base_kwargs["n_gpu_layers"] != 0,
+                        progress=calibration_status, cancel_token=cancel_token, finished_trials=finished_trials)
+                    break
+                except inference_tuning.CalibrationPreempted:
+                    calibration_status["preemptions"] += 1
+                    logger.info(f"Калибровка {model_name} уступила модель после {len(finished_trials)} замеров.")
+            generation_scheduler.record_resume()
+        tuning_store.put(model_path, result)
+        calibration_status.update({"state": "done", "result": result})
+        logger.info(f"Калибровка {model_name} завершена: {result['params']}")
+    except Exception as e:
+        logger.exception(f"Ошибка калибровки модели {model_name}: {e}")
+        calibration_status.update({"state": "error", "error": str(e)})
+
+
+@router.post("/calibrate", status_code=202)
+async def start_calibration(request: CalibrationRequestBody):
+    if model_manager is None:
+        raise HTTPException(status_code=400,
+                            detail="Менеджер моделей не инициализирован. Сначала выполните GET /models.")
+    if calibration_status["state"] == "running":
+        raise HTTPException(status_code=409, detail="Калибровка уже выполняется.")
+    model_path = model_manager.get_model_path(request.model)
+    if not model_path or not os.path.exists(model_path):
+        raise HTTPException(status_code=404, detail=f"Модель {request.model} не установлена.")
+    calibration_status["state"] = "running"
+    threading.Thread(target=calibrate_model, args=(request.model, model_path, request.quick),
+                     name="model-calibration", daemon=True).start()
+    return {"message": f"Калибровка модели {request.model} запущена", "status": calibration_status}
+
+
+@router.get("/calibrate/status")
+async def get_calibration_status():
+    return calibration_status
+
+
+@router.get("/speculative")
+async def list_speculative_configs():
+    return speculative_store.all()
+
+
+@router.post("/speculative")
+async def update_speculative_config(request: SpeculativeConfigRequestBody):
+    global llm_instance
+    if model_manager is None:
+        raise HTTPException(status_code=400,
+                            detail="Менеджер моделей не инициализирован. Сначала выполните GET /models.")
+    if request.mode not in SPECULATIVE_MODES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный режим {request.mode}. Допустимы: {SPECULATIVE_MODES}")
+    if request.mode == "draft_model":
+        if not request.draft_model:
+            raise HTTPException(status_code=400, detail="Для режима draft_model нужно указать draft_model.")
+        if not os.path.exists(os.path.join(ModelManager.MODELS_DIR, request.draft_model)):
+            raise HTTPException(status_code=404, detail=f"Черновая модель {request.draft_model} не найдена.")
+    model_path = model_manager.get_model_path(request.model)
+    if not model_path:
+        raise HTTPException(status_code=404, detail=f"Модель {request.model} не установлена.")
+
+    config = request.dict(exclude={"model"})
+    speculative_store.put(os.path.basename(model_path), config)
+    # Черновик передается в Llama при создании, поэтому загруженную модель придется перезагрузить
+    with llm_lock:
+        if llm_instance and llm_instance.model_path == model_path:
+            lora.release_adapters(llm_instance)
+            del llm_instance
+            llm_instance = None
+    # Воркер с этой моделью перезапустится с новыми настройками при следующем запросе
+    worker_pool.stop(model_path)
+    logger.info(f"Настройки спекулятивного декодирования для {request.model} обновлены: {config}")
+    return {"message": "Настройки спекулятивного декодирования обновлены", "settings": config}
+
+
+@router.get("/node_status")
+async def get_node_status():
+    """Состояние узла для шлюза (backend/gateway.py): какая модель в памяти и сколько генераций идет."""
+    resident_paths = get_resident_model_paths()
+    # Клиенты обращаются к модели по имени (repo_id или имя файла) — отдаем все известные имена файла
+    resident_names = [e["name"] for e in model_usage_log.recent() if e.get("model_path") in resident_paths]
+    resident_names.extend(os.path.basename(path) for path in resident_paths)
+    with active_generations_lock:
+        active = len(active_generations)
+    return {
+        "resident_models": sorted(set(resident_names)),
+        "active_generations": active,
+        "preload_state": preload_status["state"],
+    }
+
+
+@router.get("/metrics")
+async def get_metrics():
+    return {
+        "response_cache": response_cache.stats(),
+        "generation": get_generation_metrics(),
+        "cancellation": cancellation_stats.snapshot(),
+        "workers": {"mode": WORKER_MODE, "processes": worker_pool.status()},
+        "scheduler": {**generation_scheduler.snapshot(), "background_jobs": background_jobs.snapshot()},
+        "lora": lora_stats.snapshot(),
+        "chat_cache": chat_cache.stats(),
+    }
+
+
+def check_admin(http_request: Request):
+    if ADMIN_TOKEN and http_request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Неверный X-Admin-Token.")
+
+
+@router.get("/clients/usage")
+async def get_client_usage(http_request: Request, days: int = 30):
+    """Использование модели по клиентам за последние days дней и текущие лимиты."""
+    check_admin(http_request)
+    if not 1 <= days <= 3650:
+        raise HTTPException(status_code=400, detail="days должно быть от 1 до 3650.")
+    usage = await run_in_threadpool(db_get_client_usage, days)
+    return {"days": days, "clients": usage, **client_limiter.snapshot()}
+
+
+@router.post("/admin/profile")
+async def run_profiler(http_request: Request, seconds: float = 10, interval_ms: float = 5):
+    """Сэмплирует стеки всех потоков seconds секунд и возвращает collapsed stacks для flamegraph."""
+    check_admin(http_request)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds должно быть от 0 до {PROFILE_MAX_SECONDS}.")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms должно быть от 1 до 1000.")
+    logger.info(f"Профилирование на {seconds} с, интервал {interval_ms} мс")
+    try:
+        profile = await run_in_threadpool(profiler.run, seconds, interval_ms / 1000)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(profile["collapsed"], headers={
+        "Content-Disposition": f'attachment; filename="neurabox-{int(time.time())}.collapsed"',
+        "X-Profile-Samples": str(profile["samples"]),
+        "X-Profile-Seconds": str(profile["seconds"]),
+    })
+
+
+@router.get("/preload_status")
+async def get_preload_status():
+    return preload_status
+
+
 @router.post("/update_model_settings")
 async def update_model_settings(request: ModelSettingsRequestBody):
     global global_model_settings
@@ -397,29 +1178,74 @@ async def update_model_settings(request: ModelSettingsRequestBody):
         raise HTTPException(status_code=500, detail="Ошибка обновления настроек.")
 
 
-@router.post("/query")
-async def process_query(request: QueryRequestBody):
-    global llm_instance, global_model_settings, model_manager
+async def admit_client(http_request: Request) -> ClientLease:
+    """Опознает клиента и занимает его слот генерации; при превышении лимитов — 429 с Retry-After."""
+    remote_host = http_request.client.host if http_request.client else None
+    client = None
+    try:
+        client = client_limiter.identify(http_request.headers, remote_host)
+        return client_limiter.admit(client)
+    except ClientRejected as e:
+        logger.warning(f"Запрос клиента {client if client else '(без ключа)'} отклонен ({e.reason}): {e}")
+        if client is not None:
+            await run_in_threadpool(db_record_client_usage, client.client_id, rejected=1)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=e.headers())
+
+
+def resolve_lora_adapter(model_path: str, adapter: Optional[str]) -> Optional[str]:
+    """Проверяет, что адаптер есть у этой базовой модели; пустое имя — без адаптера."""
+    if not adapter:
+        return None
+    try:
+        lora.adapter_path(model_path, adapter)
+    except lora.LoraAdapterError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return adapter
 
-    logger.info(f"Запрос к /query для chat_id: {request.chat_id}, модель: {request.model}")
 
+def register_generation(chat_id: str) -> CancellationToken:
+    cancel_token = CancellationToken()
+    with active_generations_lock:
+        active_generations[chat_id] = cancel_token
+    return cancel_token
+
+
+def unregister_generation(chat_id: str, cancel_token: CancellationToken):
+    with active_generations_lock:
+        if active_generations.get(chat_id) is cancel_token:
+            del active_generations[chat_id]
+
+
+async def watch_disconnect(http_request: Request, cancel_token: CancellationToken):
+    """Следит за клиентом, пока идет генерация, и отменяет ее, если соединение закрыто."""
+    while not cancel_token.cancelled:
+        if await http_request.is_disconnected():
+            logger.info("Клиент отключился, генерация будет прервана.")
+            cancel_token.cancel("disconnect")
+            break
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+async def prepare_chat_turn(request: QueryRequestBody) -> Dict:
+    """Готовит ход диалога: модель, сообщение пользователя в БД, промпт, настройки и поиск в кеше."""
     if model_manager is None:
         logger.error("Попытка выполнить /query до инициализации ModelManager.")
         raise HTTPException(status_code=500, detail="Сервер не готов, менеджер моделей не инициализирован.")
+    if request.use_internet and not research.SEARCH_API_URL:
+        raise HTTPException(status_code=400, detail="Поиск в сети не настроен: задайте SEARCH_API_URL.")
 
     # --- Проверка и загрузка модели ---
     try:
-        model_path = model_manager.get_model_path(request.model)
+        with tracing.span("get_model_path", model=request.model):
+            model_path = model_manager.get_model_path(request.model)
         if not model_path or not os.path.exists(model_path):
             logger.warning(f"Модель {request.model} не найдена локально.")
             raise HTTPException(status_code=404, detail=f"Модель {request.model} не установлена.")
 
-        # Проверяем, загружена ли нужная модель
-        if not llm_instance or llm_instance.model_path != model_path:
-            logger.info(f"Требуется загрузка/перезагрузка модели {request.model}...")
-            load_model(request.model)
-        else:
-            logger.info(f"Модель {request.model} уже загружена.")
+        # Проверяем, загружена ли нужная модель (в потоке, чтобы ожидание прогрева не блокировало сервер)
+        with tracing.span("ensure_model_loaded", model=request.model):
+            await run_in_threadpool(load_model_for_turn, request.model, model_path)
+        model_usage_log.record(request.model, model_path)
 
     except HTTPException as http_exc:
         raise http_exc  # Передаем ошибки 404 и 500 от load_model/get_model_path
@@ -432,8 +1258,15 @@ async def process_query(request: QueryRequestBody):
     if not user_text:
         raise HTTPException(status_code=400, detail="Текст запроса не может быть пустым.")
 
+    # Адаптер проверяем до записи в БД: с несуществующим адаптером ход не начнется
+    adapter = request.lora if request.lora is not None else db_get_chat_lora(request.chat_id)
+    adapter = resolve_lora_adapter(model_path, adapter)
+
     try:
-        db_add_message(request.chat_id, 'user', user_text)
+        with tracing.span("db.add_message", sender="user"):
+            db_add_message(request.chat_id, 'user', user_text)
+        with tracing.span("db.set_chat_model"):
+            db_set_chat_model(request.chat_id, request.model)
     except HTTPException as db_exc:
         # Если сохранение в БД не удалось, прерываем запрос
         logger.error(f"Не удалось сохранить сообщение пользователя для чата {request.chat_id}. Запрос прерван.")
@@ -443,91 +1276,499 @@ async def process_query(request: QueryRequestBody):
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера при сохранении запроса.")
 
     # --- Формирование промпта с историей из БД ---
+    # Ограничиваем историю для контекста (например, последние 15 пар сообщений)
+    history_limit_pairs = 15
+    with tracing.span("db.get_messages", chat_id=request.chat_id) as span:
+        messages_from_db = db_get_messages(request.chat_id, limit=history_limit_pairs * 2)
+        span.set_attribute("messages", len(messages_from_db) if messages_from_db is not None else 0)
+    if messages_from_db is None:  # Проверка, что чат существует (db_get_messages вернет None)
+        logger.error(f"Чат {request.chat_id} не найден при попытке сформировать историю.")
+        raise HTTPException(status_code=404, detail=f"Чат с ID {request.chat_id} не найден.")
+
+    relevant_history = messages_from_db[-(history_limit_pairs * 2):]
+
+    history_text_parts = []
+    for msg in relevant_history:
+        # Используем 'User' и 'Assistant' как стандартные роли для промпта
+        sender_prefix = "User" if msg['sender'] == 'user' else "Assistant"
+        history_text_parts.append(f"{sender_prefix}: {msg['content']}")
+
+    # Собираем историю. Последнее сообщение пользователя уже включено.
+    history_text = "\n".join(history_text_parts)
+
+    # Системный промпт можно вынести в настройки или константы
+    system_prompt = """You are NeuraBox, a helpful AI assistant running locally.
+    Answer concisely and factually in the same language as the user's last message.
+    **Format your response using GitHub Flavored Markdown (GFM).**
+    - Use ```python ... ``` for code blocks (replace 'python' with the correct language).
+    - Use `inline_code` for inline code.
+    - Use **bold** and *italic* text for emphasis.
+    - Use lists (`- item` or `1. item`) where appropriate."""
+    prompt = f"{system_prompt}\n\nConversation history:\n{history_text}\n\nAssistant:"
+
+    logger.info(f"Промпт для модели (Chat ID: {request.chat_id}, длина: {len(prompt)}):\n{prompt[:300]}...")
+
+    # Используем настройки из запроса или глобальные
+    max_tokens = request.max_tokens if request.max_tokens is not None else global_model_settings["max_tokens"]
+    temperature = request.temperature if request.temperature is not None else global_model_settings["temperature"]
+    top_p = request.top_p if request.top_p is not None else global_model_settings["top_p"]
+
+    turn = {
+        "model_path": model_path,
+        "user_text": user_text,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        # Ответ deep research зависит от того, что сейчас в сети, — такие ответы не кешируем
+        "use_response_cache": RESPONSE_CACHE_ENABLED and (temperature == 0 or request.use_cache)
+                              and not request.use_internet,
+        "semantic_cache": request.use_cache or response_cache.embedder.semantic,
+        "research": request.use_internet,
+        "sources": None,
+        "deadline": None,  # time.monotonic(), после которого генерация обрывается (бюджет deep research)
+        "first_turn": len(messages_from_db) == 1,  # В истории только что сохраненный вопрос (limit > 1)
+        "lora": adapter,
+        "lora_scale": request.lora_scale,
+        "cached": None,
+    }
+
+    # --- Поиск в кеше ответов ---
+    if turn["use_response_cache"]:
+        cache_scope = ResponseCache.make_scope(
+            get_model_fingerprint(model_path),
+            {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p,
+             "lora": adapter, "lora_scale": request.lora_scale if adapter else None})
+        with tracing.span("tokenize"):
+            prompt_tokens = await run_in_threadpool(tokenize_prompt, request.model, model_path,
+                                                    normalize_prompt(prompt))
+        turn["cache_key"] = ResponseCache.make_key(cache_scope, prompt_tokens)
+        turn["cache_context_key"] = ResponseCache.make_context_key(cache_scope, "\n".join(history_text_parts[:-1]))
+        with tracing.span("response_cache.lookup") as span:
+            turn["cached"] = await run_in_threadpool(response_cache.lookup, turn["cache_key"],
+                                                     turn["cache_context_key"], user_text, turn["semantic_cache"])
+            span.set_attribute("hit", turn["cached"]["tier"] if turn["cached"] else "miss")
+        if turn["cached"]:
+            logger.info(f"Ответ для чата {request.chat_id} взят из кеша ({turn['cached']['tier']}, "
+                        f"близость {turn['cached']['similarity']:.3f}).")
+    return turn
+
+
+def estimate_prompt_tokens(spec: Dict) -> int:
+    """Грубая оценка токенов промпта (~4 символа на токен) — для очереди, до токенизации."""
+    if spec["kind"] == "chat":
+        return sum(len(message.get("content") or "") for message in spec["messages"]) // 4
+    return len(spec["prompt"]) // 4
+
+
+class ModelNotResidentError(RuntimeError):
+    """Модель выгрузили или сменили, пока запрос с resident_only ждал очередь."""
+
+
+def run_model_stream(model_name: str, model_path: str, spec: Dict, cancel_token: CancellationToken,
+                     on_token: Optional[Callable[[str], None]] = None, priority: int = INTERACTIVE,
+                     lease: Optional[ClientLease] = None, resident_only: bool = False) -> Dict:
+    """Общая часть любой генерации: очередь к модели, модель, отмена, статистика (вызывается в потоке из пула).
+
+    spec описывает запрос (см. generation.open_stream): completion или chat completion и параметры.
+    Фоновую генерацию (priority=BACKGROUND) интерактивный запрос может прервать с причиной PREEMPTED.
+    lease — допуск клиента (admit_client): по нему очередь делится между клиентами, токены списываются
+    с его лимита, а слот параллельности освобождается по окончании.
+    resident_only — модель не загружать: если ее уже нет в памяти, ModelNotResidentError.
+    """
     try:
-        messages_from_db = db_get_messages(request.chat_id)
-        if messages_from_db is None:  # Проверка, что чат существует (db_get_messages вернет None)
-            logger.error(f"Чат {request.chat_id} не найден при попытке сформировать историю.")
-            raise HTTPException(status_code=404, detail=f"Чат с ID {request.chat_id} не найден.")
-
-        # Ограничиваем историю для контекста (например, последние 15 пар сообщений)
-        history_limit_pairs = 15
-        relevant_history = messages_from_db[-(history_limit_pairs * 2):]
-
-        history_text_parts = []
-        for msg in relevant_history:
-            # Используем 'User' и 'Assistant' как стандартные роли для промпта
-            sender_prefix = "User" if msg['sender'] == 'user' else "Assistant"
-            history_text_parts.append(f"{sender_prefix}: {msg['content']}")
-
-        # Собираем историю. Последнее сообщение пользователя уже включено.
-        history_text = "\n".join(history_text_parts)
-
-        # Системный промпт можно вынести в настройки или константы
-        system_prompt = """You are NeuraBox, a helpful AI assistant running locally.
-        Answer concisely and factually in the same language as the user's last message.
-        **Format your response using GitHub Flavored Markdown (GFM).**
-        - Use ```python ... ``` for code blocks (replace 'python' with the correct language).
-        - Use `inline_code` for inline code.
-        - Use **bold** and *italic* text for emphasis.
-        - Use lists (`- item` or `1. item`) where appropriate."""
-        prompt = f"{system_prompt}\n\nConversation history:\n{history_text}\n\nAssistant:"
-
-        logger.info(f"Промпт для модели (Chat ID: {request.chat_id}, длина: {len(prompt)}):\n{prompt[:300]}...")
-
-        # Используем настройки из запроса или глобальные
-        max_tokens = request.max_tokens if request.max_tokens is not None else global_model_settings["max_tokens"]
-        temperature = request.temperature if request.temperature is not None else global_model_settings["temperature"]
-        top_p = request.top_p if request.top_p is not None else global_model_settings["top_p"]
-
-        # --- Генерация ответа ---
-        logger.info(f"Параметры генерации: max_tokens={max_tokens}, temp={temperature}, top_p={top_p}")
-        response = llm_instance(
-            prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            echo=False,
-            stop=["\nUser:", "\nAssistant:", "<|endoftext|>"]  # Добавим стандартные стоп-токены
-        )
-
-        model_response = response["choices"][0]["text"].strip()
-        usage = response.get("usage", {})  # usage может отсутствовать
-        tokens_used = usage.get("total_tokens", 0)
-
+        get_model_store().touch(get_model_store().file_name_for(model_path))  # Для вытеснения по LRU
+        resource = generation_resource(model_path)
+        client = lease.client if lease else None
+        # Оценка стоимости по max_tokens: запрос на 8192 токена встает в очередь клиента дальше коротких
+        cost = estimate_prompt_tokens(spec) + spec["params"]["max_tokens"]
+        with tracing.span("generate", model=model_name, kind=spec["kind"]) as span:
+            wait_start_ns = time.time_ns()
+            with generation_scheduler.slot(resource, priority, cancel_token,
+                                           client_id=client.client_id if client else None,
+                                           weight=client.weight if client else 1.0, cost=cost) as ticket:
+                tracing.record_span("queue_wait", wait_start_ns, time.time_ns(), priority=priority)
+                if use_worker_processes():
+                    try:
+                        result = worker_pool.generate(model_path, spec, cancel_token, on_token,
+                                                      start=not resident_only)
+                    except WorkerNotRunningError as e:
+                        raise ModelNotResidentError(str(e))
+                    except WorkerCrashedError as e:
+                        # Монитор пула перезапустит воркер; этот запрос повторять не будем — часть ответа уже ушла
+                        logger.error(f"Воркер модели {model_name} упал во время генерации: {e}")
+                        raise HTTPException(status_code=503,
+                                            detail="Процесс модели упал, он будет перезапущен. Повторите запрос.")
+                else:
+                    with llm_lock:
+                        # Пока запрос ждал очередь, другой мог сменить модель — проверяем еще раз под lock
+                        if resident_only and resident_llm(model_path) is None:
+                            raise ModelNotResidentError(f"Модель {model_name} больше не загружена.")
+                        ensure_model_loaded(model_name, model_path)
+                        result = generate_on_llm(llm_instance, spec, cancel_token, on_token)
+            record_generation_spans(span, result)
+        lora_stats.record(result.get("lora_switch_seconds"))
+        ticket.charge(result["prompt_tokens"] + result["completion_tokens"])
+        if client:
+            client_limiter.charge_tokens(client.client_id, result["prompt_tokens"] + result["completion_tokens"])
+            db_record_client_usage(client.client_id, requests=1, prompt_tokens=result["prompt_tokens"],
+                                   completion_tokens=result["completion_tokens"],
+                                   queue_wait_seconds=ticket.waited, generation_seconds=result["seconds"])
+    finally:
+        if lease:
+            lease.release()
+    result["generation"] = record_generation_stats(model_path, result)
+    max_tokens = spec["params"]["max_tokens"]
+    if result["cancelled"] == PREEMPTED:
+        logger.info(f"Фоновая генерация уступила модель после {result['completion_tokens']} токенов.")
+    elif result["cancelled"]:
+        cancellation_stats.record(result["cancelled"], result["seconds"], result["completion_tokens"], max_tokens)
+        logger.info(f"Генерация прервана ({result['cancelled']}) после {result['completion_tokens']} токенов.")
+    return result
+
+
+def record_generation_spans(span, result: Dict):
+    """Делит генерацию на обработку промпта (до первого токена) и декодирование по замерам generate_on_llm."""
+    if not tracing.enabled():
+        return
+    for key in ("prompt_tokens", "completion_tokens", "finish_reason", "cancelled", "speculative"):
+        span.set_attribute(key, result.get(key))
+    end_ns = time.time_ns()
+    start_ns = end_ns - int(result["seconds"] * 1e9)
+    if result["first_token_seconds"] is None:
+        return
+    first_token_ns = start_ns + int(result["first_token_seconds"] * 1e9)
+    tracing.record_span("prompt_eval", start_ns, first_token_ns, tokens=result["prompt_tokens"])
+    tracing.record_span("decode", first_token_ns, end_ns, tokens=result["completion_tokens"])
+
+
+def plan_research(model_name: str, turn: Dict, cancel_token: CancellationToken) -> List[str]:
+    """План deep research: модель разбивает вопрос на поисковые подзапросы (вызывается в потоке из пула)."""
+    spec = {
+        "kind": "completion",
+        "prompt": research.build_plan_prompt(turn["user_text"]),
+        "params": {"max_tokens": 128, "temperature": 0.2, "top_p": 0.9, "stop": ["\n\n", *DEFAULT_STOP]},
+        "lora": turn["lora"],
+        "lora_scale": turn["lora_scale"],
+    }
+    # Без lease: допуск клиента один на ход и освобождается после ответа, а не после плана
+    result = run_model_stream(model_name, turn["model_path"], spec, cancel_token)
+    return research.parse_plan(result["text"], turn["user_text"])
+
+
+async def research_turn(request: QueryRequestBody, turn: Dict,
+                        on_event: Optional[Callable[[Dict], None]] = None):
+    """Deep research перед ответом: план подзапросов, параллельный поиск и загрузка страниц, отбор фрагментов.
+
+    Найденные фрагменты с номерами источников попадают в промпт хода, а turn["deadline"] ограничивает
+    весь ход бюджетом: план и сбор укладываются в его долю RESEARCH_GATHER_SHARE, ответ модели
+    обрывается с причиной "budget", когда бюджет истек. on_event получает события прогресса для стрима.
+    """
+    budget = request.research_budget_seconds or research.RESEARCH_BUDGET_SECONDS
+    start = time.monotonic()
+    turn["deadline"] = start + budget
+    gather_deadline = start + budget * research.RESEARCH_GATHER_SHARE
+    emit = on_event or (lambda event: None)
+
+    plan_token = CancellationToken()  # Свой токен: истекший бюджет плана не должен отменять ответ
+    timer = threading.Timer(budget * research.RESEARCH_GATHER_SHARE / 2, plan_token.cancel, args=("budget",))
+    timer.start()
+    try:
+        with tracing.span("research.plan"):
+            queries = await run_in_threadpool(plan_research, request.model, turn, plan_token)
+    finally:
+        timer.cancel()
+    logger.info(f"План deep research для чата {request.chat_id}: {queries}")
+    emit({"type": "research", "stage": "plan", "queries": queries})
+
+    with tracing.span("research.gather", queries=len(queries)) as span:
+        async for event in research.gather_sources(turn["user_text"], queries, gather_deadline):
+            if event["type"] == "sources":
+                turn["prompt"] = research.build_synthesis_prompt(turn["prompt"], event["passages"])
+                turn["sources"] = event["sources"]
+                for key, value in event["stats"].items():
+                    span.set_attribute(key, value)
+                event = {"type": "sources", "sources": event["sources"], "stats": event["stats"]}
+            emit(event)
+
+
+def run_generation(model_name: str, turn: Dict, cancel_token: CancellationToken,
+                   on_token: Optional[Callable[[str], None]] = None) -> Dict:
+    """Генерирует ответ на промпт хода диалога."""
+    logger.info(f"Параметры генерации: max_tokens={turn['max_tokens']}, temp={turn['temperature']}, "
+                f"top_p={turn['top_p']}")
+
+    spec = {
+        "kind": "completion",
+        "prompt": turn["prompt"],
+        "params": {
+            "max_tokens": turn["max_tokens"],
+            "temperature": turn["temperature"],
+            "top_p": turn["top_p"],
+            "stop": DEFAULT_STOP,
+        },
+        "lora": turn["lora"],
+        "lora_scale": turn["lora_scale"],
+    }
+    timer = None
+    if turn["deadline"] is not None:
+        timer = threading.Timer(max(0.0, turn["deadline"] - time.monotonic()), cancel_token.cancel, args=("budget",))
+        timer.start()
+    try:
+        return run_model_stream(model_name, turn["model_path"], spec, cancel_token, on_token,
+                                lease=turn.get("lease"))
+    finally:
+        if timer:
+            timer.cancel()
+
+
+def run_background_generation(model_name: str, model_path: str, spec: Dict) -> Optional[str]:
+    """Фоновая completion-генерация, которая переживает вытеснение.
+
+    Если интерактивный запрос забрал модель, продолжаем с места остановки: уже полученный текст
+    дописывается к промпту, а лимит токенов уменьшается. Модель ради фоновой задачи не загружаем —
+    если ее выгрузили (в том числе пока задача ждала очередь), задача просто отменяется (None).
+    """
+    text, remaining = "", spec["params"]["max_tokens"]
+    while remaining > 0:
+        if model_path not in get_resident_model_paths():
+            logger.info(f"Модель {model_name} выгружена, фоновая генерация отменена.")
+            return None
+        part_spec = {**spec, "prompt": spec["prompt"] + text, "params": {**spec["params"], "max_tokens": remaining}}
+        try:
+            result = run_model_stream(model_name, model_path, part_spec, CancellationToken(), priority=BACKGROUND,
+                                      resident_only=True)
+        except ModelNotResidentError:
+            logger.info(f"Модель {model_name} выгружена, пока фоновая генерация ждала очередь; задача отменена.")
+            return None
+        text += result["text"]
+        remaining -= result["completion_tokens"]
+        if result["cancelled"] != PREEMPTED:
+            break
+        generation_scheduler.record_resume()
+    return text
+
+
+def clean_chat_title(text: str) -> str:
+    title = text.strip().splitlines()[0] if text.strip() else ""
+    if title.lower().startswith("title:"):
+        title = title[len("title:"):]
+    return title.strip().strip("\"'«»*#").strip()[:80]
+
+
+def generate_chat_title(chat_id: str, model_name: str, model_path: str, user_text: str, ai_text: str):
+    """Фоновая задача: название чата по первому обмену сообщениями вместо обрезанного вопроса."""
+    prompt = ("Write a short title (at most 6 words) for the conversation below. "
+              "Use the language of the user's message. Reply with the title only.\n\n"
+              f"User: {user_text[:1000]}\nAssistant: {ai_text[:1000]}\n\nTitle:")
+    spec = {
+        "kind": "completion",
+        "prompt": prompt,
+        "params": {"max_tokens": 24, "temperature": 0.2, "top_p": 0.9, "stop": ["\n", *DEFAULT_STOP]},
+    }
+    text = run_background_generation(model_name, model_path, spec)
+    title = clean_chat_title(text or "")
+    # Заглушка — то, что db_add_message поставил из первого сообщения; если ее уже сменили, не трогаем
+    if title and db_replace_chat_title(chat_id, title, user_text[:50]):
+        logger.info(f"Название чата {chat_id} сгенерировано: {title}")
+
+
+def finish_chat_turn(request: QueryRequestBody, turn: Dict, result: Optional[Dict]) -> Dict:
+    """Сохраняет ответ ИИ (полный или частичный) и собирает ответ эндпоинта."""
+    if turn["cached"]:
+        model_response = turn["cached"]["response"]
+        tokens_used = 0
+    else:
+        model_response = result["text"].strip()
+        tokens_used = result["prompt_tokens"] + result["completion_tokens"]
         logger.info(
             f"Ответ модели получен (Chat ID: {request.chat_id}, токены: {tokens_used}):\n{model_response[:300]}...")
-
-        if not model_response:
-            logger.warning(f"Модель вернула пустой ответ для чата {request.chat_id}.")
-            model_response = "(Модель не смогла сгенерировать ответ)"  # Сообщение об ошибке
-
-        # --- Сохранение ответа ИИ ---
+        if turn["use_response_cache"] and model_response and not result["cancelled"]:
+            response_cache.store(turn["cache_key"], turn["cache_context_key"], turn["user_text"], model_response)
+
+    cancelled = result["cancelled"] if result else None
+    if not model_response and not cancelled:
+        logger.warning(f"Модель вернула пустой ответ для чата {request.chat_id}.")
+        model_response = "(Модель не смогла сгенерировать ответ)"  # Сообщение об ошибке
+    if model_response and turn["sources"]:
+        model_response += research.format_sources(turn["sources"])  # Ссылки [n] должны читаться и в истории
+
+    # --- Сохранение ответа ИИ ---
+    # Частичный ответ после отмены тоже сохраняем, пустой — нет
+    if model_response:
         try:
-            db_add_message(request.chat_id, 'ai', model_response)
+            with tracing.span("db.add_message", sender="ai"):
+                db_add_message(request.chat_id, 'ai', model_response)
         except HTTPException as db_exc:
             # Если не удалось сохранить ответ ИИ, логируем, но все равно возвращаем ответ пользователю
             logger.error(f"Не удалось сохранить ответ ИИ для чата {request.chat_id}: {db_exc.detail}")
             # Не прерываем запрос, но можно добавить флаг в ответ, что сохранение не удалось
         except Exception as e:
             logger.exception(f"Неожиданная ошибка сохранения ответа ИИ: {e}")
-
-        return {
-            "response": model_response,
-            "chat_id": request.chat_id,
-            "model": request.model,
-            "tokens_used": tokens_used,
-            "settings_used": {
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": top_p
-            }
+        if LLM_CHAT_TITLES and turn["first_turn"] and not cancelled:
+            background_jobs.submit(f"title:{request.chat_id}", generate_chat_title, request.chat_id, request.model,
+                                   turn["model_path"], turn["user_text"], model_response)
+
+    return {
+        "response": model_response,
+        "chat_id": request.chat_id,
+        "model": request.model,
+        "tokens_used": tokens_used,
+        "cached": turn["cached"]["tier"] if turn["cached"] else None,
+        "cancelled": cancelled,
+        "sources": turn["sources"],
+        "generation": result["generation"] if result else None,
+        "settings_used": {
+            "max_tokens": turn["max_tokens"],
+            "temperature": turn["temperature"],
+            "top_p": turn["top_p"]
         }
+    }
+
+
+def generate_and_finish(request: QueryRequestBody, turn: Dict, cancel_token: CancellationToken,
+                        on_token: Optional[Callable[[str], None]] = None) -> Dict:
+    # Генерация и сохранение идут в одном потоке: даже если клиент ушел и ответ никто не ждет,
+    # частичный текст все равно попадет в БД
+    try:
+        result = run_generation(request.model, turn, cancel_token, on_token)
+        return finish_chat_turn(request, turn, result)
+    finally:
+        unregister_generation(request.chat_id, cancel_token)
+
+
+@router.post("/query")
+async def process_query(request: QueryRequestBody, http_request: Request):
+    logger.info(f"Запрос к /query для chat_id: {request.chat_id}, модель: {request.model}")
+    lease = await admit_client(http_request)  # 401/429 — до записи сообщения в БД
+    try:
+        with tracing.span("query", chat_id=request.chat_id, model=request.model):
+            with tracing.span("prepare_chat_turn"):
+                turn = await prepare_chat_turn(request)
+            turn["lease"] = lease
+            if turn["cached"]:
+                return finish_chat_turn(request, turn, None)
+            if turn["research"]:
+                await research_turn(request, turn)
+
+            cancel_token = register_generation(request.chat_id)
+            watcher = asyncio.create_task(watch_disconnect(http_request, cancel_token))
+            try:
+                return await run_in_threadpool(generate_and_finish, request, turn, cancel_token)
+            finally:
+                watcher.cancel()
 
     except HTTPException as http_exc:
         raise http_exc  # Передаем 404, 500 и другие ошибки дальше
     except Exception as e:
         logger.exception(f"Критическая ошибка обработки /query для чата {request.chat_id}: {e}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера при обработке запроса.")
+    finally:
+        lease.release()  # Обычно уже освобожден в run_model_stream; здесь — для кеша и ошибок
+
+
+@router.post("/query/stream")
+async def process_query_stream(request: QueryRequestBody, http_request: Request):
+    """Как /query, но отдает ответ по токенам в NDJSON: {"type": "token"} ... {"type": "done"}."""
+    logger.info(f"Запрос к /query/stream для chat_id: {request.chat_id}, модель: {request.model}")
+    lease = await admit_client(http_request)
+    # Спан живет до конца стрима, поэтому открываем и закрываем его вручную
+    query_span = tracing.start_span("query_stream", chat_id=request.chat_id, model=request.model)
+    # Ошибки подготовки (нет модели, нет чата) возвращаем обычным HTTP-ответом, до начала стрима
+    try:
+        with tracing.use_span(query_span), tracing.span("prepare_chat_turn"):
+            turn = await prepare_chat_turn(request)
+    except Exception as e:
+        query_span.end(error=e)
+        lease.release()
+        raise
+    turn["lease"] = lease
+
+    async def event_stream():
+        if turn["cached"]:
+            with tracing.use_span(query_span):
+                result = finish_chat_turn(request, turn, None)
+            query_span.end()
+            yield json.dumps({"type": "token", "text": result["response"]}, ensure_ascii=False) + "\n"
+            yield json.dumps({"type": "done", **result}, ensure_ascii=False) + "\n"
+            return
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancel_token = register_generation(request.chat_id)
+        finished = False
+
+        if turn["research"]:
+            # Сбор источников — отдельная задача с контекстом query_span; события идут в тот же поток NDJSON
+            with tracing.use_span(query_span):
+                research_task = asyncio.ensure_future(research_turn(request, turn, queue.put_nowait))
+            research_task.add_done_callback(lambda _: queue.put_nowait(None))
+            try:
+                while (event := await queue.get()) is not None:
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+                research_task.result()
+            except Exception as e:
+                logger.exception(f"Ошибка deep research для чата {request.chat_id}: {e}")
+                unregister_generation(request.chat_id, cancel_token)
+                query_span.end(error=e)
+                detail = e.detail if isinstance(e, HTTPException) else "Внутренняя ошибка сервера при поиске."
+                yield json.dumps({"type": "error", "detail": detail}, ensure_ascii=False) + "\n"
+                return
+            finally:
+                if not research_task.done():  # Клиент ушел во время сбора: загрузки страниц не нужны
+                    research_task.cancel()
+                    unregister_generation(request.chat_id, cancel_token)
+                    query_span.end()
+
+        def on_token(piece: str):
+            loop.call_soon_threadsafe(queue.put_nowait, piece)
+
+        def generate_in_thread() -> Dict:
+            try:
+                return generate_and_finish(request, turn, cancel_token, on_token)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)  # Конец потока токенов
+
+        with tracing.use_span(query_span):  # Задача копирует контекст: спаны генерации станут дочерними
+            generation_task = asyncio.ensure_future(run_in_threadpool(generate_in_thread))
+        try:
+            while (piece := await queue.get()) is not None:
+                yield json.dumps({"type": "token", "text": piece}, ensure_ascii=False) + "\n"
+            try:
+                result = await generation_task
+                if turn["sources"] and result["response"]:
+                    # Список источников дописан к сохраненному ответу — досылаем его и в стрим
+                    yield json.dumps({"type": "token", "text": research.format_sources(turn["sources"])},
+                                     ensure_ascii=False) + "\n"
+                yield json.dumps({"type": "done", **result}, ensure_ascii=False) + "\n"
+            except Exception as e:
+                logger.exception(f"Ошибка потоковой генерации для чата {request.chat_id}: {e}")
+                yield json.dumps({"type": "error", "detail": "Внутренняя ошибка сервера при генерации."},
+                                 ensure_ascii=False) + "\n"
+            finished = True
+        finally:
+            if not finished:
+                # Starlette закрывает генератор, когда клиент отключился: останавливаем модель,
+                # а генерация в потоке сама сохранит то, что успела
+                cancel_token.cancel("disconnect")
+                query_span.set_attribute("disconnected", True)
+            query_span.end()
+
+    # background выполняется и после отключения клиента — слот клиента не утечет, даже если стрим не начался
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson",
+                             background=BackgroundTask(lease.release))
+
+
+@router.post("/chats/{chat_id}/stop")
+async def stop_generation(chat_id: str):
+    """Останавливает текущую генерацию в чате; уже сгенерированная часть сохраняется."""
+    with active_generations_lock:
+        cancel_token = active_generations.get(chat_id)
+    if cancel_token is None:
+        raise HTTPException(status_code=404, detail=f"В чате {chat_id} нет активной генерации.")
+    cancel_token.cancel("stop")
+    logger.info(f"Генерация в чате {chat_id} остановлена пользователем.")
+    return {"message": "Генерация остановлена", "chat_id": chat_id}
 
 
 @router.post("/save_token")
@@ -609,11 +1850,20 @@ class ChatCreateResponse(ChatInfo):  # Ответ при создании сод
 
 
 @router.get("/chats", response_model=List[ChatInfo])
-async def get_all_chats():
-    """Получает метаданные всех чатов, отсортированные по последнему изменению."""
+async def get_all_chats(request: Request):
+    """Получает метаданные всех чатов, отсортированные по последнему изменению.
+
+    Если список не менялся с прошлого запроса клиента (If-None-Match), отвечает 304 без чтения чатов.
+    """
     try:
-        chats_data = db_get_chats()
-        return chats_data  # FastAPI автоматически обработает список словарей в List[ChatInfo]
+        etag = make_etag("chats", *await run_in_threadpool(db_get_chats_version))
+        if etag_matches(request, etag):
+            return json_response(request, None, etag=etag)
+        chats_data = await run_in_threadpool(db_get_chats)
+        # response_model остается для схемы OpenAPI; сами строки из БД не валидируем, только приводим время
+        for chat in chats_data:
+            chat['last_modified_at'] = datetime.datetime.fromisoformat(chat['last_modified_at'])
+        return json_response(request, chats_data, etag=etag)
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
@@ -656,16 +1906,22 @@ async def create_new_chat():
 
 
 @router.get("/chats/{chat_id}/messages", response_model=List[MessageInfo])
-async def get_chat_messages(chat_id: str):
-    """Получает все сообщения для указанного чата."""
+async def get_chat_messages(chat_id: str, request: Request):
+    """Получает все сообщения для указанного чата (304, если история не менялась)."""
     try:
-        messages_data = db_get_messages(chat_id)
-        if messages_data is None:  # Если db_get_messages вернул None, чат не найден
+        version = await run_in_threadpool(db_get_messages_version, chat_id)
+        if version is None:
             raise HTTPException(status_code=404, detail=f"Чат с ID {chat_id} не найден.")
-        # Преобразуем строки времени в datetime объекты для Pydantic
+        etag = make_etag("messages", chat_id, *version)
+        if etag_matches(request, etag):
+            return json_response(request, None, etag=etag)
+        messages_data = await run_in_threadpool(db_get_messages, chat_id)
+        if messages_data is None:  # Чат удалили между запросами версии и сообщений
+            raise HTTPException(status_code=404, detail=f"Чат с ID {chat_id} не найден.")
+        # Время в ISO с "T", как раньше отдавал Pydantic
         for msg in messages_data:
             msg['timestamp'] = datetime.datetime.fromisoformat(msg['timestamp'])
-        return messages_data
+        return json_response(request, messages_data, etag=etag)
     except HTTPException as http_exc:
         raise http_exc  # Передаем 404 дальше
     except Exception as e:
@@ -673,6 +1929,29 @@ async def get_chat_messages(chat_id: str):
         raise HTTPException(status_code=500, detail="Не удалось получить сообщения чата.")
 
 
+class ChatLoraRequestBody(BaseModel):
+    adapter: Optional[str] = None  # None или "" — чистая базовая модель
+
+
+@router.post("/chats/{chat_id}/lora")
+async def set_chat_lora(chat_id: str, request: ChatLoraRequestBody):
+    """Выбирает LoRA-адаптер для всех следующих ходов чата (запрос может переопределить его полем lora)."""
+    adapter = request.adapter or None
+    if adapter and (os.path.basename(adapter) != adapter or adapter.startswith(".")):
+        raise HTTPException(status_code=400, detail=f"Некорректное имя адаптера: {adapter}")
+    if not await run_in_threadpool(db_set_chat_lora, chat_id, adapter):
+        raise HTTPException(status_code=404, detail=f"Чат с ID {chat_id} не найден.")
+    return {"chat_id": chat_id, "lora": adapter}
+
+
+@router.get("/lora_adapters")
+async def list_lora_adapters(model: str):
+    """Адаптеры базовой модели из папки <модель>.lora рядом с ее GGUF."""
+    model_path = await run_in_threadpool(resolve_model_path, model)
+    return {"model": model, "directory": lora.adapters_dir(model_path),
+            "adapters": await run_in_threadpool(lora.list_adapters, model_path)}
+
+
 @router.delete("/chats/{chat_id}", status_code=204)  # 204 No Content - стандартный ответ для успешного DELETE
 async def delete_chat(chat_id: str):
     """Удаляет чат и все связанные с ним сообщения."""
@@ -687,4 +1966,69 @@ async def delete_chat(chat_id: str):
         raise http_exc  # Передаем 404 и 500 от db_delete_chat дальше
     except Exception as e:
         logger.exception(f"Неожиданная ошибка при удалении чата {chat_id}: {e}")
-        raise HTTPException(status_code=500, detail="Не удалось удалить чат.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Не удалось удалить чат.")
+
+
+@router.get("/export")
+async def export_chats(compression: str = "none"):
+    """Потоковый экспорт всех чатов и сообщений в NDJSON (compression: none, gzip или zstd)."""
+    if compression not in chat_transfer.COMPRESSIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"Неизвестное сжатие {compression}. Допустимы: {chat_transfer.COMPRESSIONS}")
+    try:
+        chunks = chat_transfer.iter_export(DATABASE_PATH, compression)
+        first_chunk = await run_in_threadpool(next, chunks, b"")  # Ошибки сжатия/БД — до начала ответа
+    except chat_transfer.TransferError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка экспорта чатов: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка экспорта чатов.")
+
+    def body():
+        yield first_chunk
+        yield from chunks
+
+    file_name = f"neurabox_chats_{datetime.datetime.now():%Y%m%d_%H%M%S}{chat_transfer.export_file_suffix(compression)}"
+    # Длина заранее неизвестна, поэтому ответ уходит chunked-кодированием
+    return StreamingResponse(body(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
+
+@router.post("/import")
+async def import_chats(http_request: Request, import_id: Optional[str] = None):
+    """Потоковый импорт NDJSON-экспорта (сжатие определяется автоматически).
+
+    Если импорт оборвался, отправьте тот же файл с тем же import_id — уже записанные
+    строки будут пропущены. Существующие чаты с тем же chat_id не перезаписываются.
+    """
+    import_id = import_id or str(uuid.uuid4())
+    try:
+        importer = await run_in_threadpool(chat_transfer.ChatImporter, DATABASE_PATH, import_id)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка подготовки импорта {import_id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка подготовки импорта.")
+    try:
+        async for data in http_request.stream():
+            if data:
+                await run_in_threadpool(importer.feed, data)
+        summary = await run_in_threadpool(importer.finish)
+        logger.info(f"Импорт {import_id} завершен: {summary}")
+        return summary
+    except chat_transfer.TransferError as e:
+        raise HTTPException(status_code=400, detail={"message": str(e), **importer.summary()})
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка импорта {import_id}: {e}")
+        raise HTTPException(status_code=500, detail={"message": "Ошибка записи в БД при импорте.",
+                                                     **importer.summary()})
+    finally:
+        importer.close()
+        chat_cache.clear()  # Импорт пишет в БД мимо db_* хелперов
+        note_chat_list_change()  # Импорт пишет чаты со старыми last_modified_at
+
+
+@router.get("/import/{import_id}")
+async def get_import_status(import_id: str):
+    status = await run_in_threadpool(chat_transfer.checkpoint_status, DATABASE_PATH, import_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Импорт {import_id} не найден.")
+    return status
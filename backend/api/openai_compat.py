@@ -0,0 +1,235 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Union
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from llama_cpp import Llama
+from pydantic import BaseModel, Field
+
+from backend.api import api as core
+from backend import embeddings, quant_selection
+from backend.generation import CancellationToken
+from backend.scheduler import INTERACTIVE
+from backend.model_manager import get_model_store
+
+logger = logging.getLogger(__name__)
+
+# OpenAI-совместимые эндпоинты (/v1): без chat_id и без записи в историю чатов,
+# чтобы внутренние инструменты могли гонять бэкенд пачками
+router = APIRouter()
+
+embedding_instance: Optional[Llama] = None
+# Модель для эмбеддингов создается с embedding=True и живет отдельно от llm_instance
+embedding_lock = threading.Lock()
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatCompletionRequestBody(BaseModel):
+    model: str
+    messages: List[ChatMessage]
+    max_tokens: Optional[int] = Field(default=None, ge=1, le=8192)
+    temperature: Optional[float] = Field(default=None, ge=0.0, le=2.0)
+    top_p: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    stop: Optional[Union[str, List[str]]] = None
+    stream: bool = False
+    lora: Optional[str] = None  # Расширение: LoRA-адаптер базовой модели (см. GET /api/lora_adapters)
+    lora_scale: float = Field(default=1.0, ge=0.0, le=4.0)
+
+
+class EmbeddingRequestBody(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+
+
+def get_embedding_model(model_path: str) -> Llama:
+    """Загружает (или переиспользует) модель в режиме эмбеддингов. Вызывать под embedding_lock.
+
+    В процессе API модель одна на все запросы (ресурс "inprocess" очереди): если второй экземпляр
+    не влезает в память рядом с моделью генерации, освобождаем ее — следующий ход загрузит ее снова.
+    """
+    global embedding_instance
+    if embedding_instance is None or embedding_instance.model_path != model_path:
+        if embedding_instance is not None:
+            del embedding_instance
+            embedding_instance = None
+        if not embeddings.fits_in_memory(model_path):
+            core.unload_in_process_model()
+        embedding_instance = embeddings.create_embedding_llama(model_path, core.get_llama_kwargs(model_path))
+    return embedding_instance
+
+
+def compute_embeddings(model_path: str, inputs: List[str]) -> Dict:
+    if core.use_worker_processes():
+        # Второй экземпляр живет в воркере модели и выгружается вместе с ним
+        return core.worker_pool.embed(model_path, inputs)
+    with embedding_lock:
+        return embeddings.embed_on_llm(get_embedding_model(model_path), inputs)
+
+
+def run_embeddings(model_path: str, inputs: List[str], lease) -> Dict:
+    """Эмбеддинги в очереди generation_scheduler наравне с генерацией (вызывается в потоке из пула)."""
+    try:
+        get_model_store().touch(get_model_store().file_name_for(model_path))
+        client = lease.client
+        with core.generation_scheduler.slot(core.generation_resource(model_path), INTERACTIVE,
+                                            client_id=client.client_id, weight=client.weight,
+                                            cost=sum(len(text) for text in inputs) // 4) as ticket:
+            result = compute_embeddings(model_path, inputs)
+        ticket.charge(result["total_tokens"])
+        core.client_limiter.charge_tokens(client.client_id, result["total_tokens"])
+        core.db_record_client_usage(client.client_id, requests=1, prompt_tokens=result["total_tokens"],
+                                    queue_wait_seconds=ticket.waited)
+        return result
+    finally:
+        lease.release()
+
+
+def completion_settings(request: ChatCompletionRequestBody) -> Dict:
+    return {
+        "max_tokens": request.max_tokens or core.global_model_settings["max_tokens"],
+        "temperature": request.temperature if request.temperature is not None
+        else core.global_model_settings["temperature"],
+        "top_p": request.top_p if request.top_p is not None else core.global_model_settings["top_p"],
+    }
+
+
+def run_chat_completion(request: ChatCompletionRequestBody, model_path: str, cancel_token: CancellationToken,
+                        on_token=None, lease=None) -> Dict:
+    # Шаблон чата берется из метаданных GGUF, как и ожидают OpenAI-клиенты
+    spec = {
+        "kind": "chat",
+        "messages": [m.dict() for m in request.messages],
+        "params": {**completion_settings(request), "stop": request.stop},
+        "lora": request.lora or None,
+        "lora_scale": request.lora_scale,
+    }
+    return core.run_model_stream(request.model, model_path, spec, cancel_token, on_token=on_token, lease=lease)
+
+
+def build_chunk(completion_id: str, created: int, model: str, delta: Dict, finish_reason: Optional[str]) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+@router.get("/models")
+async def list_models():
+    # Тот же учет файлов, что у каталога: модели в подпапках тоже видны, а вторые части split-GGUF — нет
+    files = [f for f in get_model_store().installed_files() if not quant_selection.is_secondary_shard(f)]
+    return {
+        "object": "list",
+        "data": [{"id": f, "object": "model", "owned_by": "local"} for f in files],
+    }
+
+
+@router.post("/chat/completions")
+async def chat_completions(request: ChatCompletionRequestBody, http_request: Request):
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="messages не может быть пустым.")
+    model_path = await run_in_threadpool(core.resolve_model_path, request.model)
+    core.resolve_lora_adapter(model_path, request.lora)
+    lease = await core.admit_client(http_request)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    cancel_token = CancellationToken()
+
+    if not request.stream:
+        watcher = asyncio.create_task(core.watch_disconnect(http_request, cancel_token))
+        try:
+            result = await run_in_threadpool(run_chat_completion, request, model_path, cancel_token, None, lease)
+        finally:
+            watcher.cancel()
+            lease.release()
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": request.model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": result["text"]},
+                "finish_reason": result["finish_reason"],
+            }],
+            "usage": {
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "total_tokens": result["prompt_tokens"] + result["completion_tokens"],
+            },
+        }
+
+    async def event_stream():
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = False
+
+        def on_token(piece: str):
+            loop.call_soon_threadsafe(queue.put_nowait, piece)
+
+        def generate_in_thread() -> Dict:
+            try:
+                return run_chat_completion(request, model_path, cancel_token, on_token, lease)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        generation_task = asyncio.ensure_future(run_in_threadpool(generate_in_thread))
+        try:
+            yield build_chunk(completion_id, created, request.model, {"role": "assistant"}, None)
+            while (piece := await queue.get()) is not None:
+                yield build_chunk(completion_id, created, request.model, {"content": piece}, None)
+            try:
+                result = await generation_task
+                yield build_chunk(completion_id, created, request.model, {}, result["finish_reason"])
+            except Exception as e:
+                logger.exception(f"Ошибка потоковой генерации /v1/chat/completions: {e}")
+                yield f"data: {json.dumps({'error': {'message': 'Ошибка генерации.'}}, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            finished = True
+        finally:
+            if not finished:
+                cancel_token.cancel("disconnect")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", background=BackgroundTask(lease.release))
+
+
+@router.post("/embeddings")
+async def create_embeddings(request: EmbeddingRequestBody, http_request: Request):
+    inputs = [request.input] if isinstance(request.input, str) else request.input
+    if not inputs:
+        raise HTTPException(status_code=400, detail="input не может быть пустым.")
+    model_path = await run_in_threadpool(core.resolve_model_path, request.model)
+    lease = await core.admit_client(http_request)
+    try:
+        result = await run_in_threadpool(run_embeddings, model_path, inputs, lease)
+    except embeddings.EmbeddingError as e:
+        logger.warning(f"Запрос эмбеддингов ({request.model}) отклонен: {e}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail())
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Ошибка вычисления эмбеддингов ({request.model}): {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка вычисления эмбеддингов: {e}")
+    return {
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": embedding}
+            for i, embedding in enumerate(result["embeddings"])
+        ],
+        "usage": {"prompt_tokens": result["total_tokens"], "total_tokens": result["total_tokens"]},
+    }
@@ -0,0 +1,134 @@
+"""Замер сериализации, сжатия и условных GET для больших ответов /chats/{id}/messages.
+
+Запуск:
+    python -m backend.bench.api_payloads --messages 200 2000 20000 --message-bytes 1500
+
+Для чата из N сообщений во временной базе сравнивает прежний путь ответа (валидация
+List[MessageInfo] через Pydantic + jsonable_encoder + json.dumps, как в JSONResponse)
+с json_responses.dumps, печатает размер тела без сжатия, с gzip и brotli (если установлен),
+а также время чтения всей истории против запроса версии для ETag (путь ответа 304).
+"""
+import os
+import json
+import time
+import gzip
+import random
+import string
+import sqlite3
+import argparse
+import datetime
+import tempfile
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, TypeAdapter
+
+from backend import json_responses
+from backend.bench.export_import import SCHEMA
+
+
+class MessageInfo(BaseModel):  # Та же схема, что api.MessageInfo (api импортировать дорого: грузит llama_cpp)
+    message_id: int
+    sender: str
+    content: str
+    timestamp: datetime.datetime
+
+
+def best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 3)
+
+
+def fill_chat(conn: sqlite3.Connection, chat_id: str, count: int, message_bytes: int):
+    alphabet = string.ascii_letters + " " * 10 + "абвгдеёжзийклмнопрстуфхцчшщэюя"
+    texts = ["".join(random.choices(alphabet, k=message_bytes)) for _ in range(64)]
+    conn.execute("INSERT INTO chats (chat_id, title) VALUES (?, ?)", (chat_id, chat_id))
+    conn.executemany("INSERT INTO messages (chat_id, sender, content) VALUES (?, ?, ?)",
+                     [(chat_id, "user" if i % 2 == 0 else "ai", random.choice(texts)) for i in range(count)])
+    conn.commit()
+
+
+def read_messages(db_path: str, chat_id: str) -> List[dict]:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute(
+            "SELECT message_id, sender, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp ASC",
+            (chat_id,))]
+    finally:
+        conn.close()
+
+
+def read_version(db_path: str, chat_id: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(
+            """SELECT last_modified_at, (SELECT MAX(message_id) FROM messages WHERE chat_id = ?)
+               FROM chats WHERE chat_id = ?""", (chat_id, chat_id)).fetchone()
+    finally:
+        conn.close()
+
+
+def measure(db_path: str, chat_id: str, repeat: int) -> dict:
+    rows = read_messages(db_path, chat_id)
+    adapter = TypeAdapter(List[MessageInfo])
+
+    def before() -> bytes:
+        validated = adapter.validate_python([dict(row) for row in rows])
+        return json.dumps(jsonable_encoder(validated), ensure_ascii=False, allow_nan=False,
+                          separators=(",", ":")).encode("utf-8")
+
+    def after() -> bytes:
+        messages = [dict(row) for row in rows]
+        for msg in messages:
+            msg["timestamp"] = datetime.datetime.fromisoformat(msg["timestamp"])
+        return json_responses.dumps(messages)
+
+    body = after()
+    assert json.loads(body) == json.loads(before()), "Новый путь должен отдавать тот же JSON"
+    result = {
+        "messages": len(rows),
+        "serialize_ms": {"before": best_of(before, repeat), "after": best_of(after, repeat),
+                         "encoder": "orjson" if json_responses.orjson is not None else "json"},
+        "bytes": {"raw": len(body),
+                  "gzip": len(gzip.compress(body, compresslevel=json_responses.GZIP_LEVEL))},
+        "compress_ms": {"gzip": best_of(lambda: gzip.compress(body, compresslevel=json_responses.GZIP_LEVEL),
+                                        repeat)},
+        "read_ms": {"full_history": best_of(lambda: read_messages(db_path, chat_id), repeat),
+                    "etag_version": best_of(lambda: read_version(db_path, chat_id), repeat)},
+    }
+    if json_responses.brotli is not None:
+        brotli = json_responses.brotli
+        result["bytes"]["br"] = len(brotli.compress(body, quality=json_responses.BROTLI_QUALITY))
+        result["compress_ms"]["br"] = best_of(lambda: brotli.compress(body, quality=json_responses.BROTLI_QUALITY),
+                                              repeat)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[200, 2000, 20000],
+                        help="Размеры чатов (число сообщений)")
+    parser.add_argument("--message-bytes", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=5, help="Берется лучшее время из стольких повторов")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="neurabox_bench_"), "chats.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id);")
+    report = []
+    for count in args.messages:
+        chat_id = f"bench-{count}"
+        fill_chat(conn, chat_id, count, args.message_bytes)
+        report.append(measure(db_path, chat_id, args.repeat))
+    conn.close()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Сравнение пакетного вычисления эмбеддингов с поэлементным.
+
+Запуск:
+    python -m backend.bench.embeddings_batch --model path/to/model.gguf --count 64
+
+Считает одни и те же входы двумя способами — одним вызовом embed() на весь массив
+(так работает /v1/embeddings) и отдельным вызовом на каждый вход — и печатает JSON
+со временем и пропускной способностью.
+"""
+import argparse
+import json
+import time
+
+import llama_cpp
+from llama_cpp import Llama
+
+SAMPLE_TEXTS = [
+    "How do I install a model in NeuraBox?",
+    "Local inference keeps your data on your own machine.",
+    "The quick brown fox jumps over the lazy dog.",
+    "Quantized GGUF files trade a little quality for a lot of memory.",
+    "Speculative decoding drafts several tokens and verifies them in one batch.",
+    "SQLite stores chats and messages in a single file.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", required=True, help="Путь к GGUF-файлу")
+    parser.add_argument("--count", type=int, default=64, help="Сколько входов считать")
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    args = parser.parse_args()
+
+    inputs = [f"{SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]} #{i}" for i in range(args.count)]
+    llm = Llama(
+        model_path=args.model,
+        embedding=True,
+        pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+        n_ctx=args.n_ctx,
+        n_batch=args.n_ctx,
+        n_ubatch=args.n_ctx,
+        verbose=False,
+    )
+    llm.embed(inputs[:2])  # Прогрев, чтобы первый замер не платил за холодные веса
+
+    start = time.perf_counter()
+    llm.embed(inputs, normalize=True)
+    batched_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for text in inputs:
+        llm.embed(text, normalize=True)
+    single_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        "inputs": len(inputs),
+        "batched_seconds": round(batched_seconds, 4),
+        "per_item_seconds": round(single_seconds, 4),
+        "batched_inputs_per_second": round(len(inputs) / batched_seconds, 2),
+        "per_item_inputs_per_second": round(len(inputs) / single_seconds, 2),
+        "speedup": round(single_seconds / batched_seconds, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Замер потокового экспорта/импорта чатов на большой синтетической базе.
+
+Запуск:
+    python -m backend.bench.export_import --size-gb 2 --compression zstd
+    python -m backend.bench.export_import --db path/to/neurabox_chats.db --skip-generate
+
+Создает базу нужного размера (та же схема, что в api.init_db), экспортирует ее в файл
+через chat_transfer.iter_export, импортирует в пустую базу через ChatImporter и печатает
+JSON со временем, пропускной способностью и пиковым RSS каждой фазы. Пиковый RSS
+не должен расти вместе с размером базы.
+"""
+import os
+import json
+import time
+import random
+import string
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+
+from backend import chat_transfer
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chats (
+        chat_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        model_used TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_modified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        sender TEXT NOT NULL CHECK(sender IN ('user', 'ai')),
+        content TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (chat_id) REFERENCES chats (chat_id) ON DELETE CASCADE
+    );
+    CREATE TRIGGER IF NOT EXISTS update_chat_modtime
+    AFTER INSERT ON messages
+    FOR EACH ROW
+    BEGIN
+        UPDATE chats SET last_modified_at = CURRENT_TIMESTAMP WHERE chat_id = NEW.chat_id;
+    END;
+"""
+READ_CHUNK_SIZE = 256 * 1024
+
+
+def current_rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+@contextlib.contextmanager
+def track_peak_rss(result: dict):
+    """Опрашивает RSS в фоне и кладет пик фазы в result["peak_rss_mb"]."""
+    stop = threading.Event()
+    peak = [current_rss_bytes()]
+
+    def sample():
+        while not stop.wait(0.05):
+            peak[0] = max(peak[0], current_rss_bytes())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        result["peak_rss_mb"] = round(max(peak[0], current_rss_bytes()) / 1024 ** 2, 1)
+
+
+def generate_database(path: str, size_gb: float, messages_per_chat: int, message_bytes: int) -> dict:
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    alphabet = string.ascii_letters + " " * 10 + "абвгдеёжзийклмнопрстуфхцчшщэюя"
+    # Пул случайных текстов, чтобы генерация не упиралась в random
+    texts = ["".join(random.choices(alphabet, k=message_bytes)) for _ in range(256)]
+    target_bytes = int(size_gb * 1024 ** 3)
+    chats = messages = 0
+    start = time.perf_counter()
+    while os.path.getsize(path) < target_bytes:
+        chat_rows, message_rows = [], []
+        for _ in range(100):
+            chat_id = f"bench-{chats:09d}"
+            chat_rows.append((chat_id, f"Bench chat {chats}", "bench.gguf"))
+            for i in range(messages_per_chat):
+                message_rows.append((chat_id, "user" if i % 2 == 0 else "ai", random.choice(texts)))
+            chats += 1
+        conn.executemany("INSERT INTO chats (chat_id, title, model_used) VALUES (?, ?, ?)", chat_rows)
+        conn.executemany("INSERT INTO messages (chat_id, sender, content) VALUES (?, ?, ?)", message_rows)
+        conn.commit()
+        messages += len(message_rows)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    conn.close()
+    return {"chats": chats, "messages": messages, "db_mb": round(os.path.getsize(path) / 1024 ** 2, 1),
+            "seconds": round(time.perf_counter() - start, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="Путь к базе (по умолчанию — во временной папке)")
+    parser.add_argument("--skip-generate", action="store_true", help="Не генерировать, взять существующую --db")
+    parser.add_argument("--size-gb", type=float, default=1.0)
+    parser.add_argument("--messages-per-chat", type=int, default=40)
+    parser.add_argument("--message-bytes", type=int, default=1500)
+    parser.add_argument("--compression", choices=chat_transfer.COMPRESSIONS, default="none")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="neurabox_bench_")
+    source_db = args.db or os.path.join(workdir, "source.db")
+    export_path = os.path.join(workdir, "export" + chat_transfer.export_file_suffix(args.compression))
+    target_db = os.path.join(workdir, "target.db")
+    report = {"workdir": workdir, "compression": args.compression}
+
+    if not args.skip_generate:
+        report["generate"] = generate_database(source_db, args.size_gb, args.messages_per_chat, args.message_bytes)
+
+    phase = {}
+    with track_peak_rss(phase):
+        start = time.perf_counter()
+        with open(export_path, "wb") as f:
+            for chunk in chat_transfer.iter_export(source_db, args.compression):
+                f.write(chunk)
+        phase["seconds"] = round(time.perf_counter() - start, 2)
+    phase["file_mb"] = round(os.path.getsize(export_path) / 1024 ** 2, 1)
+    phase["source_mb_per_second"] = round(os.path.getsize(source_db) / 1024 ** 2 / phase["seconds"], 1)
+    report["export"] = phase
+
+    conn = sqlite3.connect(target_db)
+    conn.executescript(SCHEMA)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.close()
+    phase = {}
+    with track_peak_rss(phase):
+        importer = chat_transfer.ChatImporter(target_db, "bench")
+        try:
+            with open(export_path, "rb") as f:
+                while data := f.read(READ_CHUNK_SIZE):
+                    importer.feed(data)
+            summary = importer.finish()
+        finally:
+            importer.close()
+    phase.update(summary)
+    phase["rows_per_second"] = round((summary["chats"] + summary["messages"]) / summary["seconds"], 1)
+    report["import"] = phase
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Нагрузочный тест API чатов: N виртуальных пользователей и отчет по SLO.
+
+Запуск (бэкенд уже работает, модель установлена — для замера подойдет крошечная CPU-модель):
+    python -m backend.bench.loadtest --model qwen2.5-0.5b-instruct-q4_k_m.gguf --users 8 --duration 120
+    python -m backend.bench.loadtest --model tiny.gguf --users 4 --turns 5 --think-time 2 --html report.html
+
+Каждый виртуальный пользователь создает чат (POST /chats), затем в цикле «думает»
+(экспоненциальная пауза со средним --think-time), отправляет ход через /query или
+/query/stream (доля стрима — --stream-ratio) и иногда открывает историю
+(GET /chats/{id}/messages). В конце печатается JSON с p50/p95/p99 задержек по
+эндпоинтам, временем до первого токена, пропускной способностью и долей ошибок;
+--json/--html сохраняют отчет в файл. Код выхода 1, если SLO не выполнены.
+"""
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import html
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+PROMPTS = [
+    "Explain what a GGUF file is in two sentences.",
+    "Write a haiku about local inference.",
+    "What is the capital of France?",
+    "Give me three tips for writing readable Python.",
+    "Summarize the benefits of quantization.",
+    "Как работает кеш KV в трансформерах? Кратко.",
+]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Перцентиль по методу ближайшего ранга; None для пустой выборки."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: List[Dict] = []  # {"endpoint", "start", "latency", "ok", "status", "ttft", "tokens"}
+        self.started = time.perf_counter()
+
+    def add(self, endpoint: str, start: float, ok: bool, status: Optional[int] = None,
+            ttft: Optional[float] = None, tokens: int = 0, error: Optional[str] = None):
+        self.samples.append({
+            "endpoint": endpoint,
+            "start": start - self.started,
+            "latency": time.perf_counter() - start,
+            "ok": ok,
+            "status": status,
+            "ttft": ttft,
+            "tokens": tokens,
+            "error": error,
+        })
+
+
+async def timed_json(session: aiohttp.ClientSession, recorder: Recorder, endpoint: str, method: str, url: str,
+                     **kwargs) -> Optional[Dict]:
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            body = await resp.read()
+            ok = resp.status < 400
+            recorder.add(endpoint, start, ok, resp.status, error=None if ok else body[:200].decode(errors="replace"))
+            return json.loads(body) if ok and body else None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        recorder.add(endpoint, start, False, error=type(e).__name__)
+        return None
+
+
+async def stream_turn(session: aiohttp.ClientSession, recorder: Recorder, url: str, payload: Dict):
+    start = time.perf_counter()
+    ttft = None
+    tokens = 0
+    try:
+        async with session.post(url, json=payload) as resp:
+            if resp.status >= 400:
+                body = await resp.read()
+                recorder.add("query_stream", start, False, resp.status, error=body[:200].decode(errors="replace"))
+                return
+            done = False
+            async for line in resp.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event["type"] == "token":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    tokens += 1
+                elif event["type"] == "done":
+                    done = True
+                elif event["type"] == "error":
+                    recorder.add("query_stream", start, False, resp.status, ttft, tokens, event.get("detail"))
+                    return
+            recorder.add("query_stream", start, done, resp.status, ttft, tokens,
+                         None if done else "stream ended without done")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        recorder.add("query_stream", start, False, ttft=ttft, tokens=tokens, error=type(e).__name__)
+
+
+async def virtual_user(args, session: aiohttp.ClientSession, recorder: Recorder, deadline: float):
+    api = args.url.rstrip("/") + "/api"
+    await asyncio.sleep(random.uniform(0, args.ramp_up))  # Плавный разгон, а не все пользователи разом
+    chat = await timed_json(session, recorder, "create_chat", "POST", f"{api}/chats")
+    if not chat:
+        return None
+    chat_id = chat["chat_id"]
+    turns = 0
+    while time.perf_counter() < deadline and (args.turns is None or turns < args.turns):
+        if args.think_time > 0:
+            await asyncio.sleep(random.expovariate(1 / args.think_time))
+        if time.perf_counter() >= deadline:
+            break
+        payload = {"chat_id": chat_id, "model": args.model, "text": random.choice(PROMPTS),
+                   "max_tokens": args.max_tokens, "temperature": args.temperature}
+        if random.random() < args.stream_ratio:
+            await stream_turn(session, recorder, f"{api}/query/stream", payload)
+        else:
+            await timed_json(session, recorder, "query", "POST", f"{api}/query", json=payload)
+        turns += 1
+        if random.random() < args.browse_ratio:
+            await timed_json(session, recorder, "messages", "GET", f"{api}/chats/{chat_id}/messages")
+    return chat_id
+
+
+def summarize(recorder: Recorder, wall_seconds: float, args) -> Dict:
+    endpoints = {}
+    for name in sorted({s["endpoint"] for s in recorder.samples}):
+        samples = [s for s in recorder.samples if s["endpoint"] == name]
+        latencies = [s["latency"] for s in samples if s["ok"]]
+        errors = [s for s in samples if not s["ok"]]
+        error_kinds: Dict[str, int] = {}
+        for s in errors:
+            key = str(s["status"] or s["error"])
+            error_kinds[key] = error_kinds.get(key, 0) + 1
+        endpoints[name] = {
+            "requests": len(samples),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(samples), 4) if samples else 0.0,
+            "error_kinds": error_kinds,
+            "throughput_rps": round(len(samples) / wall_seconds, 3),
+            **{f"p{p}": _round(percentile(latencies, p)) for p in (50, 95, 99)},
+            "mean": _round(sum(latencies) / len(latencies)) if latencies else None,
+            "max": _round(max(latencies)) if latencies else None,
+        }
+    stream = [s for s in recorder.samples if s["endpoint"] == "query_stream" and s["ok"]]
+    ttfts = [s["ttft"] for s in stream if s["ttft"] is not None]
+    turns = [s for s in recorder.samples if s["endpoint"] in ("query", "query_stream")]
+    all_errors = sum(1 for s in recorder.samples if not s["ok"])
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "html")},
+        "wall_seconds": round(wall_seconds, 2),
+        "total_requests": len(recorder.samples),
+        "error_rate": round(all_errors / len(recorder.samples), 4) if recorder.samples else 0.0,
+        "turns_per_second": round(sum(1 for s in turns if s["ok"]) / wall_seconds, 3),
+        "ttft": {f"p{p}": _round(percentile(ttfts, p)) for p in (50, 95, 99)},
+        # Токены считаются по событиям стрима (≈ один токен на событие)
+        "stream_tokens_per_second": round(sum(s["tokens"] for s in stream) / wall_seconds, 2),
+        "endpoints": endpoints,
+    }
+    report["slo"] = check_slo(report, args)
+    return report
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def check_slo(report: Dict, args) -> Dict:
+    turn_p95 = max((report["endpoints"].get(name, {}).get("p95") or 0) for name in ("query", "query_stream"))
+    checks = {
+        "turn_latency_p95": {"value": turn_p95, "limit": args.slo_p95_latency},
+        "ttft_p95": {"value": report["ttft"]["p95"], "limit": args.slo_p95_ttft},
+        "error_rate": {"value": report["error_rate"], "limit": args.slo_error_rate},
+    }
+    for check in checks.values():
+        check["passed"] = check["value"] is None or check["limit"] is None or check["value"] <= check["limit"]
+    return {"checks": checks, "passed": all(c["passed"] for c in checks.values())}
+
+
+def render_html(report: Dict, recorder: Recorder) -> str:
+    rows = "".join(
+        f"<tr><td>{html.escape(name)}</td><td>{e['requests']}</td><td>{e['errors']}</td>"
+        f"<td>{e['error_rate']:.2%}</td><td>{e['throughput_rps']}</td><td>{e['p50']}</td><td>{e['p95']}</td>"
+        f"<td>{e['p99']}</td><td>{e['max']}</td></tr>"
+        for name, e in report["endpoints"].items())
+    slo_rows = "".join(
+        f"<tr class=\"{'ok' if c['passed'] else 'fail'}\"><td>{name}</td><td>{c['value']}</td><td>{c['limit']}</td>"
+        f"<td>{'OK' if c['passed'] else 'FAIL'}</td></tr>"
+        for name, c in report["slo"]["checks"].items())
+    # Точечный график: задержка хода от времени старта — видно, где начинается деградация
+    turns = [s for s in recorder.samples if s["endpoint"] in ("query", "query_stream")]
+    width, height = 800, 240
+    max_x = max((s["start"] for s in turns), default=1) or 1
+    max_y = max((s["latency"] for s in turns), default=1) or 1
+    points = "".join(
+        f"<circle cx=\"{40 + s['start'] / max_x * (width - 50):.1f}\" cy=\"{height - 20 - s['latency'] / max_y * (height - 30):.1f}\" "
+        f"r=\"2.5\" fill=\"{'#2b7' if s['ok'] else '#d33'}\"/>"
+        for s in turns)
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>NeuraBox load test</title>
+<style>
+body {{ font-family: sans-serif; margin: 24px; }}
+table {{ border-collapse: collapse; margin-bottom: 24px; }}
+td, th {{ border: 1px solid #ccc; padding: 4px 10px; text-align: right; }}
+td:first-child {{ text-align: left; }}
+.ok td:last-child {{ color: #2b7; }} .fail td:last-child {{ color: #d33; font-weight: bold; }}
+</style></head><body>
+<h1>NeuraBox load test</h1>
+<p>Пользователей: {report['config']['users']}, длительность: {report['wall_seconds']} c,
+ходов/с: {report['turns_per_second']}, токенов/с (стрим): {report['stream_tokens_per_second']},
+доля ошибок: {report['error_rate']:.2%}</p>
+<h2>SLO: {'выполнены' if report['slo']['passed'] else 'НЕ выполнены'}</h2>
+<table><tr><th>Проверка</th><th>Значение</th><th>Предел</th><th></th></tr>{slo_rows}</table>
+<h2>Эндпоинты (секунды)</h2>
+<table><tr><th>Эндпоинт</th><th>Запросов</th><th>Ошибок</th><th>Доля ошибок</th><th>RPS</th>
+<th>p50</th><th>p95</th><th>p99</th><th>max</th></tr>{rows}</table>
+<h2>Время до первого токена (секунды)</h2>
+<p>p50: {report['ttft']['p50']}, p95: {report['ttft']['p95']}, p99: {report['ttft']['p99']}</p>
+<h2>Задержка хода во времени</h2>
+<svg width="{width}" height="{height}" style="border:1px solid #ccc">
+<text x="4" y="14" font-size="11">{max_y:.1f} c</text><text x="{width - 60}" y="{height - 4}" font-size="11">{max_x:.0f} c</text>
+{points}</svg>
+</body></html>"""
+
+
+async def run(args) -> Tuple[Dict, Recorder]:
+    recorder = Recorder()
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    connector = aiohttp.TCPConnector(limit=0)  # Каждый виртуальный пользователь — свое соединение
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        api = args.url.rstrip("/") + "/api"
+        # /query требует инициализированного менеджера моделей — как и фронтенд, сначала запрашиваем каталог
+        await timed_json(session, recorder, "models", "GET", f"{api}/models")
+        deadline = time.perf_counter() + args.duration
+        started = time.perf_counter()
+        chat_ids = await asyncio.gather(*(virtual_user(args, session, recorder, deadline)
+                                          for _ in range(args.users)))
+        wall_seconds = time.perf_counter() - started
+        if not args.keep_chats:
+            for chat_id in filter(None, chat_ids):
+                async with session.delete(f"{api}/chats/{chat_id}"):
+                    pass
+    return summarize(recorder, wall_seconds, args), recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:9015")
+    parser.add_argument("--model", required=True, help="Имя установленной модели (как в /api/models)")
+    parser.add_argument("--users", type=int, default=4, help="Число виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=60, help="Длительность теста, секунды")
+    parser.add_argument("--turns", type=int, help="Ходов на пользователя (по умолчанию — до конца --duration)")
+    parser.add_argument("--think-time", type=float, default=3.0, help="Средняя пауза между ходами, секунды")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="За сколько секунд подключаются все пользователи")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="Доля ходов через /query/stream")
+    parser.add_argument("--browse-ratio", type=float, default=0.3, help="Вероятность открыть историю после хода")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--request-timeout", type=float, default=600)
+    parser.add_argument("--slo-p95-latency", type=float, default=10.0, help="Предел p95 задержки хода, секунды")
+    parser.add_argument("--slo-p95-ttft", type=float, default=2.0, help="Предел p95 времени до первого токена")
+    parser.add_argument("--slo-error-rate", type=float, default=0.01, help="Предел доли ошибок")
+    parser.add_argument("--keep-chats", action="store_true", help="Не удалять созданные чаты после теста")
+    parser.add_argument("--json", help="Сохранить отчет в JSON-файл")
+    parser.add_argument("--html", help="Сохранить отчет в HTML-файл")
+    args = parser.parse_args()
+
+    report, recorder = asyncio.run(run(args))
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(output)
+    if args.html:
+        with open(args.html, "w", encoding="utf-8") as f:
+            f.write(render_html(report, recorder))
+    raise SystemExit(0 if report["slo"]["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
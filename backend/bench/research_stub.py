@@ -0,0 +1,141 @@
+"""Заглушка поисковика и веб-сайтов для режима deep research (use_internet) без интернета.
+
+Запуск:
+    python -m backend.bench.research_stub --port 8765
+    SEARCH_API_URL=http://127.0.0.1:8765/search RESEARCH_ALLOW_PRIVATE_HOSTS=1 python -m backend.main
+    python -m backend.bench.research_stub --check --budget 5               # сбор источников без модели
+
+/search?q=...&format=json отвечает как SearxNG: страницы небольшого корпуса, упорядоченные
+по числу общих с запросом слов. Среди страниц есть зеркала (тот же текст в другой обертке —
+их должна отсеять MinHash-дедупликация), страница, которая отвечает --slow-seconds
+(проверка бюджета времени), и битая ссылка (404). --check поднимает заглушку в фоне,
+прогоняет research.gather_sources по вопросу и готовым подвопросам (вместо плана модели)
+и печатает JSON: события, отобранные источники с оценками BM25 и время сбора.
+Страницы заглушки лежат на 127.0.0.1, поэтому бэкенду нужен RESEARCH_ALLOW_PRIVATE_HOSTS=1
+(иначе он не грузит страницы из внутренней сети); --check включает его сам.
+"""
+import json
+import time
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from backend import research
+
+CORPUS = {
+    "gguf-format": ("GGUF file format",
+                    "GGUF is the binary file format used by llama.cpp to store model weights together with the "
+                    "tokenizer and metadata in a single file. It replaced the older GGML format in August 2023. "
+                    "A GGUF file starts with a header, followed by key-value metadata such as the architecture, "
+                    "context length and quantization type, and then the tensor data aligned for memory mapping. "
+                    "Because tensors are aligned, llama.cpp can mmap the file and start without copying weights."),
+    "quantization": ("Quantization in llama.cpp",
+                     "Quantization stores weights with fewer bits to reduce memory and speed up inference. "
+                     "llama.cpp offers k-quants such as Q4_K_M and Q5_K_M which quantize weights in blocks "
+                     "of 256 values with per-block scales. Q4_K_M uses about 4.8 bits per weight and is the usual "
+                     "trade-off between quality and size, while Q8_0 is almost lossless but twice as large. "
+                     "Perplexity grows slowly down to 4 bits and quickly below 3 bits per weight."),
+    "kv-cache": ("KV cache explained",
+                 "The KV cache keeps the attention keys and values of already processed tokens so that each new "
+                 "token only attends to cached state instead of recomputing the whole prompt. Its size grows "
+                 "linearly with context length, number of layers and hidden size, which is why long contexts need "
+                 "a lot of memory. llama.cpp can store the KV cache in 8-bit or 4-bit types to save memory."),
+    "speculative": ("Speculative decoding",
+                    "Speculative decoding uses a small draft model to propose several tokens which the large model "
+                    "verifies in a single forward pass. When the draft agrees with the target model often, "
+                    "generation becomes two to three times faster without changing the output distribution. "
+                    "Prompt lookup decoding is a variant that drafts tokens by copying n-grams from the prompt."),
+}
+MIRRORS = {"gguf-format-mirror": "gguf-format", "quantization-mirror": "quantization"}
+SLOW_PAGE = "benchmarks-slow"
+BROKEN_PAGE = "missing-page"
+CHECK_QUESTION = "How does GGUF quantization affect memory and speed in llama.cpp?"
+CHECK_QUERIES = ["GGUF file format", "Q4_K_M bits per weight", "llama.cpp KV cache memory"]
+
+
+def page_html(slug: str) -> str:
+    title, text = CORPUS[MIRRORS.get(slug, slug)]
+    wrapper = "Mirror of the original article" if slug in MIRRORS else "Knowledge base"
+    return (f"<html><head><title>{title}</title><script>var tracking = 1;</script></head>"
+            f"<body><nav>Home | Articles | About</nav><header>{wrapper}</header>"
+            f"<article><h1>{title}</h1><p>{text}</p></article><footer>© Stub</footer></body></html>")
+
+
+def make_handler(slow_seconds: float):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status: int, body: str, content_type: str):
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            base = f"http://{self.headers.get('Host')}"
+            if url.path == "/search":
+                words = set(research.tokenize(parse_qs(url.query).get("q", [""])[0]))
+                slugs = [*CORPUS, *MIRRORS]
+                ranked = sorted(slugs, key=lambda slug: -len(words & set(research.tokenize(" ".join(
+                    CORPUS[MIRRORS.get(slug, slug)])))))
+                results = [{"url": f"{base}/page/{slug}", "title": CORPUS[MIRRORS.get(slug, slug)][0],
+                            "content": CORPUS[MIRRORS.get(slug, slug)][1][:160]} for slug in ranked[:3]]
+                results += [{"url": f"{base}/page/{BROKEN_PAGE}", "title": "Gone", "content": ""},
+                            {"url": f"{base}/page/{SLOW_PAGE}", "title": "Benchmarks", "content": ""}]
+                self.send_body(200, json.dumps({"query": url.query, "results": results}), "application/json")
+            elif url.path == f"/page/{SLOW_PAGE}":
+                time.sleep(slow_seconds)
+                self.send_body(200, "<html><body><p>Too late to matter.</p></body></html>", "text/html")
+            elif url.path.startswith("/page/") and url.path[len("/page/"):] in {*CORPUS, *MIRRORS}:
+                self.send_body(200, page_html(url.path[len("/page/"):]), "text/html")
+            else:
+                self.send_body(404, "not found", "text/plain")
+
+    return StubHandler
+
+
+async def check(search_url: str, budget: float) -> dict:
+    start = time.monotonic()
+    events = []
+    async for event in research.gather_sources(CHECK_QUESTION, [CHECK_QUESTION, *CHECK_QUERIES],
+                                               start + budget, search_url=search_url):
+        events.append({key: value for key, value in event.items() if key != "passages"})
+        if event["type"] == "sources":
+            passages = [{"source": passage["source"], "score": passage["score"], "text": passage["text"][:80]}
+                        for passage in event["passages"]]
+    return {"seconds": round(time.monotonic() - start, 3), "budget": budget, "events": events,
+            "passages": passages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="0 — любой свободный порт")
+    parser.add_argument("--slow-seconds", type=float, default=30, help="Сколько отвечает медленная страница")
+    parser.add_argument("--check", action="store_true", help="Прогнать сбор источников и выйти")
+    parser.add_argument("--budget", type=float, default=5, help="Бюджет сбора для --check, секунды")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port if not args.check else 0), make_handler(args.slow_seconds))
+    server.daemon_threads = True  # Медленная страница не должна держать выход
+    search_url = f"http://{args.host}:{server.server_address[1]}/search"
+    if not args.check:
+        print(f"Заглушка поиска: SEARCH_API_URL={search_url}")
+        server.serve_forever()
+        return
+    research.RESEARCH_ALLOW_PRIVATE_HOSTS = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        print(json.dumps(asyncio.run(check(search_url, args.budget)), indent=2, ensure_ascii=False))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
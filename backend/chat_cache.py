@@ -0,0 +1,248 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+MESSAGE_OVERHEAD_BYTES = 256  # dict сообщения, message_id и строка времени сверх самого текста
+LOOKUP_KINDS = ("chats", "messages", "versions")
+
+
+class MessageWindow:
+    """Последние сообщения одного чата по возрастанию message_id; complete — в окне вся история."""
+    __slots__ = ("messages", "ids", "complete", "size")
+
+    def __init__(self, messages: List[Dict], complete: bool):
+        self.messages = messages
+        self.ids = [message["message_id"] for message in messages]
+        self.complete = complete
+        self.size = sum(message_size(message) for message in messages)
+
+
+def message_size(message: Dict) -> int:
+    return len(message["content"].encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+
+
+class ChatCache:
+    """Сквозной (write-through) кеш списка чатов и окон последних сообщений в памяти процесса API.
+
+    Интерфейс после каждого хода перечитывает /chats, а при переключении чата — всю историю; без кеша
+    каждый такой запрос открывает SQLite и заново разбирает строки. Читатели передают функцию загрузки
+    из БД (load) и получают данные из памяти, если они там есть. Все записи идут через db_* хелперы api,
+    которые после коммита обновляют кеш; то, что пишут мимо них (импорт), сбрасывает его через clear().
+
+    Окно чата — не больше window_size последних сообщений: его хватает и для промпта хода, и для
+    истории обычного чата целиком. Окна вытесняются по LRU, когда их суммарный размер превышает
+    max_bytes; список чатов (по строке на чат) не вытесняется.
+
+    Загрузка из БД идет без lock, поэтому кладем ее результат, только если за это время не было
+    ни одной записи: иначе прочитанное могло устареть раньше, чем попало в кеш.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, window_size: int = 200, enabled: bool = True):
+        self.max_bytes = max_bytes
+        self.window_size = max(1, window_size)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._chats: Optional[Dict[str, Dict]] = None  # None — список из БД еще не читали
+        self._windows: "OrderedDict[str, MessageWindow]" = OrderedDict()
+        self._total_bytes = 0
+        self._writes = 0
+        self._stats = {kind: {"hits": 0, "misses": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+                       for kind in LOOKUP_KINDS}
+        self._evictions = 0
+
+    # --- Чтение ---
+
+    def _record(self, kind: str, hit: bool, start: float):
+        stats = self._stats[kind]
+        stats["hits" if hit else "misses"] += 1
+        stats["hit_seconds" if hit else "miss_seconds"] += time.perf_counter() - start
+
+    def chats(self, load: Callable[[], List[Dict]]) -> List[Dict]:
+        """Все чаты по убыванию last_modified_at (копии строк — вызывающий может их менять)."""
+        start = time.perf_counter()
+        with self._lock:
+            if self.enabled and self._chats is not None:
+                # Тот же порядок, что ORDER BY last_modified_at DESC, chat_id ASC в db_load_chats
+                rows = sorted((dict(chat) for chat in self._chats.values()), key=lambda chat: chat["chat_id"])
+                rows.sort(key=lambda chat: chat["last_modified_at"] or "", reverse=True)
+                self._record("chats", True, start)
+                return rows
+            writes = self._writes
+        rows = load()
+        with self._lock:
+            self._record("chats", False, start)
+            if self.enabled and writes == self._writes:
+                self._chats = {row["chat_id"]: dict(row) for row in rows}
+        return rows
+
+    def chats_version(self, load: Callable[[], Tuple]) -> Tuple:
+        """(число чатов, максимальный last_modified_at) — как агрегат по таблице chats."""
+        start = time.perf_counter()
+        with self._lock:
+            if self.enabled and self._chats is not None:
+                latest = max((chat["last_modified_at"] for chat in self._chats.values()
+                              if chat["last_modified_at"]), default=None)
+                self._record("versions", True, start)
+                return len(self._chats), latest
+        version = load()
+        with self._lock:
+            self._record("versions", False, start)
+        return version
+
+    def _window_slice(self, chat_id: str, limit: Optional[int]) -> Tuple[bool, Optional[List[Dict]]]:
+        """(попадание, сообщения); сообщения None — чата нет. Вызывается под lock."""
+        if self._chats is not None and chat_id not in self._chats:
+            return True, None  # Список чатов полный: раз чата в нем нет, его нет и в БД
+        window = self._windows.get(chat_id)
+        if window is None or not (window.complete or (limit is not None and len(window.messages) >= limit)):
+            return False, None
+        self._windows.move_to_end(chat_id)
+        messages = window.messages if limit is None else window.messages[-limit:] if limit else []
+        return True, [dict(message) for message in messages]
+
+    def messages(self, chat_id: str, load: Callable[[Optional[int]], Optional[List[Dict]]],
+                 limit: Optional[int] = None) -> Optional[List[Dict]]:
+        """Вся история чата (limit=None) или последние limit сообщений; None — чата нет.
+
+        load(limit) читает из БД последние limit сообщений (None — все). При промахе читаем сразу
+        окно целиком, а не limit: следующий запрос истории этого чата уже попадет в кеш.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if self.enabled:
+                hit, messages = self._window_slice(chat_id, limit)
+                if hit:
+                    self._record("messages", True, start)
+                    return messages
+            writes = self._writes
+        load_limit = None if limit is None else max(limit, self.window_size)
+        rows = load(load_limit)
+        with self._lock:
+            self._record("messages", False, start)
+            if self.enabled and rows is not None and writes == self._writes:
+                complete = load_limit is None or len(rows) < load_limit
+                window_rows = [dict(row) for row in rows[-self.window_size:]]
+                self._store_window(chat_id, MessageWindow(window_rows, complete and len(rows) <= self.window_size))
+        if rows is None or limit is None:
+            return rows
+        return rows[-limit:] if limit else []
+
+    def messages_version(self, chat_id: str, load: Callable[[], Optional[Tuple]]) -> Optional[Tuple]:
+        """(last_modified_at чата, последний message_id) для ETag истории; None — чата нет."""
+        start = time.perf_counter()
+        with self._lock:
+            if self.enabled and self._chats is not None:
+                chat = self._chats.get(chat_id)
+                window = self._windows.get(chat_id)
+                if chat is None or window is not None:
+                    self._record("versions", True, start)
+                    if chat is None:
+                        return None
+                    return chat["last_modified_at"], window.ids[-1] if window.ids else None
+        version = load()
+        with self._lock:
+            self._record("versions", False, start)
+        return version
+
+    # --- Запись (после коммита в БД) ---
+
+    def _store_window(self, chat_id: str, window: MessageWindow):
+        old = self._windows.pop(chat_id, None)
+        if old:
+            self._total_bytes -= old.size
+        self._windows[chat_id] = window
+        self._total_bytes += window.size
+        self._evict()
+
+    def _evict(self):
+        while self._windows and self._total_bytes > self.max_bytes:
+            _, evicted = self._windows.popitem(last=False)
+            self._total_bytes -= evicted.size
+            self._evictions += 1
+
+    def add_chat(self, chat: Dict):
+        with self._lock:
+            self._writes += 1
+            if not self.enabled:
+                return
+            if self._chats is not None:
+                self._chats[chat["chat_id"]] = dict(chat)
+            self._store_window(chat["chat_id"], MessageWindow([], complete=True))  # Новый чат пуст
+
+    def add_message(self, chat_id: str, message: Dict, **chat_fields):
+        """Новое сообщение; chat_fields — поля чата, которые поменялись вместе с ним (время, название)."""
+        with self._lock:
+            self._writes += 1
+            if not self.enabled:
+                return
+            if self._chats is not None and chat_id in self._chats:
+                self._chats[chat_id].update(chat_fields)
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+            # Параллельные записи в один чат могут прийти сюда не в порядке message_id
+            position = bisect.bisect_left(window.ids, message["message_id"])
+            if position < len(window.ids) and window.ids[position] == message["message_id"]:
+                return  # Уже прочитано из БД вместе с окном
+            window.ids.insert(position, message["message_id"])
+            window.messages.insert(position, dict(message))
+            window.size += message_size(message)
+            self._total_bytes += message_size(message)
+            while len(window.messages) > self.window_size:
+                window.ids.pop(0)
+                dropped = window.messages.pop(0)
+                window.size -= message_size(dropped)
+                self._total_bytes -= message_size(dropped)
+                window.complete = False
+            self._windows.move_to_end(chat_id)
+            self._evict()
+
+    def update_chat(self, chat_id: str, **fields):
+        with self._lock:
+            self._writes += 1
+            if self.enabled and self._chats is not None and chat_id in self._chats:
+                self._chats[chat_id].update(fields)
+
+    def delete_chat(self, chat_id: str):
+        with self._lock:
+            self._writes += 1
+            if self._chats is not None:
+                self._chats.pop(chat_id, None)
+            window = self._windows.pop(chat_id, None)
+            if window:
+                self._total_bytes -= window.size
+
+    def clear(self):
+        with self._lock:
+            self._writes += 1
+            self._chats = None
+            self._windows.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = {}
+            for kind, stats in self._stats.items():
+                hits, misses = stats["hits"], stats["misses"]
+                avg_hit = stats["hit_seconds"] / hits if hits else 0.0
+                avg_miss = stats["miss_seconds"] / misses if misses else 0.0
+                lookups[kind] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                    "avg_hit_ms": round(avg_hit * 1000, 3),
+                    "avg_miss_ms": round(avg_miss * 1000, 3),
+                    # Оценка: каждое попадание сэкономило разницу между средним промахом (чтение БД) и попаданием
+                    "saved_ms": round(hits * max(0.0, avg_miss - avg_hit) * 1000, 1) if misses else None,
+                }
+            return {
+                "enabled": self.enabled,
+                "lookups": lookups,
+                "chats": len(self._chats) if self._chats is not None else None,
+                "windows": len(self._windows),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,301 @@
+import json
+import time
+import zlib
+import sqlite3
+import datetime
+from typing import Dict, Iterator, Optional
+
+EXPORT_FORMAT = "neurabox-chats"
+EXPORT_VERSION = 1
+FETCH_BATCH_SIZE = 1000  # Строк за один fetchmany при экспорте
+IMPORT_BATCH_SIZE = 1000  # Строк NDJSON на одну транзакцию импорта
+OUTPUT_CHUNK_SIZE = 64 * 1024  # Копим вывод до такого размера, чтобы не слать по строке на чанк
+COMPRESSIONS = ("none", "gzip", "zstd")
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class TransferError(ValueError):
+    pass
+
+
+def _open_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise TransferError("Сжатие zstd недоступно: установите пакет zstandard.")
+    return zstandard
+
+
+def _make_compressor(compression: str):
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 — формат gzip
+    if compression == "zstd":
+        return _open_zstd().ZstdCompressor(level=3).compressobj()
+    if compression == "none":
+        return None
+    raise TransferError(f"Неизвестное сжатие {compression}. Допустимы: {COMPRESSIONS}")
+
+
+def export_file_suffix(compression: str) -> str:
+    return {"gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}.get(compression, ".ndjson")
+
+
+def _iter_lines(conn: sqlite3.Connection) -> Iterator[str]:
+    yield json.dumps({"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION,
+                      "exported_at": datetime.datetime.now().isoformat()}) + "\n"
+    # Сначала все чаты, потом все сообщения в порядке message_id: так оба запроса идут по rowid
+    # без сортировки во временной таблице, а порядок сообщений внутри чата сохраняется
+    cursor = conn.execute("SELECT chat_id, title, model_used, created_at, last_modified_at FROM chats ORDER BY rowid")
+    while rows := cursor.fetchmany(FETCH_BATCH_SIZE):
+        for row in rows:
+            yield json.dumps({"type": "chat", **dict(row)}, ensure_ascii=False, default=str) + "\n"
+    cursor = conn.execute("SELECT message_id, chat_id, sender, content, timestamp FROM messages ORDER BY message_id")
+    while rows := cursor.fetchmany(FETCH_BATCH_SIZE):
+        for row in rows:
+            yield json.dumps({"type": "message", **dict(row)}, ensure_ascii=False, default=str) + "\n"
+
+
+def iter_export(db_path: str, compression: str = "none") -> Iterator[bytes]:
+    """Экспорт всех чатов и сообщений в NDJSON (опционально gzip/zstd) потоком байтовых чанков.
+
+    Строки читаются курсором порциями по FETCH_BATCH_SIZE, так что расход памяти не зависит
+    от размера базы. Все чтение идет в одной транзакции — экспорт видит согласованный снимок
+    (в режиме WAL он при этом не блокирует запись новых сообщений).
+    """
+    compressor = _make_compressor(compression)
+    # Starlette крутит синхронный генератор в разных потоках пула, но строго по очереди
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("BEGIN")
+        buffer = []
+        buffered = 0
+        for line in _iter_lines(conn):
+            data = line.encode("utf-8")
+            buffer.append(data)
+            buffered += len(data)
+            if buffered >= OUTPUT_CHUNK_SIZE:
+                chunk = b"".join(buffer)
+                buffer, buffered = [], 0
+                chunk = compressor.compress(chunk) if compressor else chunk
+                if chunk:
+                    yield chunk
+        chunk = b"".join(buffer)
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def init_import_tables(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS import_checkpoints (
+            import_id TEXT PRIMARY KEY,
+            lines_done INTEGER NOT NULL DEFAULT 0,
+            chats INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Чаты текущего импорта: skipped — чат с таким id уже был в базе, его сообщения не импортируем.
+    # Лежит в БД, а не в памяти, чтобы переживать возобновление и не расти вместе с файлом
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS import_chats (
+            import_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            last_modified_at TIMESTAMP,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (import_id, chat_id)
+        );
+    """)
+    conn.commit()
+
+
+class _Decompressor:
+    """Определяет сжатие по первым байтам потока и распаковывает его по частям."""
+
+    def __init__(self):
+        self._inner = None
+        self._pending = b""
+        self._detected = False
+
+    def feed(self, data: bytes) -> bytes:
+        if not self._detected:
+            self._pending += data
+            if len(self._pending) < 4:
+                return b""
+            data, self._pending = self._pending, b""
+            self._detected = True
+            if data.startswith(ZSTD_MAGIC):
+                self._inner = _open_zstd().ZstdDecompressor().decompressobj()
+            elif data.startswith(GZIP_MAGIC):
+                self._inner = zlib.decompressobj(47)  # 32 + 15 — автоопределение заголовка gzip/zlib
+        return self._inner.decompress(data) if self._inner else data
+
+    def flush(self) -> bytes:
+        if not self._detected:
+            self._detected = True
+            return self._pending
+        return self._inner.flush() if self._inner and hasattr(self._inner, "flush") else b""
+
+
+class ChatImporter:
+    """Потоковый импорт NDJSON-экспорта с контрольными точками.
+
+    Данные подаются кусками через feed(); строки копятся до IMPORT_BATCH_SIZE и пишутся одной
+    транзакцией через executemany вместе с номером последней строки в import_checkpoints.
+    Если импорт оборвался, повторная отправка того же файла с тем же import_id пропускает
+    уже записанные строки и продолжает с контрольной точки.
+    """
+
+    def __init__(self, db_path: str, import_id: str):
+        self.import_id = import_id
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        init_import_tables(self.conn)
+        row = self.conn.execute(
+            "SELECT lines_done, chats, messages, completed FROM import_checkpoints WHERE import_id = ?",
+            (import_id,)).fetchone()
+        if row is None:
+            self.conn.execute("INSERT INTO import_checkpoints (import_id) VALUES (?)", (import_id,))
+            self.conn.commit()
+            row = (0, 0, 0, 0)
+        self.resume_from, self.chats, self.messages, self.completed = row
+        self.line_number = 0
+        self.skipped_lines = 0
+        self._decompressor = _Decompressor()
+        self._remainder = b""
+        self._chat_rows = []
+        self._message_rows = []
+        self._batch_lines = 0
+        self.started = time.perf_counter()
+
+    def feed(self, data: bytes):
+        data = self._remainder + self._decompressor.feed(data)
+        lines = data.split(b"\n")
+        self._remainder = lines.pop()
+        for line in lines:
+            self._handle_line(line)
+
+    def _handle_line(self, line: bytes):
+        if not line.strip():
+            return
+        self.line_number += 1
+        if self.line_number <= self.resume_from or self.completed:
+            self.skipped_lines += 1  # Уже записано до обрыва — даже не разбираем JSON
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise TransferError(f"Строка {self.line_number}: некорректный JSON.")
+        kind = record.get("type")
+        if kind == "header":
+            if record.get("format") != EXPORT_FORMAT or record.get("version", 0) > EXPORT_VERSION:
+                raise TransferError("Файл не является экспортом чатов NeuraBox этой или более ранней версии.")
+        elif kind == "chat":
+            self._chat_rows.append((record["chat_id"], record["title"], record.get("model_used"),
+                                    record.get("created_at"), record.get("last_modified_at")))
+        elif kind == "message":
+            if record.get("sender") not in ("user", "ai"):
+                raise TransferError(f"Строка {self.line_number}: неизвестный отправитель {record.get('sender')}.")
+            self._message_rows.append((record["chat_id"], record["sender"], record["content"],
+                                       record.get("timestamp")))
+        else:
+            raise TransferError(f"Строка {self.line_number}: неизвестный тип записи {kind}.")
+        self._batch_lines += 1
+        if self._batch_lines >= IMPORT_BATCH_SIZE:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if not self._batch_lines:
+            return
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            if self._chat_rows:
+                # Сначала отмечаем чаты, которые уже есть в базе: их не перезаписываем
+                cursor.executemany(
+                    """INSERT OR IGNORE INTO import_chats (import_id, chat_id, last_modified_at, skipped)
+                       SELECT ?, ?, ?, EXISTS (SELECT 1 FROM chats WHERE chat_id = ?)""",
+                    [(self.import_id, row[0], row[4], row[0]) for row in self._chat_rows])
+                cursor.executemany(
+                    """INSERT OR IGNORE INTO chats (chat_id, title, model_used, created_at, last_modified_at)
+                       VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))""",
+                    self._chat_rows)
+                self.chats += max(cursor.rowcount, 0)  # Уже существующие чаты не считаются
+            if self._message_rows:
+                # message_id не переносим — в базе уже могут быть свои; порядок сохраняется порядком вставки
+                cursor.executemany(
+                    """INSERT INTO messages (chat_id, sender, content, timestamp)
+                       SELECT ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP)
+                       WHERE NOT EXISTS (SELECT 1 FROM import_chats
+                                         WHERE import_id = ? AND chat_id = ? AND skipped = 1)""",
+                    [(*row, self.import_id, row[0]) for row in self._message_rows])
+                self.messages += max(cursor.rowcount, 0)
+            cursor.execute(
+                """UPDATE import_checkpoints SET lines_done = ?, chats = ?, messages = ?,
+                   updated_at = CURRENT_TIMESTAMP WHERE import_id = ?""",
+                (self.line_number, self.chats, self.messages, self.import_id))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self._chat_rows, self._message_rows, self._batch_lines = [], [], 0
+
+    def finish(self) -> Dict:
+        tail = self._remainder + self._decompressor.flush()
+        self._remainder = b""
+        for line in tail.split(b"\n"):
+            self._handle_line(line)
+        self._flush_batch()
+        if not self.completed:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute("BEGIN")
+                # Триггер update_chat_modtime при вставке сообщений сдвинул last_modified_at на "сейчас" —
+                # возвращаем исходное время, чтобы импортированные чаты не всплыли наверх списка
+                cursor.execute(
+                    """UPDATE chats SET last_modified_at = (
+                           SELECT ic.last_modified_at FROM import_chats ic
+                           WHERE ic.import_id = ? AND ic.chat_id = chats.chat_id)
+                       WHERE chat_id IN (SELECT chat_id FROM import_chats
+                                         WHERE import_id = ? AND skipped = 0 AND last_modified_at IS NOT NULL)""",
+                    (self.import_id, self.import_id))
+                cursor.execute("DELETE FROM import_chats WHERE import_id = ?", (self.import_id,))
+                cursor.execute("UPDATE import_checkpoints SET completed = 1, updated_at = CURRENT_TIMESTAMP "
+                               "WHERE import_id = ?", (self.import_id,))
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        return self.summary()
+
+    def summary(self) -> Dict:
+        return {
+            "import_id": self.import_id,
+            "chats": self.chats,
+            "messages": self.messages,
+            "lines": self.line_number,
+            "resumed_from_line": self.resume_from,
+            "skipped_lines": self.skipped_lines,
+            "already_completed": bool(self.completed),
+            "seconds": round(time.perf_counter() - self.started, 3),
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def checkpoint_status(db_path: str, import_id: str) -> Optional[Dict]:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        init_import_tables(conn)
+        row = conn.execute("SELECT * FROM import_checkpoints WHERE import_id = ?", (import_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
@@ -0,0 +1,201 @@
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+ANONYMOUS_CLIENT = "anonymous"
+MIN_PRUNE_BUCKETS = 1024  # Ниже этого числа ведер полные не ищем
+
+
+class ClientRejected(Exception):
+    """Запрос клиента не принят: status_code 401 (нет ключа) или 429 (лимит, см. retry_after)."""
+
+    def __init__(self, message: str, status_code: int = 429, retry_after: Optional[float] = None,
+                 reason: str = "rate"):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def headers(self) -> Optional[Dict[str, str]]:
+        if self.retry_after is None:
+            return None
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class ClientIdentity:
+    """client_id — ключ лимитов и учета; label — необязательная подпись клиента без ключа (X-Client-Id) для логов."""
+    __slots__ = ("client_id", "weight", "label")
+
+    def __init__(self, client_id: str, weight: float = 1.0, label: Optional[str] = None):
+        self.client_id = client_id
+        self.weight = weight
+        self.label = label
+
+    def __str__(self) -> str:
+        return f"{self.client_id} ({self.label})" if self.label else self.client_id
+
+
+def parse_api_keys(value: str) -> Dict[str, ClientIdentity]:
+    """CLIENT_API_KEYS: "имя:ключ[:вес],..." — вес задает долю модели при справедливой очереди."""
+    keys = {}
+    for item in value.split(","):
+        parts = [part.strip() for part in item.split(":")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        try:
+            weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        except ValueError:
+            logger.warning(f"Некорректный вес клиента {parts[0]} в CLIENT_API_KEYS, используется 1.")
+            weight = 1.0
+        keys[parts[1]] = ClientIdentity(parts[0], max(weight, 0.01))
+    return keys
+
+
+class TokenBucket:
+    """Ведро токенов: capacity в минуту, пополняется равномерно. Может уходить в минус (долг)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class ClientLease:
+    """Право клиента на одну генерацию: держит слот лимита параллельности до release()."""
+
+    def __init__(self, limiter: "ClientLimiter", client: ClientIdentity):
+        self.limiter = limiter
+        self.client = client
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.limiter._release(self.client.client_id)
+
+
+class ClientLimiter:
+    """Опознает клиента по X-API-Key (без ключа — по IP) и применяет лимиты.
+
+    Лимиты (0 — выключен): запросов в минуту, токенов (промпт + ответ) в минуту и одновременных
+    генераций на клиента. Токены списываются после генерации, поэтому клиент может уйти в долг
+    одним длинным ответом — тогда следующие запросы получают 429, пока долг не погасится.
+
+    Заголовку X-Client-Id без ключа не верим: меняя его на каждом запросе, клиент получал бы
+    новое ведро и слот. Он остается только подписью внутри ведра своего IP.
+    Полностью пополнившееся ведро ничем не отличается от нового, поэтому такие ведра
+    выбрасываются (см. _prune_locked) — память растет с числом недавно активных клиентов, а не всех.
+    """
+
+    def __init__(self, api_keys: Dict[str, ClientIdentity], require_api_key: bool = False,
+                 requests_per_minute: float = 0, tokens_per_minute: float = 0, max_concurrent: int = 0):
+        self.api_keys = api_keys
+        self.require_api_key = require_api_key
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._request_buckets: Dict[str, TokenBucket] = {}
+        self._token_buckets: Dict[str, TokenBucket] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._prune_at = MIN_PRUNE_BUCKETS
+
+    @classmethod
+    def from_env(cls) -> "ClientLimiter":
+        return cls(
+            parse_api_keys(os.getenv("CLIENT_API_KEYS", "")),
+            require_api_key=os.getenv("REQUIRE_API_KEY", "0") == "1",
+            requests_per_minute=float(os.getenv("CLIENT_RATE_LIMIT_RPM", "0")),
+            tokens_per_minute=float(os.getenv("CLIENT_TOKEN_LIMIT_TPM", "0")),
+            max_concurrent=int(os.getenv("CLIENT_MAX_CONCURRENT", "0")),
+        )
+
+    def identify(self, headers, remote_host: Optional[str] = None) -> ClientIdentity:
+        api_key = headers.get("X-API-Key") or ""
+        if not api_key and headers.get("Authorization", "").startswith("Bearer "):
+            api_key = headers["Authorization"][len("Bearer "):].strip()  # Как у OpenAI-клиентов
+        if api_key in self.api_keys:
+            return self.api_keys[api_key]
+        if self.require_api_key:
+            raise ClientRejected("Нужен действительный X-API-Key.", status_code=401, reason="auth")
+        label = headers.get("X-Client-Id")
+        return ClientIdentity(f"ip:{remote_host}" if remote_host else ANONYMOUS_CLIENT,
+                              label=label[:128] if label else None)
+
+    def admit(self, client: ClientIdentity) -> ClientLease:
+        """Проверяет лимиты и занимает слот параллельности; при отказе — ClientRejected (429)."""
+        client_id = client.client_id
+        with self._lock:
+            if self.max_concurrent and self._in_flight.get(client_id, 0) >= self.max_concurrent:
+                raise ClientRejected(f"Не больше {self.max_concurrent} одновременных генераций на клиента.",
+                                     retry_after=1, reason="concurrency")
+            if self.tokens_per_minute:
+                bucket = self._token_buckets.setdefault(client_id, TokenBucket(self.tokens_per_minute))
+                bucket.refill()
+                if bucket.tokens <= 0:
+                    raise ClientRejected("Превышен лимит токенов в минуту.",
+                                         retry_after=bucket.seconds_until(1), reason="tokens")
+            if self.requests_per_minute:
+                bucket = self._request_buckets.setdefault(client_id, TokenBucket(self.requests_per_minute))
+                bucket.refill()
+                if bucket.tokens < 1:
+                    raise ClientRejected("Превышен лимит запросов в минуту.",
+                                         retry_after=bucket.seconds_until(1), reason="requests")
+                bucket.tokens -= 1
+            self._in_flight[client_id] = self._in_flight.get(client_id, 0) + 1
+            self._prune_locked()
+        return ClientLease(self, client)
+
+    def _prune_locked(self):
+        """Выбрасывает полные ведра, когда их стало вдвое больше, чем после прошлой чистки (амортизированно O(1))."""
+        if len(self._request_buckets) + len(self._token_buckets) < self._prune_at:
+            return
+        for buckets in (self._request_buckets, self._token_buckets):
+            for client_id in [client_id for client_id, bucket in buckets.items() if bucket.full()]:
+                del buckets[client_id]
+        self._prune_at = max(MIN_PRUNE_BUCKETS, 2 * (len(self._request_buckets) + len(self._token_buckets)))
+
+    def charge_tokens(self, client_id: str, tokens: int):
+        if not self.tokens_per_minute:
+            return
+        with self._lock:
+            bucket = self._token_buckets.setdefault(client_id, TokenBucket(self.tokens_per_minute))
+            bucket.refill()
+            bucket.tokens -= tokens
+
+    def _release(self, client_id: str):
+        with self._lock:
+            left = self._in_flight.get(client_id, 0) - 1
+            if left > 0:
+                self._in_flight[client_id] = left
+            else:
+                self._in_flight.pop(client_id, None)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "limits": {"requests_per_minute": self.requests_per_minute,
+                           "tokens_per_minute": self.tokens_per_minute,
+                           "max_concurrent": self.max_concurrent,
+                           "require_api_key": self.require_api_key},
+                "in_flight": dict(self._in_flight),
+                "tracked_buckets": len(self._request_buckets) + len(self._token_buckets),
+            }
@@ -0,0 +1,72 @@
+import os
+import logging
+from typing import Dict, List, Optional
+
+import llama_cpp
+from llama_cpp import Llama
+
+from backend.hardware import get_available_memory_bytes
+from backend.quant_selection import MEMORY_OVERHEAD_BYTES, MEMORY_OVERHEAD_RATIO, shard_file_names
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CTX = 2048  # Одна последовательность должна целиком влезать в батч
+
+
+class EmbeddingError(Exception):
+    """Ошибка запроса эмбеддингов, о которой отвечаем клиенту (в формате ошибок OpenAI), а не 500.
+
+    Аргументы конструктора лежат в args, поэтому ошибка переживает pickle по каналу воркера.
+    """
+
+    def __init__(self, status_code: int, message: str, error_type: str, code: str, param: Optional[str] = None):
+        super().__init__(status_code, message, error_type, code, param)
+        self.status_code = status_code
+        self.message = message
+        self.error_type = error_type
+        self.code = code
+        self.param = param
+
+    def __str__(self) -> str:
+        return self.message
+
+    def detail(self) -> Dict:
+        return {"error": {"message": self.message, "type": self.error_type, "param": self.param, "code": self.code}}
+
+
+def estimate_memory_bytes(model_path: str) -> int:
+    """Сколько памяти займет еще один экземпляр модели: та же оценка, что при выборе квантования."""
+    size = sum(os.path.getsize(part) for part in shard_file_names(model_path) if os.path.exists(part))
+    return int(size * MEMORY_OVERHEAD_RATIO + MEMORY_OVERHEAD_BYTES)
+
+
+def fits_in_memory(model_path: str) -> bool:
+    available = get_available_memory_bytes()
+    return available is None or estimate_memory_bytes(model_path) <= available
+
+
+def create_embedding_llama(model_path: str, llama_kwargs: Dict) -> Llama:
+    """Отдельный экземпляр модели с embedding=True: режим задается при создании контекста.
+
+    Это второй экземпляр рядом с генерацией, поэтому сначала проверяем, что он влезет в память.
+    """
+    if not fits_in_memory(model_path):
+        raise EmbeddingError(503, f"Недостаточно памяти для модели эмбеддингов {os.path.basename(model_path)} "
+                                  f"(нужно ~{estimate_memory_bytes(model_path) / 1024 ** 3:.1f} GB).",
+                             "server_error", "insufficient_memory")
+    logger.info(f"Загрузка модели эмбеддингов: {model_path}")
+    return Llama(model_path=model_path, embedding=True, pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+                 **{**llama_kwargs, "n_ctx": EMBEDDING_CTX, "n_batch": EMBEDDING_CTX, "n_ubatch": EMBEDDING_CTX})
+
+
+def embed_on_llm(llm, inputs: List[str]) -> Dict:
+    """Эмбеддинги всех входов; вход длиннее контекста — ошибка клиента, а не падение llama.cpp."""
+    for index, text in enumerate(inputs):
+        tokens = len(llm.tokenize(text.encode("utf-8")))
+        if tokens > EMBEDDING_CTX:
+            raise EmbeddingError(400, f"Вход {index} содержит {tokens} токенов, максимум {EMBEDDING_CTX}.",
+                                 "invalid_request_error", "context_length_exceeded", "input")
+    # embed() сам раскладывает входы по последовательностям одного батча llama.cpp,
+    # так что весь массив считается за один-несколько decode-вызовов, а не по одному на вход
+    embeddings, total_tokens = llm.embed(inputs, normalize=True, return_count=True)
+    return {"embeddings": embeddings, "total_tokens": total_tokens}
@@ -0,0 +1,376 @@
+"""Шлюз перед несколькими узлами NeuraBox.
+
+Запуск (узлы — обычные бэкенды на своих портах):
+    python -m backend.main --port 9016
+    python -m backend.main --port 9017
+    python -m backend.gateway --port 9015 --nodes http://127.0.0.1:9016,http://127.0.0.1:9017
+
+Фронтенд и инструменты ходят в шлюз как в обычный бэкенд. Чат живет в БД одного узла,
+поэтому все его запросы (/query, история, удаление) идут только на этот узел; если он
+недоступен — 503. Новые чаты и запросы без чата уходят на узел, где уже загружена нужная
+модель, с поправкой на загрузку узлов. Упавший узел выводится из ротации по health-check'у
+или по первой ошибке соединения. На следующий кандидат запрос повторяется, только если
+до узла не удалось подключиться или метод идемпотентный: POST мог уже выполниться.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL = float(os.getenv("GATEWAY_HEALTH_INTERVAL", "2.0"))
+HEALTH_CHECK_TIMEOUT = 2.0
+# Стоимость маршрутизации в "запросах в очереди": узел без нужной модели сначала будет ее загружать
+MODEL_LOAD_PENALTY = 3.0
+# Сколько chat_id -> узел помнить; вытесненный чат найдется заново опросом узлов (NodePool.refresh_chats)
+MAX_TRACKED_CHATS = int(os.getenv("GATEWAY_MAX_TRACKED_CHATS", "100000"))
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Эти запросы меняют состояние узла, поэтому рассылаются на все живые узлы
+BROADCAST_PATHS = {"/api/install_model", "/api/save_token", "/api/update_model_settings", "/api/speculative",
+                   "/api/models/pin"}
+BROADCAST_PREFIXES = ("/api/models/",)  # DELETE /api/models/{name} — удаление модели со всех узлов
+NODE_HEADER = "X-NeuraBox-Node"  # Какой узел обслужил запрос
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host", "content-encoding"}
+
+
+class Node:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = False
+        self.resident_models: List[str] = []
+        self.active_generations = 0  # По данным самого узла
+        self.in_flight = 0  # Запросы, которые шлюз сейчас проксирует на узел
+        self.failures = 0
+        self.last_check = 0.0
+
+    @property
+    def load(self) -> int:
+        return max(self.active_generations, self.in_flight)
+
+    def to_dict(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "resident_models": self.resident_models,
+            "active_generations": self.active_generations,
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "last_check": self.last_check,
+        }
+
+
+class NodePool:
+    def __init__(self, urls: List[str], max_tracked_chats: int = MAX_TRACKED_CHATS):
+        self.nodes = [Node(url) for url in urls]
+        self.chat_affinity: "OrderedDict[str, str]" = OrderedDict()  # chat_id -> url узла с чатом, по LRU
+        self.max_tracked_chats = max_tracked_chats
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def chat_owner(self, chat_id: str) -> Optional[str]:
+        url = self.chat_affinity.get(chat_id)
+        if url is not None:
+            self.chat_affinity.move_to_end(chat_id)
+        return url
+
+    def remember_chat(self, chat_id: str, url: str):
+        self.chat_affinity[chat_id] = url
+        self.chat_affinity.move_to_end(chat_id)
+        while len(self.chat_affinity) > self.max_tracked_chats:
+            self.chat_affinity.popitem(last=False)
+
+    def forget_chat(self, chat_id: str):
+        self.chat_affinity.pop(chat_id, None)
+
+    async def check_node(self, node: Node):
+        try:
+            timeout = aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+            async with self.session.get(f"{node.url}/api/node_status", timeout=timeout) as resp:
+                resp.raise_for_status()
+                status = await resp.json()
+            if not node.healthy:
+                logger.info(f"Узел {node.url} доступен.")
+            node.healthy = True
+            node.failures = 0
+            node.resident_models = status.get("resident_models", [])
+            node.active_generations = status.get("active_generations", 0)
+        except Exception as e:
+            self.mark_failed(node, e)
+        node.last_check = time.time()
+
+    def mark_failed(self, node: Node, error: Exception):
+        if node.healthy:
+            logger.warning(f"Узел {node.url} недоступен: {error}")
+        node.healthy = False
+        node.failures += 1
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check_node(node) for node in self.nodes))
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+    async def refresh_chats(self) -> bool:
+        """Заново узнает, какие чаты на каких узлах (после перезапуска шлюза или вытеснения из chat_affinity).
+
+        True — ответили все узлы, то есть чата, которого не нашли, нет нигде.
+        """
+        async def fetch(node: Node) -> bool:
+            try:
+                async with self.session.get(f"{node.url}/api/chats") as resp:
+                    resp.raise_for_status()
+                    chats = await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.mark_failed(node, e)
+                return False
+            for chat in chats:
+                self.remember_chat(chat["chat_id"], node.url)
+            return True
+
+        nodes = [node for node in self.nodes if node.healthy]
+        results = await asyncio.gather(*(fetch(node) for node in nodes))
+        return len(nodes) == len(self.nodes) and all(results)
+
+    def rank(self, chat_id: Optional[str] = None, model: Optional[str] = None) -> List[Node]:
+        """Живые узлы от лучшего к худшему для этого чата и модели.
+
+        У известного чата кандидат один — узел, в БД которого он лежит (пустой список, если узел
+        недоступен): на другом узле такого чата нет. Остальное раскладывается по загрузке и по тому,
+        загружена ли модель; равные по стоимости узлы упорядочиваются rendezvous-хешем от chat_id,
+        чтобы новые чаты стабильно раскладывались по узлам, а не падали все на первый.
+        """
+        owner_url = self.chat_owner(chat_id) if chat_id else None
+        if owner_url is not None:
+            return [node for node in self.nodes if node.url == owner_url and node.healthy]
+
+        def cost(node: Node):
+            value = float(node.load)
+            if model and model not in node.resident_models:
+                value += MODEL_LOAD_PENALTY
+            tie_break = hashlib.sha1(f"{chat_id or ''}|{node.url}".encode()).hexdigest()
+            return value, tie_break
+
+        return sorted((node for node in self.nodes if node.healthy), key=cost)
+
+
+pool: Optional[NodePool] = None
+app = FastAPI(title="NeuraBox Gateway", version="1.0")
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.on_event("startup")
+async def start_gateway():
+    pool.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=5))
+    await asyncio.gather(*(pool.check_node(node) for node in pool.nodes))
+    asyncio.create_task(pool.health_loop())
+
+
+@app.on_event("shutdown")
+async def stop_gateway():
+    await pool.session.close()
+
+
+def forward_headers(request: Request, skip: Tuple[str, ...] = ()) -> Dict[str, str]:
+    return {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() not in skip}
+
+
+async def proxy(request: Request, path: str, candidates: List[Node], body: bytes,
+                chat_id: Optional[str] = None, skip_headers: Tuple[str, ...] = ()) -> Response:
+    """Пробует узлы по порядку; следующий берется, только если до узла не удалось достучаться.
+
+    Если соединение оборвалось после подключения, узел мог уже получить тело и выполнить запрос,
+    поэтому неидемпотентный запрос (POST) не повторяется на другом узле, а завершается 502.
+    """
+    if not candidates:
+        raise HTTPException(status_code=503, detail="Нет доступных узлов.")
+    last_error = None
+    for node in candidates:
+        node.in_flight += 1
+        released = False
+        try:
+            resp = await pool.session.request(
+                request.method, f"{node.url}{path}", params=request.query_params,
+                data=body, headers=forward_headers(request, skip_headers))
+        except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+            # Не подключились — узел запрос не получил, повторить можно любой
+            node.in_flight -= 1
+            pool.mark_failed(node, e)
+            last_error = e
+            continue
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            node.in_flight -= 1
+            pool.mark_failed(node, e)
+            last_error = e
+            if request.method not in IDEMPOTENT_METHODS:
+                raise HTTPException(status_code=502,
+                                    detail=f"Узел {node.url} оборвал соединение, запрос мог быть выполнен: {e}")
+            continue
+        try:
+            if chat_id and 200 <= resp.status < 300:
+                pool.remember_chat(chat_id, node.url)
+            headers = {k: v for k, v in resp.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+            headers[NODE_HEADER] = node.url
+            content_type = resp.headers.get("Content-Type", "")
+            if content_type.startswith(("text/event-stream", "application/x-ndjson")):
+                async def relay(resp=resp, node=node):
+                    try:
+                        async for data in resp.content.iter_any():
+                            yield data
+                    except aiohttp.ClientError as e:
+                        # Узел умер посреди ответа: повторить нельзя, клиент уже получил часть
+                        pool.mark_failed(node, e)
+                    finally:
+                        resp.release()
+                        node.in_flight -= 1
+
+                released = True  # in_flight уменьшит relay
+                return StreamingResponse(relay(), status_code=resp.status, headers=headers)
+            payload = await resp.read()
+            return Response(content=payload, status_code=resp.status, headers=headers)
+        finally:
+            if not released:
+                resp.release()
+                node.in_flight -= 1
+    raise HTTPException(status_code=502, detail=f"Все узлы недоступны: {last_error}")
+
+
+async def broadcast(request: Request, path: str, body: bytes) -> Response:
+    nodes = [node for node in pool.nodes if node.healthy]
+    if not nodes:
+        raise HTTPException(status_code=503, detail="Нет доступных узлов.")
+    responses = await asyncio.gather(*(proxy(request, path, [node], body) for node in nodes),
+                                     return_exceptions=True)
+    ok = [r for r in responses if isinstance(r, Response) and r.status_code < 400]
+    if ok:
+        return ok[0]
+    first = responses[0]
+    if isinstance(first, Exception):
+        raise first
+    return first
+
+
+@app.get("/gateway/status")
+async def gateway_status():
+    return {"nodes": [node.to_dict() for node in pool.nodes], "tracked_chats": len(pool.chat_affinity),
+            "max_tracked_chats": pool.max_tracked_chats}
+
+
+@app.get("/api/chats")
+async def list_chats(request: Request):
+    # Узлы могут жить на разных машинах с разными БД — собираем список со всех
+    nodes = [node for node in pool.nodes if node.healthy]
+    # ETag клиента относится к объединенному списку: узел ответил бы 304, и его чаты выпали бы из списка
+    responses = await asyncio.gather(*(proxy(request, "/api/chats", [node], b"", skip_headers=("if-none-match",))
+                                       for node in nodes), return_exceptions=True)
+    chats: Dict[str, Dict] = {}
+    for node, resp in zip(nodes, responses):
+        if isinstance(resp, Response) and resp.status_code == 200:
+            for chat in json.loads(resp.body):
+                if chat["chat_id"] not in chats:
+                    chats[chat["chat_id"]] = chat
+                    pool.remember_chat(chat["chat_id"], node.url)
+    merged = sorted(chats.values(), key=lambda c: c["last_modified_at"], reverse=True)
+    return merged
+
+
+@app.post("/api/chats")
+async def create_chat(request: Request):
+    body = await request.body()
+    resp = await proxy(request, "/api/chats", pool.rank(), body)
+    if resp.status_code == 201:
+        # Узел, создавший чат, запоминаем сразу — там его строка в БД
+        pool.remember_chat(json.loads(resp.body)["chat_id"], resp.headers[NODE_HEADER])
+    return resp
+
+
+async def chat_nodes(chat_id: str) -> List[Node]:
+    """Узел с чатом. Чат не переезжает, поэтому при недоступном узле — 503, а не другой узел."""
+    if pool.chat_owner(chat_id) is None:
+        all_nodes_answered = await pool.refresh_chats()
+        if pool.chat_owner(chat_id) is None:
+            if not all_nodes_answered:
+                raise HTTPException(status_code=503, detail=f"Чат {chat_id} не найден на доступных узлах.")
+            raise HTTPException(status_code=404, detail=f"Чат с ID {chat_id} не найден.")
+    nodes = pool.rank(chat_id=chat_id)
+    if not nodes:
+        raise HTTPException(status_code=503, detail=f"Узел чата {chat_id} недоступен.")
+    return nodes
+
+
+@app.api_route("/api/chats/{chat_id}/{rest:path}", methods=["GET", "POST", "DELETE"])
+@app.api_route("/api/chats/{chat_id}", methods=["GET", "POST", "DELETE"])
+async def chat_scoped(request: Request, chat_id: str, rest: str = ""):
+    body = await request.body()
+    resp = await proxy(request, request.url.path, await chat_nodes(chat_id), body, chat_id=chat_id)
+    if request.method == "DELETE" and not rest and 200 <= resp.status_code < 300:
+        pool.forget_chat(chat_id)
+    return resp
+
+
+@app.post("/api/query")
+@app.post("/api/query/stream")
+async def route_query(request: Request):
+    body = await request.body()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный JSON.")
+    chat_id, model = payload.get("chat_id"), payload.get("model")
+    nodes = await chat_nodes(chat_id) if chat_id else pool.rank(model=model)
+    return await proxy(request, request.url.path, nodes, body, chat_id=chat_id)
+
+
+@app.post("/v1/chat/completions")
+@app.post("/v1/embeddings")
+async def route_v1(request: Request):
+    body = await request.body()
+    try:
+        model = json.loads(body).get("model")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный JSON.")
+    return await proxy(request, request.url.path, pool.rank(model=model), body)
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def route_other(request: Request, path: str):
+    body = await request.body()
+    path = request.url.path
+    if request.method != "GET" and (path in BROADCAST_PATHS
+                                    or request.method == "DELETE" and path.startswith(BROADCAST_PREFIXES)):
+        return await broadcast(request, path, body)
+    return await proxy(request, path, pool.rank(), body)
+
+
+def main():
+    global pool
+    import uvicorn
+    parser = argparse.ArgumentParser(description="NeuraBox gateway")
+    parser.add_argument("--nodes", default=os.getenv("GATEWAY_NODES", ""),
+                        help="URL узлов через запятую, например http://127.0.0.1:9016,http://127.0.0.1:9017")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9015)
+    args = parser.parse_args()
+    urls = [url.strip() for url in args.nodes.split(",") if url.strip()]
+    if not urls:
+        parser.error("Нужно указать хотя бы один узел (--nodes или GATEWAY_NODES).")
+    pool = NodePool(urls)
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import time
+import threading
+from typing import Callable, Dict, Iterator, List, Optional
+
+from backend.lora import apply_adapter
+
+DEFAULT_STOP = ["\nUser:", "\nAssistant:", "<|endoftext|>"]
+
+
+class CancellationToken:
+    """Флаг отмены генерации, который проверяется между токенами.
+
+    reason запоминает, кто отменил: "disconnect" (клиент ушел), "stop" (пользователь нажал стоп)
+    или "budget" (истек бюджет времени хода, см. research).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+def consume_stream(stream: Iterator[Dict], cancel_token: CancellationToken,
+                   on_token: Optional[Callable[[str], None]] = None, chat: bool = False) -> Dict:
+    """Читает поток чанков llama.cpp и прерывается при отмене.
+
+    Подходит и для completion (текст в choices[0].text), и для chat completion
+    (текст в choices[0].delta.content, chat=True). Возвращает текст (полный или частичный),
+    число сгенерированных токенов, причину завершения и тайминги: время до первого
+    токена (≈ обработка промпта) и общее время. started=False — поток не читали вовсе
+    (отменили до начала), и модель этот промпт не обрабатывала.
+    """
+    start = time.perf_counter()
+    first_token_seconds = None
+    text_parts: List[str] = []
+    completion_tokens = 0
+    finish_reason = None
+
+    if cancel_token.cancelled:  # Отменили, пока запрос ждал модель
+        stream.close()
+        return {"text": "", "completion_tokens": 0, "finish_reason": "cancelled", "started": False,
+                "cancelled": cancel_token.reason, "seconds": 0.0, "first_token_seconds": None}
+
+    try:
+        for chunk in stream:
+            if cancel_token.cancelled:
+                finish_reason = "cancelled"
+                break
+            choice = chunk["choices"][0]
+            piece = (choice.get("delta", {}).get("content") if chat else choice.get("text")) or ""
+            if piece:
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                # Чанк стрима ≈ один токен (кроме придержанных из-за стоп-строк и склеенных потом)
+                completion_tokens += 1
+                text_parts.append(piece)
+                if on_token:
+                    on_token(piece)
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+    finally:
+        stream.close()  # Освобождаем генератор llama.cpp сразу, а не при сборке мусора
+
+    return {
+        "text": "".join(text_parts),
+        "completion_tokens": completion_tokens,
+        "finish_reason": finish_reason,
+        "started": True,
+        "cancelled": cancel_token.reason if finish_reason == "cancelled" else None,
+        "seconds": time.perf_counter() - start,
+        "first_token_seconds": first_token_seconds,
+    }
+
+
+def open_stream(llm, spec: Dict) -> Iterator[Dict]:
+    """Открывает поток чанков по описанию запроса.
+
+    spec — словарь, который можно передать в другой процесс:
+    {"kind": "completion", "prompt": ..., "params": {...}} или {"kind": "chat", "messages": [...], "params": {...}}.
+    """
+    if spec["kind"] == "chat":
+        return llm.create_chat_completion(messages=spec["messages"], stream=True, **spec["params"])
+    return llm(spec["prompt"], echo=False, stream=True, **spec["params"])
+
+
+def generate_on_llm(llm, spec: Dict, cancel_token: CancellationToken,
+                    on_token: Optional[Callable[[str], None]] = None) -> Dict:
+    """Генерация на загруженной модели со статистикой черновика (если включено спекулятивное декодирование).
+
+    spec["lora"] — имя LoRA-адаптера базовой модели (см. backend.lora); без него генерирует чистая база.
+    """
+    lora_switch_seconds = apply_adapter(llm, spec.get("lora"), spec.get("lora_scale", 1.0))
+    draft = getattr(llm, "draft_model", None)
+    draft_before = None
+    if draft is not None:
+        draft.reset_pending()
+        draft_before = draft.snapshot()
+    result = consume_stream(open_stream(llm, spec), cancel_token, on_token, chat=spec["kind"] == "chat")
+    # После генерации в контексте лежат промпт и сгенерированные токены. Если поток не запускали,
+    # в n_tokens остался прошлый запрос — этот промпт не обрабатывался, и списывать за него нечего
+    result["prompt_tokens"] = max(0, llm.n_tokens - result["completion_tokens"]) if result["started"] else 0
+    result["speculative"] = draft is not None
+    result["lora"] = spec.get("lora")
+    result["lora_switch_seconds"] = lora_switch_seconds
+    result["draft_proposed"] = result["draft_accepted"] = 0
+    if draft is not None:
+        draft_after = draft.snapshot()
+        result["draft_proposed"] = draft_after["proposed"] - draft_before["proposed"]
+        result["draft_accepted"] = draft_after["accepted"] - draft_before["accepted"]
+    return result
+
+
+class CancellationStats:
+    """Сколько генераций отменено и сколько времени декодирования ушло впустую.
+
+    Впустую считается только время генераций, брошенных клиентом: при "стоп" пользователь
+    видел частичный ответ, а при разрыве соединения его не увидел никто.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "cancelled_by_disconnect": 0,
+            "cancelled_by_stop": 0,
+            "cancelled_by_budget": 0,
+            "wasted_decode_seconds": 0.0,
+            "wasted_tokens": 0,
+            "avoided_tokens": 0,  # max_tokens минус сгенерированное — столько не пришлось декодировать
+        }
+
+    def record(self, reason: str, decode_seconds: float, generated_tokens: int, max_tokens: int):
+        with self._lock:
+            if reason == "disconnect":
+                self._stats["cancelled_by_disconnect"] += 1
+                self._stats["wasted_decode_seconds"] += decode_seconds
+                self._stats["wasted_tokens"] += generated_tokens
+            elif reason == "budget":
+                self._stats["cancelled_by_budget"] += 1
+            else:
+                self._stats["cancelled_by_stop"] += 1
+            self._stats["avoided_tokens"] += max(0, max_tokens - generated_tokens)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "wasted_decode_seconds": round(self._stats["wasted_decode_seconds"], 3)}
@@ -0,0 +1,81 @@
+import os
+import sys
+import ctypes
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _windows_memory_status():
+    # GlobalMemoryStatusEx возвращает и общий, и доступный объем физической памяти
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [
+            ("dwLength", ctypes.c_ulong),
+            ("dwMemoryLoad", ctypes.c_ulong),
+            ("ullTotalPhys", ctypes.c_ulonglong),
+            ("ullAvailPhys", ctypes.c_ulonglong),
+            ("ullTotalPageFile", ctypes.c_ulonglong),
+            ("ullAvailPageFile", ctypes.c_ulonglong),
+            ("ullTotalVirtual", ctypes.c_ulonglong),
+            ("ullAvailVirtual", ctypes.c_ulonglong),
+            ("sullAvailExtendedVirtual", ctypes.c_ulonglong),
+        ]
+
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+    if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        return None
+    return status
+
+
+def _read_meminfo() -> dict:
+    values = {}
+    with open("/proc/meminfo", "r", encoding="utf-8") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            parts = rest.split()
+            if parts:
+                values[key] = int(parts[0]) * 1024  # Значения в kB
+    return values
+
+
+def get_total_memory_bytes() -> int | None:
+    """Объем физической памяти машины в байтах (None, если определить не удалось)."""
+    try:
+        if sys.platform == "win32":
+            status = _windows_memory_status()
+            return int(status.ullTotalPhys) if status else None
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError) as e:
+        logger.warning(f"Не удалось определить объем памяти: {e}")
+        return None
+
+
+def get_available_memory_bytes() -> int | None:
+    """Объем доступной (свободной + освобождаемой) памяти в байтах."""
+    try:
+        if sys.platform == "win32":
+            status = _windows_memory_status()
+            return int(status.ullAvailPhys) if status else None
+        if os.path.exists("/proc/meminfo"):
+            meminfo = _read_meminfo()
+            if "MemAvailable" in meminfo:
+                return meminfo["MemAvailable"]
+        # macOS и прочие: точного значения нет, берем число свободных страниц
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError) as e:
+        logger.warning(f"Не удалось определить объем доступной памяти: {e}")
+        return None
+
+
+def get_gpu_memory_bytes() -> int | None:
+    """Суммарный объем видеопамяти всех GPU (llama.cpp по умолчанию делит слои между ними); None без GPU."""
+    try:
+        import GPUtil
+        gpus = GPUtil.getGPUs()
+    except Exception as e:
+        logger.info(f"Не удалось определить GPU: {e}")
+        return None
+    if not gpus:
+        return None
+    return int(sum(gpu.memoryTotal for gpu in gpus) * 1024 * 1024)  # GPUtil отдает МБ
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import hashlib
+import platform
+import threading
+import logging
+from typing import Dict, List, Optional
+
+from backend.model_manager import USER_DATA_DIR, get_model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Текст для замера скорости обработки промпта; повторяем, чтобы набрать нужное число токенов
+CALIBRATION_TEXT = (
+    "NeuraBox runs large language models locally. The quick brown fox jumps over the lazy dog. "
+    "Local inference speed depends on memory bandwidth, thread count and batch size. "
+)
+PROMPT_TOKENS = 256
+DECODE_TOKENS = 32
+# "Типичный" ход диалога, по которому сравниваем конфигурации: длинный промпт + ответ
+TYPICAL_PROMPT_TOKENS = 512
+TYPICAL_DECODE_TOKENS = 256
+
+
+class CalibrationPreempted(Exception):
+    """Калибровку вытеснил интерактивный запрос (см. run_calibration, cancel_token)."""
+
+
+def get_machine_key() -> str:
+    """Короткий идентификатор машины: CPU, число потоков и видеокарты."""
+    gpu_names = []
+    try:
+        import GPUtil
+        gpu_names = [gpu.name for gpu in GPUtil.getGPUs()]
+    except Exception as e:
+        logger.warning(f"Не удалось получить список GPU для ключа машины: {e}")
+    description = "|".join([
+        platform.system(), platform.machine(), platform.processor(), str(os.cpu_count()), *gpu_names
+    ])
+    return hashlib.sha1(description.encode()).hexdigest()[:12]
+
+
+def _thread_candidates(quick: bool) -> List[int]:
+    cpu_count = os.cpu_count() or 2
+    fractions = [0.5, 1.0] if quick else [0.25, 0.5, 0.75, 1.0]
+    return sorted({max(1, int(cpu_count * fraction)) for fraction in fractions})
+
+
+class TuningStore:
+    """Лучшие найденные параметры инференса по ключу (отпечаток модели, машина)."""
+    STORE_PATH = os.path.join(USER_DATA_DIR, "inference_tuning.json")
+
+    def __init__(self, store_path: str | None = None):
+        self.store_path = store_path or self.STORE_PATH
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict] = {}
+        if os.path.exists(self.store_path):
+            try:
+                with open(self.store_path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать файл настроек инференса {self.store_path}: {e}")
+
+    @staticmethod
+    def make_key(model_path: str) -> str:
+        return f"{get_model_fingerprint(model_path)}:{get_machine_key()}"
+
+    def get(self, model_path: str) -> Optional[Dict]:
+        with self._lock:
+            return self._data.get(self.make_key(model_path))
+
+    def put(self, model_path: str, result: Dict):
+        with self._lock:
+            self._data[self.make_key(model_path)] = result
+            tmp_path = self.store_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.store_path)
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить настройки инференса {self.store_path}: {e}")
+
+    def all(self) -> Dict[str, Dict]:
+        with self._lock:
+            return dict(self._data)
+
+
+def benchmark_config(llama_cls, model_path: str, base_kwargs: Dict, params: Dict) -> Dict:
+    """Загружает модель с параметрами params и меряет скорость промпта и генерации (токенов/с)."""
+    llm = llama_cls(model_path=model_path, **{**base_kwargs, **params})
+    try:
+        tokens = llm.tokenize(CALIBRATION_TEXT.encode("utf-8"))
+        while len(tokens) < PROMPT_TOKENS:
+            tokens = tokens + tokens
+        tokens = tokens[:PROMPT_TOKENS]
+
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens)
+        prompt_seconds = time.perf_counter() - start
+
+        # generate переиспользует уже посчитанный префикс, так что дальше меряется только декодирование
+        start = time.perf_counter()
+        generated = 0
+        for _ in llm.generate(tokens, temp=0.0):
+            generated += 1
+            if generated >= DECODE_TOKENS:
+                break
+        decode_seconds = time.perf_counter() - start
+
+        prompt_tps = len(tokens) / prompt_seconds if prompt_seconds > 0 else 0.0
+        decode_tps = generated / decode_seconds if decode_seconds > 0 else 0.0
+        turn_seconds = (TYPICAL_PROMPT_TOKENS / prompt_tps if prompt_tps else float("inf")) + \
+                       (TYPICAL_DECODE_TOKENS / decode_tps if decode_tps else float("inf"))
+        return {
+            "params": params,
+            "prompt_tps": round(prompt_tps, 2),
+            "decode_tps": round(decode_tps, 2),
+            "turn_seconds": round(turn_seconds, 3),
+        }
+    finally:
+        del llm
+
+
+def run_calibration(llama_cls, model_path: str, base_kwargs: Dict, quick: bool = True,
+                    use_gpu: bool = False, progress: Optional[Dict] = None, cancel_token=None,
+                    finished_trials: Optional[Dict[str, Dict]] = None) -> Dict:
+    """Подбирает n_threads, n_threads_batch, n_batch, n_ubatch, flash_attn и use_mlock.
+
+    Полный перебор сетки означает десятки перезагрузок модели, поэтому ищем покоординатно:
+    сначала потоки (для декодирования и для промпта отдельно — им нужны разные значения),
+    потом размеры батчей при найденных потоках, потом флаги. Каждый этап фиксирует лучшее
+    значение и передает его следующему.
+
+    Если cancel_token (generation.CancellationToken) отменен, следующий замер не начинается —
+    бросаем CalibrationPreempted. Замеры копятся в finished_trials (ключ — параметры), так что
+    повторный вызов с тем же словарем продолжает с места остановки: поиск детерминирован
+    и пройдет по тем же точкам.
+    """
+    trials: List[Dict] = []
+
+    def run(params: Dict) -> Dict:
+        key = json.dumps(params, sort_keys=True)
+        if finished_trials is not None and key in finished_trials:
+            result = finished_trials[key]
+        else:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise CalibrationPreempted()
+            if progress is not None:
+                progress["current"] = params
+            result = benchmark_config(llama_cls, model_path, base_kwargs, params)
+            logger.info(f"Калибровка {params}: prompt {result['prompt_tps']} tok/s, "
+                        f"decode {result['decode_tps']} tok/s")
+            if finished_trials is not None:
+                finished_trials[key] = result
+        trials.append(result)
+        if progress is not None:
+            progress["trials"] = len(trials)
+        return result
+
+    best = {"n_threads": _thread_candidates(quick)[-1], "n_batch": 512, "n_ubatch": 512,
+            "flash_attn": False, "use_mlock": False}
+
+    # 1. Потоки: одна загрузка на значение, из нее берем и скорость промпта, и скорость декодирования
+    thread_results = [run({**best, "n_threads": n, "n_threads_batch": n}) for n in _thread_candidates(quick)]
+    best["n_threads"] = max(thread_results, key=lambda r: r["decode_tps"])["params"]["n_threads"]
+    best["n_threads_batch"] = max(thread_results, key=lambda r: r["prompt_tps"])["params"]["n_threads_batch"]
+
+    # 2. Батчи влияют только на обработку промпта
+    batch_grid = [(512, 512), (256, 256)] if quick else [(256, 256), (512, 256), (512, 512), (1024, 512), (2048, 512)]
+    batch_results = [run({**best, "n_batch": n_batch, "n_ubatch": n_ubatch}) for n_batch, n_ubatch in batch_grid]
+    best_batch = max(batch_results, key=lambda r: r["prompt_tps"])["params"]
+    best["n_batch"], best["n_ubatch"] = best_batch["n_batch"], best_batch["n_ubatch"]
+
+    # 3. Флаги сравниваем по времени типичного хода
+    flag_options = [{}]
+    if use_gpu:
+        flag_options.append({"flash_attn": True})
+    if not quick:
+        flag_options.append({"use_mlock": True})
+    flag_results = [run({**best, **flags}) for flags in flag_options]
+    winner = min(flag_results, key=lambda r: r["turn_seconds"])
+
+    return {
+        "params": winner["params"],
+        "prompt_tps": winner["prompt_tps"],
+        "decode_tps": winner["decode_tps"],
+        "turn_seconds": winner["turn_seconds"],
+        "model_path": model_path,
+        "machine": get_machine_key(),
+        "quick": quick,
+        "calibrated_at": time.time(),
+        "trials": trials,
+    }
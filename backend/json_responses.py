@@ -0,0 +1,99 @@
+import gzip
+import json
+import hashlib
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# orjson и brotli необязательны: без них ответы кодируются стандартным json и сжимаются только gzip
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024  # Маленькие ответы сжимать невыгодно: заголовки и CPU дороже экономии
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4  # Быстрые уровни: ответы сжимаются на каждый запрос, а не заранее
+
+
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+
+def dumps(content) -> bytes:
+    """JSON в байтах: orjson, если установлен (datetime он сериализует сам), иначе json."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+def make_etag(*parts) -> str:
+    """Слабый ETag из версии данных (например, last_modified_at и последнего message_id), а не из тела ответа."""
+    digest = hashlib.blake2b("\x1f".join(str(part) for part in parts).encode("utf-8"), digest_size=12)
+    return f'W/"{digest.hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Для GET сравнение слабое: W/"x" и "x" — одно и то же
+    tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in header.split(","))
+
+
+def _accepted_encodings(request: Request) -> set:
+    accepted = set()
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        name, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:  # q=0 означает "этот формат не присылать"
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def compress(request: Request, body: bytes) -> tuple:
+    """Сжимает тело по Accept-Encoding клиента; возвращает (тело, Content-Encoding или None)."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = _accepted_encodings(request)
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def json_response(request: Request, content, etag: Optional[str] = None, status_code: int = 200) -> Response:
+    """JSON-ответ без валидации через Pydantic, со сжатием и поддержкой If-None-Match.
+
+    Если etag совпал с тем, что прислал клиент, возвращает 304 и content не сериализует.
+    Сжатие делается здесь, а не общим middleware: потоковые ответы (/query/stream) сжимать нельзя,
+    иначе токены будут копиться в буфере компрессора.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = "no-cache"  # Кешировать можно, но только с перепроверкой
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+    body, encoding = compress(request, dumps(content))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Адаптеры лежат рядом с базовой моделью: models/<имя базы без .gguf>.lora/<адаптер>.gguf
+LORA_DIR_SUFFIX = ".lora"
+LORA_CACHE_SIZE = int(os.getenv("LORA_CACHE_SIZE", "4"))  # Сколько адаптеров держать загруженными на модель
+
+
+class LoraAdapterError(Exception):
+    pass
+
+
+def adapters_dir(model_path: str) -> str:
+    base, _ = os.path.splitext(model_path)
+    return base + LORA_DIR_SUFFIX
+
+
+def list_adapters(model_path: str) -> List[Dict]:
+    directory = adapters_dir(model_path)
+    if not os.path.isdir(directory):
+        return []
+    return [
+        {"name": name[:-len(".gguf")], "size_bytes": os.path.getsize(os.path.join(directory, name))}
+        for name in sorted(os.listdir(directory)) if name.endswith(".gguf")
+    ]
+
+
+def adapter_path(model_path: str, name: str) -> str:
+    """Путь к адаптеру по имени; имя — только имя файла, без подпапок."""
+    if not name or os.path.basename(name) != name or name.startswith("."):
+        raise LoraAdapterError(f"Некорректное имя адаптера: {name}")
+    path = os.path.join(adapters_dir(model_path), name + ".gguf")
+    if not os.path.isfile(path):
+        raise LoraAdapterError(f"Адаптер {name} не найден для модели {os.path.basename(model_path)}.")
+    return path
+
+
+def _lora_api():
+    """Функции llama.cpp для LoRA; в llama.cpp их переименовывали, поддерживаем оба варианта имен."""
+    import llama_cpp
+
+    def pick(*names):
+        for name in names:
+            if hasattr(llama_cpp, name):
+                return getattr(llama_cpp, name)
+        raise LoraAdapterError("Эта версия llama-cpp-python не поддерживает LoRA-адаптеры.")
+
+    return {
+        "init": pick("llama_adapter_lora_init", "llama_lora_adapter_init"),
+        "set": pick("llama_set_adapter_lora", "llama_lora_adapter_set"),
+        "remove": pick("llama_rm_adapter_lora", "llama_lora_adapter_remove"),
+        "free": pick("llama_adapter_lora_free", "llama_lora_adapter_free"),
+    }
+
+
+class LoraAdapterSet:
+    """Адаптеры одной загруженной модели: LRU-кеш загруженных и текущий активный.
+
+    Смена адаптера не трогает веса базы: старый снимается с контекста, новый (из кеша или
+    с диска — он в разы меньше модели) навешивается. KV-кеш после этого сбрасывается: префикс,
+    посчитанный с другим адаптером, переиспользовать нельзя.
+    """
+
+    def __init__(self, llm, cache_size: int = LORA_CACHE_SIZE):
+        self.llm = llm
+        self.cache_size = max(1, cache_size)
+        self._adapters: "OrderedDict[str, object]" = OrderedDict()
+        self._active: Optional[tuple] = None  # (имя, масштаб)
+
+    def _load(self, name: str, api: Dict):
+        if name in self._adapters:
+            self._adapters.move_to_end(name)
+            return self._adapters[name]
+        path = adapter_path(self.llm.model_path, name)
+        handle = api["init"](self.llm._model.model, path.encode("utf-8"))
+        if not handle:
+            raise LoraAdapterError(f"llama.cpp не смог загрузить адаптер {name}.")
+        self._adapters[name] = handle
+        while len(self._adapters) > self.cache_size:
+            evicted_name, evicted = next(iter(self._adapters.items()))
+            if self._active and self._active[0] == evicted_name:
+                self._adapters.move_to_end(evicted_name)
+                continue
+            del self._adapters[evicted_name]
+            api["free"](evicted)
+        return handle
+
+    def apply(self, name: Optional[str], scale: float = 1.0) -> Optional[float]:
+        """Делает активным адаптер name (None — чистая база). Возвращает время смены в секундах или None."""
+        wanted = (name, scale) if name else None
+        if wanted == self._active:
+            return None
+        start = time.perf_counter()
+        api = _lora_api()
+        ctx = self.llm._ctx.ctx
+        if self._active:
+            api["remove"](ctx, self._adapters[self._active[0]])
+            self._active = None
+        if wanted:
+            handle = self._load(name, api)
+            if api["set"](ctx, handle, scale) != 0:
+                raise LoraAdapterError(f"Не удалось применить адаптер {name}.")
+            self._active = wanted
+        self.llm.reset()  # Токены в контексте посчитаны с прежним адаптером
+        return time.perf_counter() - start
+
+    def close(self):
+        """Снимает активный адаптер и освобождает загруженные; до освобождения модели — они привязаны к ее весам."""
+        if not self._adapters:
+            return
+        api = _lora_api()
+        if self._active:
+            api["remove"](self.llm._ctx.ctx, self._adapters[self._active[0]])
+            self._active = None
+        for handle in self._adapters.values():
+            api["free"](handle)
+        self._adapters.clear()
+
+    @property
+    def active(self) -> Optional[str]:
+        return self._active[0] if self._active else None
+
+
+_adapter_sets: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_adapter_sets_lock = threading.Lock()
+
+
+def apply_adapter(llm, name: Optional[str], scale: float = 1.0) -> Optional[float]:
+    """Включает адаптер на модели перед генерацией; вызывается под тем же lock, что и генерация."""
+    with _adapter_sets_lock:
+        adapter_set = _adapter_sets.get(llm)
+        if adapter_set is None:
+            if not name:
+                return None  # Адаптеры на этой модели еще не включали — база чистая
+            adapter_set = _adapter_sets[llm] = LoraAdapterSet(llm)
+    return adapter_set.apply(name, scale)
+
+
+def release_adapters(llm):
+    """Освобождает адаптеры модели перед ее выгрузкой или перезагрузкой.
+
+    Вместе с Llama они не освобождаются: хэндлы llama.cpp живут, пока их не освободят явно.
+    Вызывается под тем же lock, что и генерация.
+    """
+    with _adapter_sets_lock:
+        adapter_set = _adapter_sets.pop(llm, None)
+    if adapter_set is not None:
+        adapter_set.close()
+
+
+class LoraStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"switches": 0, "switch_seconds": 0.0, "max_switch_seconds": 0.0}
+
+    def record(self, switch_seconds: Optional[float]):
+        if switch_seconds is None:
+            return
+        with self._lock:
+            self._stats["switches"] += 1
+            self._stats["switch_seconds"] += switch_seconds
+            self._stats["max_switch_seconds"] = max(self._stats["max_switch_seconds"], switch_seconds)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            switches = self._stats["switches"]
+            return {
+                "switches": switches,
+                "avg_switch_ms": round(self._stats["switch_seconds"] / switches * 1000, 2) if switches else 0.0,
+                "max_switch_ms": round(self._stats["max_switch_seconds"] * 1000, 2),
+            }
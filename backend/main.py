@@ -2,7 +2,8 @@ import os
 import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from backend.api.api import router as api_router
+from backend.api.api import router as api_router, start_model_preload
+from backend.api.openai_compat import router as openai_router
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,11 +18,26 @@ app.add_middleware(
 )
 
 app.include_router(api_router, prefix="/api")
+app.include_router(openai_router, prefix="/v1")  # OpenAI-совместимый API для внутренних инструментов
+
+@app.on_event("startup")
+async def preload_models():
+    # Прогреваем недавние модели в фоне, чтобы первый /query после рестарта не ждал загрузку
+    start_model_preload()
 
 @app.get("/")
 async def root():
     return {"message": "LLM Research API is running!"}
 
 if __name__ == "__main__":
+    import argparse
+    import multiprocessing
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=9015)
\ No newline at end of file
+    # Нужно для процессов-воркеров моделей (NEURABOX_WORKER_MODE=process) в собранном backend.exe
+    multiprocessing.freeze_support()
+    # Порт можно переопределить, чтобы поднять несколько узлов за шлюзом (backend/gateway.py)
+    parser = argparse.ArgumentParser(description="NeuraBox backend")
+    parser.add_argument("--host", default=os.getenv("NEURABOX_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("NEURABOX_PORT", "9015")))
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
@@ -1,10 +1,18 @@
 import os
+import glob
+import json
 import time
+import atexit
+import hashlib
+import threading
 import platformdirs
-from typing import List, Dict
+from typing import Callable, Iterable, List, Dict, Optional
 from huggingface_hub import HfApi, hf_hub_download, ModelInfo  # Добавил ModelInfo для аннотации
 import re
 
+from backend import quant_selection, tracing
+from backend.lora import LORA_DIR_SUFFIX
+
 APP_NAME = "NeuraBox"
 APP_AUTHOR = "NeuraBoxTeam"
 
@@ -12,6 +20,405 @@ APP_AUTHOR = "NeuraBoxTeam"
 USER_DATA_DIR = platformdirs.user_data_dir(APP_NAME, APP_AUTHOR)
 
 
+FINGERPRINT_CHUNK_SIZE = 4 * 1024 * 1024
+_fingerprint_cache: Dict[tuple, str] = {}
+# Время последнего использования моделей меняется на каждом запросе, а на диск пишется не чаще этого
+USAGE_FLUSH_INTERVAL = float(os.getenv("MODEL_USAGE_FLUSH_SECONDS", "30"))
+
+
+def start_periodic_flush(flush: Callable[[], None], name: str):
+    """Фоновый поток, который раз в USAGE_FLUSH_INTERVAL секунд вызывает flush, и еще один flush при выходе."""
+    def loop():
+        while True:
+            time.sleep(USAGE_FLUSH_INTERVAL)
+            flush()
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    atexit.register(flush)
+
+
+def get_model_fingerprint(model_path: str) -> str:
+    """Быстрый отпечаток GGUF-файла: sha256 от размера, заголовка и хвоста файла.
+
+    Полный хеш многогигабайтного файла считается десятки секунд, а заголовок GGUF
+    (метаданные, словарь) плюс хвост тензоров надежно различают модели и кванты.
+    Результат кешируется по (путь, размер, mtime).
+    """
+    stat = os.stat(model_path)
+    cache_key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    cached = _fingerprint_cache.get(cache_key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256(str(stat.st_size).encode())
+    with open(model_path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        if stat.st_size > 2 * FINGERPRINT_CHUNK_SIZE:
+            f.seek(-FINGERPRINT_CHUNK_SIZE, os.SEEK_END)
+            digest.update(f.read(FINGERPRINT_CHUNK_SIZE))
+    fingerprint = digest.hexdigest()[:16]
+    _fingerprint_cache[cache_key] = fingerprint
+    return fingerprint
+
+
+class ModelUsageLog:
+    """Журнал использования моделей: когда и сколько раз каждая модель запускалась.
+
+    Хранится в JSON рядом с базой чатов и переживает перезапуск бэкенда,
+    поэтому по нему можно понять, какие модели прогревать при старте. record вызывается
+    на каждый запрос (в том числе из event loop), поэтому только меняет словарь в памяти,
+    а файл переписывается фоновым сбросом (flush).
+    """
+    LOG_PATH = os.path.join(USER_DATA_DIR, "model_usage.json")
+
+    def __init__(self, log_path: str | None = None):
+        self.log_path = log_path or self.LOG_PATH
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = self._load()
+        self._dirty = False
+        self._flush_started = False
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.log_path):
+            return {}
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать журнал использования моделей {self.log_path}: {e}")
+            return {}
+
+    def _save(self):
+        # Пишем во временный файл и атомарно подменяем, чтобы не получить битый JSON при падении
+        self._dirty = False
+        tmp_path = self.log_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.log_path)
+        except OSError as e:
+            print(f"Не удалось сохранить журнал использования моделей {self.log_path}: {e}")
+
+    def record(self, model_name: str, model_path: str):
+        with self._lock:
+            entry = self._entries.setdefault(model_name, {"use_count": 0})
+            entry["model_path"] = model_path
+            entry["last_used"] = time.time()
+            entry["use_count"] = entry.get("use_count", 0) + 1
+            self._dirty = True
+            if not self._flush_started:
+                self._flush_started = True
+                start_periodic_flush(self.flush, "model-usage-flush")
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def recent(self, limit: int | None = None) -> List[Dict]:
+        """Возвращает записи, отсортированные от последней использованной к самой старой."""
+        with self._lock:
+            entries = [{"name": name, **entry} for name, entry in self._entries.items()]
+        entries.sort(key=lambda e: e.get("last_used", 0), reverse=True)
+        return entries[:limit] if limit else entries
+
+
+class ModelStoreQuotaError(Exception):
+    """Новой модели не хватает места в квоте, а автоматическое вытеснение выключено или не помогает."""
+
+    def __init__(self, message: str, suggestions: List[Dict]):
+        super().__init__(message)
+        self.suggestions = suggestions
+
+
+def find_hf_cache_blob(sha256: str) -> Optional[str]:
+    """Ищет файл с таким sha256 в blob-хранилище кеша Hugging Face (~/.cache/huggingface/hub).
+
+    LFS-файлы там лежат как models--<org>--<repo>/blobs/<sha256>, так что тот же GGUF,
+    скачанный другим инструментом, находится без чтения содержимого.
+    """
+    try:
+        from huggingface_hub.constants import HF_HUB_CACHE
+    except ImportError:
+        return None
+    matches = glob.glob(os.path.join(HF_HUB_CACHE, "models--*", "blobs", sha256))
+    return matches[0] if matches else None
+
+
+def link_file(source: str, dest: str) -> bool:
+    """Заменяет dest жесткой ссылкой на source. False, если ссылку сделать нельзя (другой диск, FAT и т.п.)."""
+    tmp_path = dest + ".link.tmp"
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.link(source, tmp_path)
+        os.replace(tmp_path, dest)
+        return True
+    except OSError as e:
+        print(f"Не удалось создать жесткую ссылку {dest} -> {source}: {e}")
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+
+class ModelStore:
+    """Учет GGUF-файлов в MODELS_DIR: квота на диск, последнее использование, закрепление, дедупликация.
+
+    Список установленных файлов читается с диска один раз (scan) и дальше обновляется
+    при скачивании и удалении, поэтому флаги installed в каталоге не требуют обхода папки.
+    Индекс (sha256, last_used, pinned) хранится в model_store.json. last_used (touch) обновляется
+    на каждую генерацию только в памяти: на диск он попадает с любой другой записью индекса
+    (в том числе при вытеснении) или фоновым сбросом (flush).
+    """
+    INDEX_PATH = os.path.join(USER_DATA_DIR, "model_store.json")
+
+    def __init__(self, models_dir: str, quota_bytes: int | None = None, auto_evict: bool = False,
+                 index_path: str | None = None):
+        self.models_dir = models_dir
+        self.quota_bytes = quota_bytes
+        self.auto_evict = auto_evict
+        self.index_path = index_path or self.INDEX_PATH
+        self._lock = threading.RLock()
+        self._index: Dict[str, Dict] = self._load()
+        self._installed: set = set()
+        self._dirty = False
+        self._flush_started = False
+        self.scan()
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать индекс моделей {self.index_path}: {e}")
+            return {}
+
+    def _save(self):
+        self._dirty = False
+        tmp_path = self.index_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Не удалось сохранить индекс моделей {self.index_path}: {e}")
+
+    def file_name_for(self, model_path: str) -> str:
+        """Имя файла в индексе — путь относительно папки моделей (части split-GGUF бывают в подпапках)."""
+        return os.path.relpath(model_path, self.models_dir).replace(os.sep, "/")
+
+    def scan(self):
+        """Синхронизирует индекс с папкой (при старте и при полном обновлении каталога)."""
+        files = set()
+        for root, dirs, names in os.walk(self.models_dir):
+            # .cache от hf_hub_download; <модель>.lora — адаптеры, а не самостоятельные модели
+            dirs[:] = [d for d in dirs if not d.startswith(".") and not d.endswith(LORA_DIR_SUFFIX)]
+            files.update(self.file_name_for(os.path.join(root, name)) for name in names if name.endswith(".gguf"))
+        with self._lock:
+            self._installed = files
+            for file_name in files:
+                self._index.setdefault(file_name, {"installed_at": time.time(), "last_used": 0,
+                                                   "pinned": False, "sha256": None})
+            # Закрепление и sha256 удаленных вручную файлов больше не нужны
+            for file_name in [f for f in self._index if f not in files]:
+                del self._index[file_name]
+            self._save()
+
+    def is_installed(self, file_name: str) -> bool:
+        with self._lock:
+            return file_name in self._installed
+
+    def installed_files(self) -> List[str]:
+        with self._lock:
+            return sorted(self._installed)
+
+    def add(self, file_name: str, sha256: str | None = None):
+        with self._lock:
+            self._installed.add(file_name)
+            entry = self._index.setdefault(file_name, {"last_used": 0, "pinned": False})
+            entry["installed_at"] = time.time()
+            entry["sha256"] = sha256 or entry.get("sha256")
+            self._save()
+
+    def remove(self, file_name: str):
+        with self._lock:
+            for part in quant_selection.shard_file_names(file_name):
+                self._installed.discard(part)
+                self._index.pop(part, None)
+            self._save()
+
+    def touch(self, file_name: str):
+        with self._lock:
+            if file_name in self._index:
+                self._index[file_name]["last_used"] = time.time()
+                self._dirty = True
+                if not self._flush_started:
+                    self._flush_started = True
+                    start_periodic_flush(self.flush, "model-store-flush")
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def set_pinned(self, file_name: str, pinned: bool) -> bool:
+        with self._lock:
+            if file_name not in self._index:
+                return False
+            self._index[file_name]["pinned"] = pinned
+            self._save()
+            return True
+
+    def find_by_sha256(self, sha256: str) -> Optional[str]:
+        with self._lock:
+            for file_name, entry in self._index.items():
+                if entry.get("sha256") == sha256 and file_name in self._installed:
+                    return os.path.join(self.models_dir, file_name)
+        return None
+
+    def link_existing_copy(self, sha256: str | None, dest: str) -> bool:
+        """Если такой же файл уже есть (в кеше HF или под другим именем в папке), ставит на него жесткую ссылку."""
+        if not sha256:
+            return False
+        source = self.find_by_sha256(sha256) or find_hf_cache_blob(sha256)
+        if not source or os.path.abspath(source) == os.path.abspath(dest):
+            return False
+        if os.path.exists(dest) and os.path.samefile(source, dest):
+            return True
+        linked = link_file(source, dest)
+        if linked:
+            print(f"{os.path.basename(dest)}: вместо копии создана жесткая ссылка на {source}.")
+        return linked
+
+    def _file_stats(self) -> List[Dict]:
+        """Статистика по моделям; части split-GGUF собираются в одну запись по первой части."""
+        stats: Dict[str, Dict] = {}
+        with self._lock:
+            items = [(f, dict(self._index.get(f, {}))) for f in self._installed]
+        for file_name, entry in sorted(items):
+            try:
+                st = os.stat(os.path.join(self.models_dir, file_name))
+            except OSError:
+                continue
+            primary = quant_selection.shard_file_names(file_name)[0]
+            model = stats.setdefault(primary, {
+                "file_name": primary,
+                "size": 0,
+                "inodes": {},
+                # Файл, связанный ссылкой с кешем HF, при удалении отсюда место на диске не освободит
+                "hardlinks": st.st_nlink,
+                "last_used": 0,
+                "pinned": False,
+                "sha256": None,
+                "parts": 0,
+            })
+            model["size"] += st.st_size
+            model["inodes"][(st.st_dev, st.st_ino)] = st.st_size
+            model["parts"] += 1
+            if file_name == primary:
+                model.update(last_used=entry.get("last_used", 0), pinned=entry.get("pinned", False),
+                             sha256=entry.get("sha256"))
+        return list(stats.values())
+
+    @staticmethod
+    def _usage(stats: List[Dict]) -> int:
+        # Жесткие ссылки внутри папки занимают место один раз
+        inodes = {}
+        for s in stats:
+            inodes.update(s["inodes"])
+        return sum(inodes.values())
+
+    def eviction_candidates(self, needed_bytes: int = 0, protected: Iterable[str] = ()) -> List[Dict]:
+        """Давно не использованные незакрепленные модели, удаление которых освобождает needed_bytes в квоте."""
+        if self.quota_bytes is None:
+            return []
+        stats = self._file_stats()
+        overflow = self._usage(stats) + needed_bytes - self.quota_bytes
+        if overflow <= 0:
+            return []
+        protected = set(protected)
+        candidates = sorted((s for s in stats if not s["pinned"] and s["file_name"] not in protected),
+                            key=lambda s: s["last_used"])
+        selected = []
+        for candidate in candidates:
+            if overflow <= 0:
+                break
+            selected.append(candidate)
+            overflow -= candidate["size"]
+        return [{k: v for k, v in s.items() if k != "inodes"} for s in selected]
+
+    def make_room(self, needed_bytes: int, protected: Iterable[str] = ()) -> List[str]:
+        """Освобождает место под файл размера needed_bytes: вытесняет по LRU или бросает ModelStoreQuotaError."""
+        if self.quota_bytes is None:
+            return []
+        usage = self._usage(self._file_stats())
+        if usage + needed_bytes <= self.quota_bytes:
+            return []
+        candidates = self.eviction_candidates(needed_bytes, protected)
+        freed = sum(c["size"] for c in candidates)
+        if not self.auto_evict or usage + needed_bytes - freed > self.quota_bytes:
+            raise ModelStoreQuotaError(
+                f"Не хватает места в квоте моделей ({self.quota_bytes / 1024 ** 3:.1f} GB): "
+                f"нужно {needed_bytes / 1024 ** 3:.2f} GB.", candidates)
+        evicted = []
+        for candidate in candidates:
+            if self.delete_file(candidate["file_name"]):
+                print(f"Модель {candidate['file_name']} вытеснена из хранилища (LRU, квота).")
+                evicted.append(candidate["file_name"])
+        return evicted
+
+    def delete_file(self, file_name: str) -> bool:
+        """Удаляет модель (все части, если это split-GGUF)."""
+        for part in quant_selection.shard_file_names(file_name):
+            local_path = os.path.join(self.models_dir, part)
+            try:
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+            except OSError as e:
+                print(f"Ошибка при удалении файла {local_path}: {e}")
+                return False
+        self.remove(file_name)
+        return True
+
+    def stats(self) -> Dict:
+        stats = self._file_stats()
+        return {
+            "quota_bytes": self.quota_bytes,
+            "used_bytes": self._usage(stats),
+            "auto_evict": self.auto_evict,
+            "files": [{k: v for k, v in s.items() if k != "inodes"}
+                      for s in sorted(stats, key=lambda s: s["last_used"], reverse=True)],
+            "eviction_suggestions": self.eviction_candidates(),
+        }
+
+
+_model_store: Optional[ModelStore] = None
+_model_store_lock = threading.Lock()
+
+
+def get_model_store() -> ModelStore:
+    """Общий ModelStore процесса (ModelManager пересоздается при смене токена, а индекс — один)."""
+    global _model_store
+    with _model_store_lock:
+        if _model_store is None:
+            quota_gb = os.getenv("MODELS_DISK_QUOTA_GB")
+            _model_store = ModelStore(
+                ModelManager.MODELS_DIR,
+                quota_bytes=int(float(quota_gb) * 1024 ** 3) if quota_gb else None,
+                auto_evict=os.getenv("MODELS_AUTO_EVICT", "0") == "1",
+            )
+        return _model_store
+
+
 class ModelManager:
     MODELS_DIR = os.path.join(USER_DATA_DIR, "models")
     CACHE_TIME = 1800  # 30 минут кеширования
@@ -20,7 +427,11 @@ class ModelManager:
         self.hf_token = hf_token  # <--- ДОБАВЛЕНА ЭТА СТРОКА
         self.api = HfApi(token=self.hf_token) if self.hf_token else HfApi()  # Можно использовать self.hf_token
         self.cache: Dict = {"models": [], "last_update": 0}  # Добавил аннотацию типа
+        # Версия каталога для ETag ответа /models: растет при любом изменении cache["models"].
+        # Начинается со времени создания, чтобы не совпасть после перезапуска или смены токена
+        self.catalog_version = time.time_ns()
         self.ensure_models_dir()
+        self.store = get_model_store()
 
     def ensure_models_dir(self):
         # Создаем папку MODELS_DIR (e.g., %APPDATA%\NeuraBox\models), если ее нет
@@ -66,6 +477,7 @@ class ModelManager:
             print(f"Файл {model_info['file_name']} для модели {model_name} не найден в {self.MODELS_DIR}.")
             return None  # Возвращаем None
 
+    @tracing.traced("get_available_models")
     def get_available_models(self) -> List[Dict]:
         current_time = time.time()
         models_output: List[Dict] = []  # Используем новый список для вывода
@@ -73,21 +485,26 @@ class ModelManager:
         # Проверяем кеш
         if self.cache["models"] and (current_time - self.cache["last_update"] < self.CACHE_TIME):
             print(f"Возвращаем кешированные модели ({len(self.cache['models'])} шт.)")
-            # Перед возвратом кеша проверим актуальность поля 'installed'
+            # Перед возвратом кеша проверим актуальность поля 'installed' (по индексу, без обращения к диску)
             for model in self.cache["models"]:
                 if model.get("file_name"):  # Проверяем только если есть имя файла
-                    local_path = os.path.join(self.MODELS_DIR, model["file_name"])
-                    model["installed"] = os.path.exists(local_path)
+                    installed = self.store.is_installed(model["file_name"])
+                    if model.get("installed") != installed:
+                        model["installed"] = installed
+                        self.catalog_version += 1
             return self.cache["models"]
 
         print("Обновление списка моделей...")
         # Используем set для отслеживания добавленных репозиториев/файлов, чтобы избежать дубликатов
         added_identifiers = set()
 
-        # 1. Локальные модели
+        # 1. Локальные модели (полное обновление заодно подхватывает файлы, добавленные в папку вручную)
         try:
-            for file in os.listdir(self.MODELS_DIR):
-                if file.endswith(".gguf"):
+            with tracing.span("model_store.scan"):
+                self.store.scan()
+            for file in self.store.installed_files():
+                # Вторая и следующие части split-GGUF — это та же модель, что и первая часть
+                if file.endswith(".gguf") and not quant_selection.is_secondary_shard(file):
                     # Проверяем, не добавляли ли уже модель с таким именем файла
                     if file not in added_identifiers:
                         metadata = self.get_model_metadata(file)
@@ -104,6 +521,7 @@ class ModelManager:
 
         # 2. Модели с Hugging Face
         try:
+            budget = quant_selection.get_memory_budget()  # Один раз на обновление, а не на каждый репозиторий
             # Ищем модели с тегом 'gguf'
             hf_models_iterator = self.api.list_models(
                 filter="gguf",
@@ -121,22 +539,24 @@ class ModelManager:
 
                 try:
                     print(f"Обработка HF модели: {model.id}")
-                    # Получаем информацию о модели (может быть медленно для многих моделей)
-                    model_info: ModelInfo = self.api.model_info(model.id)
-                    # Ищем GGUF файл в репозитории
-                    file_name = self.get_gguf_filename(model.id)
+                    # Один запрос на репозиторий: размеры файлов приходят вместе с информацией о модели,
+                    # отдельные list_repo_files и HEAD на каждый файл не нужны
+                    with tracing.span("hf.model_info", repo_id=model.id):
+                        model_info: ModelInfo = self.api.model_info(model.id, files_metadata=True)
+                    variant = self.select_repo_variant(model_info, budget=budget)
+                    file_name = variant["file_name"] if variant else None
 
                     if file_name:
                         # Проверяем, не добавляли ли модель с таким же именем файла (из локальных)
                         if file_name not in added_identifiers:
-                            metadata = self.get_hf_model_metadata(model_info, file_name)
-                            local_path = os.path.join(self.MODELS_DIR, file_name)
+                            metadata = self.get_hf_model_metadata(model_info, file_name, variant["size_bytes"])
                             models_output.append({
                                 "name": model.id,  # Имя = repo_id для HF моделей
                                 "repo_id": model.id,
                                 "file_name": file_name,
-                                "installed": os.path.exists(local_path),
-                                **metadata
+                                "installed": self.store.is_installed(file_name),
+                                **metadata,
+                                **self.describe_variant(variant),
                             })
                             added_identifiers.add(model.id)  # Добавляем repo_id
                             added_identifiers.add(file_name)  # Добавляем и имя файла
@@ -160,36 +580,68 @@ class ModelManager:
         # Обновляем кеш
         self.cache["models"] = models_output
         self.cache["last_update"] = current_time
+        self.catalog_version += 1
         print(f"Список моделей обновлен. Всего: {len(models_output)} моделей.")
         return models_output
 
+    def select_repo_variant(self, model_info: ModelInfo, budget: Dict | None = None,
+                            quant: str | None = None) -> Dict | None:
+        """Вариант (квант) модели для этой машины; уже установленный вариант важнее подобранного.
+
+        model_info должен быть получен с files_metadata=True, иначе размеры файлов неизвестны.
+        """
+        variants = quant_selection.group_variants([(s.rfilename, s.size) for s in model_info.siblings or []])
+        if not quant:
+            installed = [v for v in variants if all(self.store.is_installed(f) for f in v["files"])]
+            if installed:
+                quant = installed[0]["quant"]
+        return quant_selection.select_variant(variants, budget=budget, quant=quant)
+
+    @staticmethod
+    def describe_variant(variant: Dict) -> Dict:
+        """Поля каталога про выбранный квант и альтернативы (с оценкой скорости и памяти)."""
+        def short(v: Dict) -> Dict:
+            return {
+                "quant": v["quant"],
+                "file_name": v["file_name"],
+                "parts": len(v["files"]),
+                "size_bytes": v["size_bytes"],
+                "memory_bytes": v["memory_bytes"],
+                "fits": v["fits"],
+                "estimated_tokens_per_second": v["estimated_tokens_per_second"],
+            }
+
+        return {
+            **short(variant),
+            "target": variant["target"],
+            "alternatives": [short(v) for v in variant["alternatives"]],
+        }
+
     def get_gguf_filename(self, repo_id: str) -> str | None:  # Может вернуть None
         try:
-            files = self.api.list_repo_files(repo_id, repo_type="model")  # Уточняем тип репозитория
-            # Ищем файлы .gguf, отдаем предпочтение большим файлам или файлам с квантованием Q4_K_M/Q5_K_M
-            gguf_files = [f for f in files if f.endswith(".gguf")]
-            if not gguf_files:
-                return None
-
-            # Приоритеты квантования (можно настроить)
-            preferred_quants = ["Q5_K_M", "Q4_K_M", "Q8_0"]
-            for quant in preferred_quants:
-                for f in gguf_files:
-                    if quant in f.upper():
-                        return f
-
-            # Если не нашли предпочтительные, возвращаем первый попавшийся
-            return gguf_files[0]
-
+            model_info: ModelInfo = self.api.model_info(repo_id, files_metadata=True)
+            variant = self.select_repo_variant(model_info)
+            return variant["file_name"] if variant else None
         except Exception as e:
             print(f"Ошибка при поиске файлов в {repo_id}: {e}")
             return None
 
+    @staticmethod
+    def format_size(size_bytes: int) -> str:
+        if size_bytes > 1024 * 1024 * 1024:  # GB
+            return f"{size_bytes / (1024 ** 3):.2f} GB"
+        elif size_bytes > 0:  # MB
+            return f"{size_bytes / (1024 ** 2):.1f} MB"
+        return "Unknown Size"
+
     def get_file_size(self, repo_id: str | None, file_name: str) -> str:
         local_path = os.path.join(self.MODELS_DIR, file_name)
         if os.path.exists(local_path):
             try:
-                size_bytes = os.path.getsize(local_path)
+                # У split-GGUF размер модели — сумма всех частей
+                size_bytes = sum(os.path.getsize(os.path.join(self.MODELS_DIR, part))
+                                 for part in quant_selection.shard_file_names(file_name)
+                                 if os.path.exists(os.path.join(self.MODELS_DIR, part)))
                 if size_bytes > 1024 * 1024 * 1024:  # GB
                     return f"{size_bytes / (1024 ** 3):.2f} GB"
                 else:  # MB
@@ -241,7 +693,7 @@ class ModelManager:
 
         return {"parameters": parameters, "type": type_guess, "size": size}
 
-    def get_hf_model_metadata(self, model_info: ModelInfo, file_name: str) -> Dict:
+    def get_hf_model_metadata(self, model_info: ModelInfo, file_name: str, size_bytes: int | None = None) -> Dict:
         # Параметры
         parameters = "?"
         try:  # Обернем в try-except на случай отсутствия полей
@@ -311,8 +763,8 @@ class ModelManager:
             print(f"Ошибка определения типа для {model_info.id}: {e}")
             model_type = "?"
 
-        # Размер файла
-        size = self.get_file_size(model_info.id, file_name)
+        # Размер файла (если размер уже известен из метаданных репозитория, HEAD-запрос не нужен)
+        size = self.format_size(size_bytes) if size_bytes else self.get_file_size(model_info.id, file_name)
 
         return {
             "parameters": parameters,
@@ -320,56 +772,109 @@ class ModelManager:
             "size": size
         }
 
-    def download_model(self, model_repo_id: str) -> str:  # Принимаем repo_id
+    def set_installed(self, file_name: str, installed: bool):
+        """Обновляет флаг installed в кеше каталога без повторного обхода папки."""
+        for model in self.cache["models"]:
+            if model.get("file_name") == file_name:
+                model["installed"] = installed
+        self.catalog_version += 1
+
+    def mark_repo_installed(self, repo_id: str, variant: Dict):
+        """В каталоге модель из репозитория теперь указывает на установленный вариант."""
+        self.set_installed(variant["file_name"], True)
+        for model in self.cache["models"]:
+            if model.get("repo_id") == repo_id:
+                model.update(file_name=variant["file_name"], installed=True, **self.describe_variant(variant))
+        self.catalog_version += 1
+
+    @tracing.traced("download_model")
+    def download_model(self, model_repo_id: str, protected: Iterable[str] = (),
+                       quant: str | None = None) -> str:  # Принимаем repo_id
+        """Скачивает GGUF из репозитория и возвращает путь к нему (к первой части, если модель разбита).
+
+        quant — конкретный квант; по умолчанию лучший, помещающийся в память машины.
+        protected — файлы, которые нельзя вытеснять по квоте (например, загруженная модель).
+        """
+        file_name = None
+        local_path = None
         # Получаем актуальную информацию о модели с HF
         try:
-            model_info: ModelInfo = self.api.model_info(model_repo_id)
-            file_name = self.get_gguf_filename(model_repo_id)
+            # files_metadata=True дает размер и sha256 файлов — для выбора кванта, квоты и дедупликации
+            with tracing.span("hf.model_info", repo_id=model_repo_id):
+                model_info: ModelInfo = self.api.model_info(model_repo_id, files_metadata=True)
+            variant = self.select_repo_variant(model_info, quant=quant)
 
-            if not file_name:
+            if not variant:
                 raise ValueError(f"Не найден GGUF файл в репозитории {model_repo_id}.")
+            if quant and variant["quant"] != quant.upper():
+                raise ValueError(f"Квант {quant} не найден в репозитории {model_repo_id}.")
 
+            file_name = variant["file_name"]
             local_path = os.path.join(self.MODELS_DIR, file_name)
+            siblings = {s.rfilename: s for s in model_info.siblings or []}
 
-            if os.path.exists(local_path):
-                print(f"Модель {model_repo_id} (файл {file_name}) уже загружена в {self.MODELS_DIR}.")
-                # Обновим статус в кеше, если модель есть в кеше
-                for model in self.cache["models"]:
-                    if model.get("repo_id") == model_repo_id or model.get("file_name") == file_name:
-                        model["installed"] = True
-                return local_path
+            def sha256_of(part: str) -> str | None:
+                lfs = getattr(siblings.get(part), "lfs", None) or {}
+                return lfs.get("sha256") if isinstance(lfs, dict) else getattr(lfs, "sha256", None)
 
-            print(f"Скачивание файла {file_name} из репозитория {model_repo_id} в {self.MODELS_DIR}...")
+            print(f"Выбран вариант {variant['quant']} ({self.format_size(variant['size_bytes'])}, "
+                  f"частей: {len(variant['files'])}) для {model_repo_id}.")
             # Убедимся, что директория существует
             self.ensure_models_dir()
 
-            # Скачиваем файл напрямую в нужную директорию
-            downloaded_path = hf_hub_download(
-                repo_id=model_repo_id,
-                filename=file_name,
-                local_dir=self.MODELS_DIR,
-                local_dir_use_symlinks=False  # Важно: скачивать напрямую, а не симлинки
-            )
-
-            # Проверяем, совпадает ли скачанный путь с ожидаемым
-            if downloaded_path != local_path:
-                print(f"Предупреждение: Файл скачан в {downloaded_path}, ожидался {local_path}")
-                # Попытка переименовать/переместить, если возможно
-                # Но hf_hub_download с local_dir должен скачивать правильно
-                # Возможно, стоит проверить права доступа?
-
-            print(f"Модель {model_repo_id} (файл {file_name}) успешно загружена в {downloaded_path}.")
+            missing = []
+            for part in variant["files"]:
+                part_path = os.path.join(self.MODELS_DIR, part)
+                if os.path.exists(part_path):
+                    self.store.add(part, sha256_of(part))
+                # Тот же файл уже лежит в кеше HF или под другим именем — ссылка вместо второй копии
+                elif self.store.link_existing_copy(sha256_of(part), part_path):
+                    self.store.add(part, sha256_of(part))
+                else:
+                    missing.append(part)
 
-            # Обновим статус в кеше
-            self.cache["last_update"] = 0  # Сбросим кеш при следующем запросе списка
+            if not missing:
+                print(f"Модель {model_repo_id} (файл {file_name}) уже загружена в {self.MODELS_DIR}.")
+                self.mark_repo_installed(model_repo_id, variant)
+                return local_path
 
-            return downloaded_path  # Возвращаем фактический путь
+            needed_bytes = sum(getattr(siblings.get(part), "size", None) or 0 for part in missing)
+            with tracing.span("model_store.make_room", needed_bytes=needed_bytes):
+                evicted = self.store.make_room(needed_bytes, protected=protected)
+            for evicted_file in evicted:
+                self.set_installed(evicted_file, False)
+
+            for part in missing:
+                print(f"Скачивание файла {part} из репозитория {model_repo_id} в {self.MODELS_DIR}...")
+                # Скачиваем файл напрямую в нужную директорию
+                with tracing.span("hf.download", repo_id=model_repo_id, file=part,
+                                  size_bytes=getattr(siblings.get(part), "size", None)):
+                    downloaded_path = hf_hub_download(
+                        repo_id=model_repo_id,
+                        filename=part,
+                        local_dir=self.MODELS_DIR,
+                        local_dir_use_symlinks=False  # Важно: скачивать напрямую, а не симлинки
+                    )
+                # Проверяем, совпадает ли скачанный путь с ожидаемым
+                if os.path.abspath(downloaded_path) != os.path.abspath(os.path.join(self.MODELS_DIR, part)):
+                    print(f"Предупреждение: Файл скачан в {downloaded_path}, ожидался {os.path.join(self.MODELS_DIR, part)}")
+                self.store.add(part, sha256_of(part))
+
+            print(f"Модель {model_repo_id} (файл {file_name}) успешно загружена в {local_path}.")
+
+            # Обновим статус в кеше каталога
+            self.mark_repo_installed(model_repo_id, variant)
+
+            # llama.cpp открывает split-GGUF по первой части и сам находит остальные рядом
+            return local_path
 
+        except ModelStoreQuotaError:
+            raise
         except Exception as e:
             print(f"Ошибка при загрузке модели {model_repo_id}: {e}")
             # Попробуем удалить частично скачанный файл, если он есть
             try:
-                potential_incomplete_path = os.path.join(self.MODELS_DIR, file_name + ".incomplete")  # Или .download
+                potential_incomplete_path = os.path.join(self.MODELS_DIR, (file_name or "") + ".incomplete")  # Или .download
                 if file_name and os.path.exists(potential_incomplete_path):
                     os.remove(potential_incomplete_path)
                     print(f"Удален частично скачанный файл: {potential_incomplete_path}")
@@ -380,29 +885,17 @@ class ModelManager:
                 print(f"Ошибка при удалении неполного файла: {remove_err}")
             raise  # Передаем исходную ошибку дальше
 
-
-# --- Можно добавить метод для удаления ---
-def delete_model(self, file_name_to_delete: str) -> bool:
-    """Удаляет локальный файл модели и обновляет кеш."""
-    local_path = os.path.join(self.MODELS_DIR, file_name_to_delete)
-    if os.path.exists(local_path):
-        try:
-            os.remove(local_path)
-            print(f"Файл модели {file_name_to_delete} удален.")
-            # Обновляем статус 'installed' в кеше
-            for model in self.cache["models"]:
-                if model.get("file_name") == file_name_to_delete:
-                    model["installed"] = False
-                    break  # Нашли и обновили, выходим
-            return True
-        except OSError as e:
-            print(f"Ошибка при удалении файла {local_path}: {e}")
+    def delete_model(self, file_name_to_delete: str) -> bool:
+        """Удаляет локальный файл модели и обновляет кеш."""
+        local_path = os.path.join(self.MODELS_DIR, file_name_to_delete)
+        if not os.path.exists(local_path):
+            print(f"Файл {file_name_to_delete} не найден для удаления.")
+            # На всякий случай обновим кеш и индекс, если там статус был неверный
+            self.store.remove(file_name_to_delete)
+            self.set_installed(file_name_to_delete, False)
             return False
-    else:
-        print(f"Файл {file_name_to_delete} не найден для удаления.")
-        # На всякий случай обновим кеш, если там статус был неверный
-        for model in self.cache["models"]:
-            if model.get("file_name") == file_name_to_delete:
-                model["installed"] = False
-                break
-        return False
\ No newline at end of file
+        if not self.store.delete_file(file_name_to_delete):
+            return False
+        print(f"Файл модели {file_name_to_delete} удален.")
+        self.set_installed(file_name_to_delete, False)
+        return True
@@ -0,0 +1,70 @@
+import os
+import time
+import logging
+from typing import List, Dict, Iterable
+
+from backend.quant_selection import shard_file_names
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_CHUNK_SIZE = 16 * 1024 * 1024  # 16 MB за одно чтение при ручном прогреве
+WARMUP_PROMPT = "Hello"
+
+
+def select_preload_candidates(recent_models: Iterable[Dict], budget_bytes: int, max_models: int) -> List[Dict]:
+    """Отбирает модели для предзагрузки так, чтобы их суммарный размер влез в бюджет памяти.
+
+    recent_models должен быть отсортирован от самой свежей к самой старой; каждая запись
+    содержит как минимум "name" и "model_path". Модели, которые не влезают, пропускаются,
+    но перебор продолжается — следующая модель может оказаться меньше.
+    """
+    selected: List[Dict] = []
+    seen_paths = set()
+    used_bytes = 0
+    for entry in recent_models:
+        if len(selected) >= max_models:
+            break
+        model_path = entry.get("model_path")
+        if not model_path or model_path in seen_paths or not os.path.exists(model_path):
+            continue
+        seen_paths.add(model_path)
+        # У split-GGUF в память попадают все части
+        size_bytes = sum(os.path.getsize(part) for part in shard_file_names(model_path) if os.path.exists(part))
+        if used_bytes + size_bytes > budget_bytes:
+            logger.info(f"Модель {entry['name']} ({size_bytes / (1024 ** 3):.2f} GB) не влезает в бюджет предзагрузки.")
+            continue
+        used_bytes += size_bytes
+        selected.append({**entry, "size_bytes": size_bytes})
+    return selected
+
+
+def prefetch_file(path: str) -> float:
+    """Подкачивает файл модели в page cache, чтобы mmap в llama.cpp не ловил page fault'ы.
+
+    На POSIX просим ядро сделать readahead (posix_fadvise WILLNEED) — это асинхронно и
+    почти бесплатно для вызывающего потока. На Windows такого API нет, поэтому просто
+    читаем файл последовательно большими блоками. Возвращает затраченное время в секундах.
+    """
+    start = time.perf_counter()
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, PREFETCH_CHUNK_SIZE):
+                pass
+    finally:
+        os.close(fd)
+    return time.perf_counter() - start
+
+
+def warm_up(llm) -> float:
+    """Прогоняет один короткий шаг генерации, чтобы подтянуть все веса и инициализировать буферы.
+
+    Даже один токен проходит через все слои, так что после этого первый настоящий запрос
+    не платит за холодные страницы mmap. Возвращает затраченное время в секундах.
+    """
+    start = time.perf_counter()
+    llm.create_completion(WARMUP_PROMPT, max_tokens=1, temperature=0.0)
+    llm.reset()  # Не оставляем прогревочный промпт в контексте
+    return time.perf_counter() - start
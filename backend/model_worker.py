@@ -0,0 +1,381 @@
+import os
+import time
+import logging
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backend.generation import CancellationToken, generate_on_llm
+
+logger = logging.getLogger(__name__)
+
+WORKER_START_TIMEOUT = 600  # Большая модель с холодного диска грузится долго
+WORKER_POLL_INTERVAL = 0.05
+MONITOR_INTERVAL = 2.0
+
+
+class WorkerCrashedError(RuntimeError):
+    pass
+
+
+class WorkerNotRunningError(RuntimeError):
+    """У модели нет воркера в пуле, а запрос не должен его поднимать (фоновая генерация)."""
+
+
+# --- Дочерний процесс ---
+
+def worker_main(conn, model_path: str, llama_kwargs: Dict, speculative_config: Dict,
+                models_dir: str, draft_kwargs: Dict, warm_up: bool):
+    """Точка входа процесса-воркера: держит одну модель и обслуживает запросы по conn.
+
+    Веса грузятся через mmap (use_mmap=True), поэтому процессы с одним и тем же GGUF
+    делят страницы page cache, а перезапущенный воркер поднимается с уже горячего кеша.
+    """
+    from backend import model_preloader
+    from backend.embeddings import EmbeddingError, create_embedding_llama, embed_on_llm
+    from backend.speculative import create_llama_with_draft
+
+    try:
+        llm = create_llama_with_draft(model_path, {**llama_kwargs, "use_mmap": True},
+                                      speculative_config, models_dir, draft_kwargs)
+        if warm_up:
+            model_preloader.warm_up(llm)
+    except Exception as e:
+        conn.send({"type": "error", "detail": f"Ошибка загрузки модели в воркере: {e}"})
+        return
+    conn.send({"type": "ready", "pid": os.getpid()})
+    embedding_llm = None  # Экземпляр с embedding=True грузится при первом запросе эмбеддингов
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break  # Процесс API закрыл канал
+        op = message.get("op")
+        if op == "shutdown":
+            break
+        try:
+            if op == "generate":
+                _handle_generate(conn, llm, message)
+            elif op == "tokenize":
+                tokens = llm.tokenize(message["text"].encode("utf-8"))
+                conn.send({"type": "result", "id": message["id"], "tokens": tokens})
+            elif op == "embed":
+                try:
+                    if embedding_llm is None:
+                        embedding_llm = create_embedding_llama(model_path, llama_kwargs)
+                    result = embed_on_llm(embedding_llm, message["inputs"])
+                except EmbeddingError as e:
+                    conn.send({"type": "result", "id": message["id"], "error": e})
+                else:
+                    conn.send({"type": "result", "id": message["id"], "result": result})
+            elif op == "ping":
+                conn.send({"type": "pong", "id": message["id"]})
+            # Запоздавший "cancel" для уже завершенной генерации просто игнорируем
+        except Exception as e:
+            conn.send({"type": "error", "id": message.get("id"), "detail": str(e)})
+
+
+def _handle_generate(conn, llm, message: Dict):
+    request_id = message["id"]
+    cancel_token = CancellationToken()
+
+    def check_cancel():
+        while conn.poll():
+            incoming = conn.recv()
+            if incoming.get("op") == "cancel" and incoming.get("id") == request_id:
+                cancel_token.cancel(incoming.get("reason", "stop"))
+
+    def on_token(piece: str):
+        conn.send({"type": "token", "id": request_id, "text": piece})
+        check_cancel()
+
+    result = generate_on_llm(llm, message["spec"], cancel_token, on_token)
+    conn.send({"type": "done", "id": request_id, "result": result})
+
+
+# --- Процесс API ---
+
+class ModelWorker:
+    """Один процесс-воркер с одной моделью. Запросы к нему идут строго по одному."""
+
+    def __init__(self, model_path: str, config_factory: Callable[[str], Tuple[Dict, Dict, Dict]],
+                 models_dir: str):
+        self.model_path = model_path
+        self.config_factory = config_factory
+        self.models_dir = models_dir
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+        self.stopping = False
+        self.restarts = 0
+        self.started_at = None
+        self.busy = False
+        self.leases = 0  # Сколько запросов пула сейчас работают с воркером (меняется под lock пула)
+        self.retired = False  # Вытеснен или остановлен пулом — больше не запускается
+        self._request_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def ensure_running(self, warm_up: bool = False):
+        with self._start_lock:
+            if self.retired:
+                # Иначе процесс поднялся бы вне пула, и его уже никто не остановил бы
+                raise WorkerCrashedError(f"Воркер модели {self.model_path} остановлен пулом.")
+            if self.is_alive():
+                return
+            if self.process is not None:
+                self.restarts += 1
+                logger.warning(f"Воркер модели {os.path.basename(self.model_path)} упал "
+                               f"(код {self.process.exitcode}), перезапуск #{self.restarts}.")
+            self.stopping = False
+            llama_kwargs, speculative_config, draft_kwargs = self.config_factory(self.model_path)
+            # spawn, а не fork: процесс API многопоточный, а на Windows другого варианта нет
+            ctx = multiprocessing.get_context("spawn")
+            parent_conn, child_conn = ctx.Pipe(duplex=True)
+            process = ctx.Process(
+                target=worker_main,
+                args=(child_conn, self.model_path, llama_kwargs, speculative_config,
+                      self.models_dir, draft_kwargs, warm_up),
+                name=f"model-worker-{os.path.basename(self.model_path)}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            if not parent_conn.poll(WORKER_START_TIMEOUT):
+                process.kill()
+                raise WorkerCrashedError(f"Воркер модели {self.model_path} не запустился за {WORKER_START_TIMEOUT} с.")
+            try:
+                message = parent_conn.recv()
+            except (EOFError, OSError):
+                raise WorkerCrashedError(f"Воркер модели {self.model_path} завершился при запуске.")
+            if message.get("type") != "ready":
+                process.join(timeout=5)
+                raise WorkerCrashedError(message.get("detail", "Воркер не смог загрузить модель."))
+            self.process, self.conn = process, parent_conn
+            self.started_at = time.time()
+            logger.info(f"Воркер модели {os.path.basename(self.model_path)} запущен (PID {message['pid']}).")
+
+    def _receive(self, request_id: int, on_message: Callable[[Dict], bool],
+                 on_tick: Optional[Callable[[], None]] = None):
+        """Читает сообщения воркера, пока on_message не вернет True; следит, что процесс жив."""
+        while True:
+            if on_tick:
+                on_tick()
+            try:
+                has_data = self.conn.poll(WORKER_POLL_INTERVAL)
+            except (EOFError, OSError):
+                has_data = False
+            if has_data:
+                try:
+                    message = self.conn.recv()
+                except (EOFError, OSError):
+                    raise WorkerCrashedError(f"Воркер модели {self.model_path} оборвал соединение.")
+                if message.get("id") != request_id:
+                    continue  # Хвост прошлого запроса
+                if message["type"] == "error":
+                    raise RuntimeError(message["detail"])
+                if on_message(message):
+                    return
+            elif not self.is_alive():
+                raise WorkerCrashedError(f"Воркер модели {self.model_path} упал (код {self.process.exitcode}).")
+
+    def generate(self, spec: Dict, cancel_token: CancellationToken,
+                 on_token: Optional[Callable[[str], None]] = None) -> Dict:
+        with self._request_lock:
+            self.ensure_running()
+            request_id = next(self._ids)
+            self.busy = True
+            try:
+                self.conn.send({"op": "generate", "id": request_id, "spec": spec})
+                state = {"result": None, "cancel_sent": False}
+
+                def on_tick():
+                    # Воркер проверяет отмену между токенами, так что шлем ее один раз и ждем "done"
+                    if cancel_token.cancelled and not state["cancel_sent"]:
+                        self.conn.send({"op": "cancel", "id": request_id, "reason": cancel_token.reason})
+                        state["cancel_sent"] = True
+
+                def on_message(message: Dict) -> bool:
+                    if message["type"] == "token":
+                        if on_token:
+                            on_token(message["text"])
+                        return False
+                    state["result"] = message["result"]
+                    return True
+
+                self._receive(request_id, on_message, on_tick)
+                return state["result"]
+            finally:
+                self.busy = False
+
+    def tokenize(self, text: str) -> List[int]:
+        with self._request_lock:
+            self.ensure_running()
+            request_id = next(self._ids)
+            self.conn.send({"op": "tokenize", "id": request_id, "text": text})
+            state = {}
+
+            def on_message(message: Dict) -> bool:
+                state["tokens"] = message["tokens"]
+                return True
+
+            self._receive(request_id, on_message)
+            return state["tokens"]
+
+    def embed(self, inputs: List[str]) -> Dict:
+        with self._request_lock:
+            self.ensure_running()
+            request_id = next(self._ids)
+            self.busy = True
+            try:
+                self.conn.send({"op": "embed", "id": request_id, "inputs": inputs})
+                state = {}
+
+                def on_message(message: Dict) -> bool:
+                    state.update(message)
+                    return True
+
+                self._receive(request_id, on_message)
+            finally:
+                self.busy = False
+            if "error" in state:
+                raise state["error"]  # EmbeddingError: ответ клиенту, а не сбой воркера
+            return state["result"]
+
+    def stop(self):
+        # Под _start_lock: запуск, который уже идет (например, из монитора), закончится до остановки
+        with self._start_lock:
+            self.stopping = True
+            if not self.is_alive():
+                return
+            try:
+                self.conn.send({"op": "shutdown"})
+            except (EOFError, OSError):
+                pass
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.kill()
+
+    def status(self) -> Dict:
+        return {
+            "model_path": self.model_path,
+            "pid": self.process.pid if self.process else None,
+            "alive": self.is_alive(),
+            "busy": self.busy,
+            "restarts": self.restarts,
+            "started_at": self.started_at,
+        }
+
+
+class WorkerPool:
+    """Процессы-воркеры по одному на модель, с LRU-вытеснением и автоперезапуском упавших.
+
+    config_factory(model_path) -> (llama_kwargs, speculative_config, draft_kwargs) вызывается
+    при каждом (пере)запуске, так что калибровка и смена настроек подхватываются.
+    """
+
+    def __init__(self, config_factory: Callable[[str], Tuple[Dict, Dict, Dict]], models_dir: str,
+                 max_workers: int = 2):
+        self.config_factory = config_factory
+        self.models_dir = models_dir
+        self.max_workers = max_workers
+        self.workers: "OrderedDict[str, ModelWorker]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._monitor_started = False
+
+    @contextmanager
+    def _lease(self, model_path: str, start: bool = True):
+        """Воркер модели на время блока: пока он в работе, вытеснение его не трогает.
+
+        Вытесненные ради него воркеры останавливаются уже без lock пула — остановка ждет
+        процесс до 10 с, и остальные запросы не должны ждать ее вместе с ним.
+        start=False — только уже запущенный воркер, иначе WorkerNotRunningError.
+        """
+        with self._lock:
+            worker = self.workers.get(model_path)
+            if not start and (worker is None or not worker.is_alive()):
+                raise WorkerNotRunningError(f"Воркер модели {model_path} не запущен.")
+            if worker is None:
+                worker = ModelWorker(model_path, self.config_factory, self.models_dir)
+                self.workers[model_path] = worker
+            self.workers.move_to_end(model_path)
+            worker.leases += 1
+            evicted = self._evict_locked()
+            if not self._monitor_started:
+                threading.Thread(target=self._monitor, name="worker-monitor", daemon=True).start()
+                self._monitor_started = True
+        try:
+            for old_worker in evicted:
+                logger.info(f"Остановка воркера {os.path.basename(old_worker.model_path)} (вытеснение по LRU).")
+                old_worker.stop()
+            yield worker
+        finally:
+            with self._lock:
+                worker.leases -= 1
+
+    def _evict_locked(self) -> List[ModelWorker]:
+        # Вытесняем самые давно использованные воркеры, с которыми сейчас никто не работает
+        evicted = []
+        for path, worker in list(self.workers.items()):
+            if len(self.workers) <= self.max_workers:
+                break
+            if worker.leases:
+                continue
+            del self.workers[path]
+            worker.retired = True
+            evicted.append(worker)
+        return evicted
+
+    def get(self, model_path: str, warm_up: bool = False) -> ModelWorker:
+        """Поднимает воркер модели (или ждет, пока он поднимется)."""
+        with self._lease(model_path) as worker:
+            worker.ensure_running(warm_up=warm_up)
+            return worker
+
+    def generate(self, model_path: str, spec: Dict, cancel_token: CancellationToken,
+                 on_token: Optional[Callable[[str], None]] = None, start: bool = True) -> Dict:
+        with self._lease(model_path, start) as worker:
+            return worker.generate(spec, cancel_token, on_token)
+
+    def tokenize(self, model_path: str, text: str) -> List[int]:
+        with self._lease(model_path) as worker:
+            return worker.tokenize(text)
+
+    def embed(self, model_path: str, inputs: List[str]) -> Dict:
+        with self._lease(model_path) as worker:
+            return worker.embed(inputs)
+
+    def stop(self, model_path: str):
+        with self._lock:
+            worker = self.workers.pop(model_path, None)
+            if worker:
+                worker.retired = True
+        if worker:
+            worker.stop()
+
+    def resident_model_paths(self) -> List[str]:
+        with self._lock:
+            return [path for path, worker in self.workers.items() if worker.is_alive()]
+
+    def status(self) -> List[Dict]:
+        with self._lock:
+            return [worker.status() for worker in self.workers.values()]
+
+    def _monitor(self):
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            with self._lock:
+                workers = list(self.workers.values())
+            for worker in workers:
+                if (worker.process is not None and not worker.stopping and not worker.retired
+                        and not worker.is_alive()):
+                    try:
+                        worker.ensure_running()
+                    except Exception as e:
+                        logger.error(f"Не удалось перезапустить воркер {worker.model_path}: {e}")
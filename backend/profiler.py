@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from typing import Dict
+
+MAX_STACK_DEPTH = 128
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер потоков Python через sys._current_frames().
+
+    Пока профилирование не запущено, никакой работы не делается. Во время профилирования
+    отдельный поток раз в interval снимает стеки всех потоков и считает одинаковые стеки;
+    результат — collapsed stacks ("поток;внешний кадр;...;внутренний кадр N"), которые
+    понимают flamegraph.pl, speedscope и inferno.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        # Строка начала функции, а не текущая: так кадры одной функции сливаются в один блок графа
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+    def _sample(self, counts: Counter, own_ident: int):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(";", ":"))
+            counts[";".join(reversed(stack))] += 1
+
+    def run(self, seconds: float, interval: float = 0.005) -> Dict:
+        """Профилирует seconds секунд; одновременно допускается только один запуск."""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("Профилирование уже запущено.")
+        try:
+            counts: Counter = Counter()
+            own_ident = threading.get_ident()
+            samples = 0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while (now := time.perf_counter()) < deadline:
+                self._sample(counts, own_ident)
+                samples += 1
+                time.sleep(max(0.0, interval - (time.perf_counter() - now)))
+            collapsed = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+            return {"collapsed": collapsed, "samples": samples, "seconds": round(time.perf_counter() - started, 3)}
+        finally:
+            self._lock.release()
@@ -0,0 +1,134 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from backend.hardware import get_gpu_memory_bytes, get_total_memory_bytes
+
+# От лучшего качества к худшему; кванты не из списка идут в конец
+QUANT_QUALITY = [
+    "F32", "BF16", "F16", "Q8_0", "Q6_K", "Q5_K_M", "Q5_K_S", "Q5_1", "Q5_0", "Q4_K_M", "IQ4_NL",
+    "Q4_K_S", "IQ4_XS", "Q4_1", "Q4_0", "Q3_K_L", "Q3_K_M", "IQ3_M", "IQ3_S", "Q3_K_S", "IQ3_XS",
+    "IQ3_XXS", "Q2_K", "Q2_K_S", "IQ2_M", "IQ2_S", "IQ2_XS", "IQ2_XXS", "IQ1_M", "IQ1_S",
+]
+QUANT_RE = re.compile(r"(?<![A-Z0-9])(" + "|".join(sorted(QUANT_QUALITY, key=len, reverse=True)) + r")(?![A-Z0-9])")
+SHARD_RE = re.compile(r"^(?P<stem>.+)-(?P<index>\d{5})-of-(?P<total>\d{5})\.gguf$")
+
+# Поверх весов нужен KV-кеш (n_ctx 4096) и буферы вычислений
+MEMORY_OVERHEAD_RATIO = 1.1
+MEMORY_OVERHEAD_BYTES = 512 * 1024 * 1024
+# Декодирование упирается в пропускную способность памяти: на каждый токен веса читаются целиком.
+# Точную скорость не определить без замера, поэтому берем типичные значения (можно переопределить).
+GPU_BANDWIDTH_GBPS = float(os.getenv("GPU_BANDWIDTH_GBPS", "300"))
+RAM_BANDWIDTH_GBPS = float(os.getenv("RAM_BANDWIDTH_GBPS", "40"))
+
+
+def parse_shard(file_name: str) -> Optional[Tuple[str, int, int]]:
+    """Для частей split-GGUF (model-00001-of-00003.gguf) возвращает (основа имени, номер, всего частей)."""
+    match = SHARD_RE.match(os.path.basename(file_name))
+    if not match:
+        return None
+    return match.group("stem"), int(match.group("index")), int(match.group("total"))
+
+
+def shard_file_names(file_name: str) -> List[str]:
+    """Все части split-GGUF по имени любой из них; для обычного файла — он сам."""
+    shard = parse_shard(file_name)
+    if not shard:
+        return [file_name]
+    stem, _, total = shard
+    directory = os.path.dirname(file_name)
+    return [os.path.join(directory, f"{stem}-{i:05d}-of-{total:05d}.gguf") for i in range(1, total + 1)]
+
+
+def is_secondary_shard(file_name: str) -> bool:
+    """Вторая и следующие части split-GGUF: llama.cpp подхватывает их сам по первой части."""
+    shard = parse_shard(file_name)
+    return bool(shard and shard[1] > 1)
+
+
+def parse_quant(file_name: str) -> Optional[str]:
+    match = QUANT_RE.search(os.path.basename(file_name).upper())
+    return match.group(1) if match else None
+
+
+def quant_rank(quant: Optional[str]) -> int:
+    return QUANT_QUALITY.index(quant) if quant in QUANT_QUALITY else len(QUANT_QUALITY)
+
+
+def group_variants(files: List[Tuple[str, Optional[int]]]) -> List[Dict]:
+    """Собирает GGUF-файлы репозитория в варианты модели: одиночный файл или полный набор частей.
+
+    files — пары (путь в репозитории, размер в байтах). Проекторы для картинок (mmproj)
+    и неполные наборы частей пропускаются.
+    """
+    groups: Dict[str, Dict] = {}
+    for path, size in files:
+        name = os.path.basename(path)
+        if not name.endswith(".gguf") or "mmproj" in name.lower():
+            continue
+        shard = parse_shard(path)
+        key = os.path.join(os.path.dirname(path), shard[0]) if shard else path
+        group = groups.setdefault(key, {"files": [], "size_bytes": 0, "total_parts": shard[2] if shard else 1})
+        group["files"].append(path)
+        group["size_bytes"] += size or 0
+    variants = []
+    for group in groups.values():
+        if len(group["files"]) != group["total_parts"]:
+            continue
+        files_sorted = sorted(group["files"])
+        variants.append({
+            "file_name": files_sorted[0],  # llama.cpp грузит split-GGUF по первой части
+            "files": files_sorted,
+            "quant": parse_quant(files_sorted[0]),
+            "size_bytes": group["size_bytes"],
+        })
+    variants.sort(key=lambda v: (quant_rank(v["quant"]), -v["size_bytes"]))
+    return variants
+
+
+def get_memory_budget() -> Dict:
+    """Куда будет грузиться модель и сколько там памяти."""
+    vram = get_gpu_memory_bytes()
+    ram = get_total_memory_bytes() or 0
+    if vram:
+        return {"target": "gpu", "memory_bytes": vram, "ram_bytes": ram, "bandwidth_gbps": GPU_BANDWIDTH_GBPS}
+    return {"target": "cpu", "memory_bytes": ram, "ram_bytes": ram, "bandwidth_gbps": RAM_BANDWIDTH_GBPS}
+
+
+def estimate_variant(variant: Dict, budget: Dict) -> Dict:
+    size = variant["size_bytes"]
+    memory_bytes = int(size * MEMORY_OVERHEAD_RATIO + MEMORY_OVERHEAD_BYTES) if size else None
+    tokens_per_second = None
+    if size:
+        tokens_per_second = round(budget["bandwidth_gbps"] * 1024 ** 3 / size, 1)
+    return {
+        **variant,
+        "memory_bytes": memory_bytes,
+        "fits": bool(memory_bytes) and memory_bytes <= budget["memory_bytes"],
+        "target": budget["target"],
+        "estimated_tokens_per_second": tokens_per_second,
+    }
+
+
+def select_variant(variants: List[Dict], budget: Dict | None = None, quant: str | None = None) -> Optional[Dict]:
+    """Лучший по качеству вариант, целиком помещающийся в VRAM (или RAM без GPU).
+
+    Если в VRAM не помещается ни один, берется лучший, помещающийся в RAM (часть слоев
+    останется на CPU), а если и так нет — самый маленький. quant задает вариант явно.
+    Возвращает выбранный вариант с полем alternatives (остальные варианты с оценками).
+    """
+    if not variants:
+        return None
+    budget = budget or get_memory_budget()
+    estimated = [estimate_variant(v, budget) for v in variants]
+    chosen = None
+    if quant:
+        chosen = next((v for v in estimated if v["quant"] == quant.upper()), None)
+    if chosen is None:
+        chosen = next((v for v in estimated if v["fits"]), None)
+    if chosen is None and budget["target"] == "gpu":
+        chosen = next((v for v in estimated if v["memory_bytes"] and v["memory_bytes"] <= budget["ram_bytes"]), None)
+    if chosen is None:
+        chosen = min(estimated, key=lambda v: v["size_bytes"] or float("inf"))
+    alternatives = [v for v in estimated if v is not chosen]
+    return {**chosen, "alternatives": alternatives}
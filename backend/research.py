@@ -0,0 +1,361 @@
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import math
+import os
+import re
+import socket
+import time
+from collections import Counter
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+import numpy as np
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+# Поиск — SearxNG-совместимый JSON API: GET SEARCH_API_URL?q=...&format=json -> {"results": [{url, title, content}]}.
+# Для проверки без интернета подходит заглушка backend/bench/research_stub.py
+SEARCH_API_URL = os.getenv("SEARCH_API_URL", "")
+RESEARCH_BUDGET_SECONDS = float(os.getenv("RESEARCH_BUDGET_SECONDS", "90"))  # Весь ход: план, поиск, ответ
+RESEARCH_GATHER_SHARE = 0.5  # Доля бюджета на план, поиск и загрузку страниц; остальное — на ответ модели
+RESEARCH_MAX_SUBQUERIES = int(os.getenv("RESEARCH_MAX_SUBQUERIES", "4"))
+RESEARCH_RESULTS_PER_QUERY = int(os.getenv("RESEARCH_RESULTS_PER_QUERY", "5"))
+RESEARCH_MAX_PAGES = int(os.getenv("RESEARCH_MAX_PAGES", "12"))
+RESEARCH_FETCH_CONCURRENCY = int(os.getenv("RESEARCH_FETCH_CONCURRENCY", "6"))
+RESEARCH_TOP_PASSAGES = int(os.getenv("RESEARCH_TOP_PASSAGES", "8"))
+REQUEST_TIMEOUT_SECONDS = 10
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+PASSAGE_WORDS = 120
+PASSAGE_STRIDE = 90  # Окна перекрываются, чтобы факт на границе не разрезался пополам
+MAX_PASSAGES_PER_SOURCE = 3  # Иначе одна длинная страница забирает весь контекст
+USER_AGENT = "NeuraBox-Research/1.0"
+# Ссылки из выдачи поисковика — чужие данные: без этого страница могла бы указать на сервисы
+# локальной сети или машины пользователя. Включать только для заглушки на 127.0.0.1
+RESEARCH_ALLOW_PRIVATE_HOSTS = os.getenv("RESEARCH_ALLOW_PRIVATE_HOSTS", "0") == "1"
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_WORD_RE = re.compile(r"\w+")
+_PLAN_LINE_PREFIX_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+MINHASH_PRIME = (1 << 61) - 1
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall(text.lower())
+
+
+def split_passages(text: str, words: int = PASSAGE_WORDS, stride: int = PASSAGE_STRIDE) -> List[str]:
+    tokens = text.split()
+    if len(tokens) <= words:
+        return [" ".join(tokens)] if tokens else []
+    return [" ".join(tokens[start:start + words]) for start in range(0, len(tokens) - words + stride, stride)]
+
+
+class MinHashIndex:
+    """Почти-дубликаты фрагментов: MinHash по шинглам из слов и LSH по полосам сигнатуры.
+
+    Одни и те же абзацы приходят с зеркал, агрегаторов и перепечаток; без дедупликации они
+    занимают места в топе BM25 и контекст модели. Новый фрагмент сравнивается только с теми,
+    у кого совпала хотя бы одна полоса, а не со всеми уже принятыми.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, threshold: float = 0.7, shingle_words: int = 4,
+                 seed: int = 0x5EED):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_words = shingle_words
+        self._buckets: Dict[tuple, List[int]] = {}
+        self._signatures: List[np.ndarray] = []
+
+    def signature(self, text: str) -> np.ndarray:
+        words = tokenize(text)
+        n = self.shingle_words
+        shingles = {" ".join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+             for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # Переполнение uint64 в a*x+b допустимо: нужна лишь независимая перестановка на каждый столбец
+        return ((np.outer(hashes, self.a) + self.b) % MINHASH_PRIME).min(axis=0)
+
+    def add(self, text: str) -> bool:
+        """Добавляет фрагмент, если похожего (оценка Жаккара >= threshold) еще нет; False — дубликат."""
+        signature = self.signature(text)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        candidates = {index for key in keys for index in self._buckets.get(key, ())}
+        for index in candidates:
+            if np.mean(self._signatures[index] == signature) >= self.threshold:
+                return False
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(index)
+        return True
+
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    """Okapi BM25 запроса для каждого документа; статистика (df, средняя длина) — по самим документам."""
+    counts = [Counter(tokenize(document)) for document in documents]
+    if not counts:
+        return []
+    lengths = [sum(counter.values()) for counter in counts]
+    average_length = sum(lengths) / len(lengths) or 1
+    document_frequency = Counter(term for counter in counts for term in counter)
+    total = len(counts)
+    idf = {term: math.log(1 + (total - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+           for term in set(tokenize(query)) if document_frequency[term]}
+    scores = []
+    for counter, length in zip(counts, lengths):
+        norm = k1 * (1 - b + b * length / average_length)
+        scores.append(sum(weight * counter[term] * (k1 + 1) / (counter[term] + norm)
+                          for term, weight in idf.items() if term in counter))
+    return scores
+
+
+def select_passages(query: str, passages: List[Dict], top_k: int = RESEARCH_TOP_PASSAGES,
+                    per_source: int = MAX_PASSAGES_PER_SOURCE) -> List[Dict]:
+    """Лучшие по BM25 фрагменты, не больше per_source с одного адреса; нерелевантные (0) отбрасываются."""
+    scored = sorted(zip(bm25_scores(query, [passage["text"] for passage in passages]), range(len(passages))),
+                    reverse=True)
+    selected, taken = [], Counter()
+    for score, index in scored:
+        passage = passages[index]
+        if score <= 0 or len(selected) >= top_k:
+            break
+        if taken[passage["url"]] >= per_source:
+            continue
+        taken[passage["url"]] += 1
+        selected.append({**passage, "score": round(score, 3)})
+    return selected
+
+
+def extract_text(html: str) -> Tuple[str, str]:
+    """Заголовок и видимый текст страницы без скриптов, меню и подвалов."""
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.get_text(" ", strip=True) if soup.title else ""
+    for tag in soup(["head", "script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg"]):
+        tag.decompose()
+    return title, " ".join(soup.get_text(" ").split())
+
+
+def build_plan_prompt(question: str, limit: int = RESEARCH_MAX_SUBQUERIES) -> str:
+    return ("You are planning web research. Break the question below into at most "
+            f"{limit} short, distinct web search queries that together cover it. "
+            "Reply with the queries only, one per line, without numbering.\n\n"
+            f"Question: {question[:2000]}\n\nSearch queries:\n")
+
+
+def parse_plan(text: str, question: str, limit: int = RESEARCH_MAX_SUBQUERIES) -> List[str]:
+    """Запросы для поиска: сам вопрос и до limit подвопросов из ответа модели (нумерация и повторы убираются)."""
+    queries = [question[:200]]
+    for line in text.splitlines():
+        line = _PLAN_LINE_PREFIX_RE.sub("", line).strip().strip("\"'«»")
+        if line and line.lower() not in {query.lower() for query in queries}:
+            queries.append(line[:200])
+    return queries[:limit + 1]
+
+
+def build_synthesis_prompt(prompt: str, passages: List[Dict]) -> str:
+    """Вставляет найденные фрагменты с номерами источников перед репликой ассистента в промпте хода."""
+    if not passages:
+        return prompt
+    sources = "\n\n".join(f"[{passage['source']}] {passage['text']}" for passage in passages)
+    head, marker, tail = prompt.rpartition("\n\nAssistant:")
+    if not marker:
+        head, tail = prompt, ""
+    return (f"{head}\n\nWeb sources:\n{sources}\n\n"
+            "Answer the user's last message using the web sources above. Cite them inline as [n] right after "
+            "the facts they support. If the sources do not cover something, say so.\n\nAssistant:" + tail)
+
+
+def format_sources(sources: List[Dict]) -> str:
+    """Список источников, который дописывается к ответу (и в БД, чтобы ссылки [n] читались в истории)."""
+    if not sources:
+        return ""
+    lines = [f"[{source['id']}] [{source['title'] or source['url']}]({source['url']})" for source in sources]
+    return "\n\n**Источники:**\n" + "\n".join(lines)
+
+
+async def search(session: aiohttp.ClientSession, search_url: str, query: str,
+                 limit: int = RESEARCH_RESULTS_PER_QUERY) -> List[Dict]:
+    try:
+        async with session.get(search_url, params={"q": query, "format": "json"}) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.warning(f"Поиск по запросу {query!r} не удался: {e}")
+        return []
+    results = []
+    for item in data.get("results", [])[:limit]:
+        url = item.get("url")
+        if url and urlparse(url).scheme in ("http", "https"):
+            results.append({"url": url, "title": (item.get("title") or "").strip(),
+                            "snippet": (item.get("content") or item.get("snippet") or "").strip()})
+    return results
+
+
+def is_public_address(address: str) -> bool:
+    """Адрес в интернете, а не в локальной сети, loopback, link-local, multicast или зарезервированный."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])  # У link-local IPv6 бывает %зона
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def is_allowed_url(url: str) -> bool:
+    """http(s)-ссылка не на внутренний IP. Имена хостов проверяет PublicAddressResolver при соединении."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if RESEARCH_ALLOW_PRIVATE_HOSTS:
+        return True
+    try:
+        return is_public_address(parsed.hostname)
+    except ValueError:
+        return True
+
+
+class PublicAddressResolver(aiohttp.ThreadedResolver):
+    """Отбрасывает внутренние адреса из ответа DNS прямо перед соединением.
+
+    Проверка в момент соединения, а не заранее: иначе имя могло бы между проверкой и загрузкой
+    начать указывать на 127.0.0.1 (DNS rebinding). IP в самой ссылке aiohttp не резолвит —
+    такие ссылки отсекает is_allowed_url.
+    """
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        addresses = [address for address in await super().resolve(host, port, family)
+                     if is_public_address(address["host"])]
+        if not addresses:
+            raise OSError(None, f"{host} указывает только на адреса во внутренней сети")
+        return addresses
+
+
+def page_session(timeout: aiohttp.ClientTimeout) -> aiohttp.ClientSession:
+    """Сессия для страниц из выдачи: соединяется только с адресами в интернете."""
+    connector = None if RESEARCH_ALLOW_PRIVATE_HOSTS else aiohttp.TCPConnector(resolver=PublicAddressResolver())
+    return aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": USER_AGENT}, connector=connector)
+
+
+async def fetch_page(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> Optional[str]:
+    """HTML или текст страницы (не больше MAX_PAGE_BYTES); None, если загрузить не удалось.
+
+    session — из page_session(). Переадресации проходятся вручную, чтобы проверить каждый адрес.
+    """
+    async with semaphore:
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                if not is_allowed_url(url):
+                    logger.warning(f"Страница {url} не загружена: адрес во внутренней сети")
+                    return None
+                async with session.get(url, allow_redirects=False) as response:
+                    if response.status in REDIRECT_STATUSES and "Location" in response.headers:
+                        url = urljoin(str(response.url), response.headers["Location"])
+                        continue
+                    response.raise_for_status()
+                    if response.content_type not in ("text/html", "text/plain", "application/xhtml+xml"):
+                        return None
+                    chunks, size = [], 0
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size >= MAX_PAGE_BYTES:
+                            break
+                    return b"".join(chunks).decode(response.charset or "utf-8", errors="replace")
+            logger.info(f"Страница {url} не загружена: больше {MAX_REDIRECTS} переадресаций")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+            logger.info(f"Страница {url} не загружена: {e}")
+            return None
+
+
+async def gather_sources(question: str, queries: List[str], deadline: float,
+                         search_url: Optional[str] = None) -> AsyncIterator[Dict]:
+    """Параллельный поиск по всем запросам и загрузка найденных страниц до deadline (time.monotonic()).
+
+    Страницы начинают грузиться, как только пришел результат своего поиска, не дожидаясь остальных.
+    Отдает события прогресса {"type": "research", "stage": ...}; последнее — {"type": "sources"}
+    с отобранными фрагментами (passages) и нумерованными источниками (sources) для цитирования.
+    Что не успело к deadline, отменяется: ответ строится по тому, что уже собрано.
+    """
+    search_url = search_url or SEARCH_API_URL
+    index = MinHashIndex()
+    passages: List[Dict] = []
+    snippets: Dict[str, Dict] = {}  # Если страница не загрузилась, остается хотя бы сниппет поисковика
+    pages_with_text = set()  # Включая страницы, все фрагменты которых оказались дубликатами
+    stats = {"queries": len(queries), "results": 0, "pages": 0, "failed_pages": 0, "passages": 0,
+             "duplicates": 0, "timed_out": False}
+
+    def add_text(url: str, title: str, text: str) -> int:
+        added = 0
+        for text_part in split_passages(text):
+            if index.add(text_part):
+                passages.append({"url": url, "title": title, "text": text_part})
+                added += 1
+            else:
+                stats["duplicates"] += 1
+        return added
+
+    semaphore = asyncio.Semaphore(RESEARCH_FETCH_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+    # Поисковик задан в настройках и может быть локальным (SearxNG на localhost), страницы — нет
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": USER_AGENT}) as session, \
+            page_session(timeout) as pages:
+        tasks = {asyncio.ensure_future(search(session, search_url, query)): ("search", query) for query in queries}
+        try:
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    stats["timed_out"] = True
+                    break
+                done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind, payload = tasks.pop(task)
+                    if kind == "search":
+                        results = task.result()
+                        stats["results"] += len(results)
+                        yield {"type": "research", "stage": "search", "query": payload, "results": len(results)}
+                        for result in results:
+                            if result["url"] in snippets or len(snippets) >= RESEARCH_MAX_PAGES:
+                                continue
+                            snippets[result["url"]] = result
+                            tasks[asyncio.ensure_future(fetch_page(pages, result["url"], semaphore))] = \
+                                ("fetch", result)
+                    else:
+                        html = task.result()
+                        added = 0
+                        if html:
+                            title, text = await asyncio.to_thread(extract_text, html)  # Разбор HTML — CPU
+                            added = add_text(payload["url"], title or payload["title"], text)
+                            if text:
+                                pages_with_text.add(payload["url"])
+                        stats["pages" if html else "failed_pages"] += 1
+                        yield {"type": "research", "stage": "fetch", "url": payload["url"], "ok": bool(html),
+                               "passages": added}
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    for url, result in snippets.items():
+        if url not in pages_with_text and result["snippet"]:
+            add_text(url, result["title"], result["snippet"])
+    stats["passages"] = len(passages)
+
+    selected = select_passages(" ".join([question, *queries]), passages)
+    source_ids: Dict[str, int] = {}
+    sources = []
+    for passage in selected:
+        if passage["url"] not in source_ids:
+            source_ids[passage["url"]] = len(source_ids) + 1
+            sources.append({"id": source_ids[passage["url"]], "url": passage["url"], "title": passage["title"]})
+        passage["source"] = source_ids[passage["url"]]
+    yield {"type": "sources", "sources": sources, "passages": selected, "stats": stats}
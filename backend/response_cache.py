@@ -0,0 +1,168 @@
+import re
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HASH_EMBEDDING_DIM = 512
+
+
+def normalize_prompt(text: str) -> str:
+    """Нормализует текст перед токенизацией: NFKC и схлопывание пробелов.
+
+    Регистр не трогаем — в коде и именах он значим.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class HashingEmbedder:
+    """Эмбеддинги без внешних моделей: хеширование символьных триграмм в вектор фиксированной длины.
+
+    Ловит перефразы уровня опечаток, пробелов и перестановки слов, но не смысл: длинные вопросы,
+    различающиеся одним словом ("TCP and UDP" / "TCP and IP"), набирают близость выше 0.95.
+    Поэтому семантический уровень с ним включается только по явному use_cache; для настоящей
+    семантической близости задайте RESPONSE_CACHE_EMBED_MODEL (sentence-transformers).
+    """
+    semantic = False  # Годится ли для семантического уровня кеша по умолчанию
+
+    def encode(self, text: str) -> np.ndarray:
+        vector = np.zeros(HASH_EMBEDDING_DIM, dtype=np.float32)
+        padded = f"  {text.lower()}  "
+        for i in range(len(padded) - 2):
+            bucket = int.from_bytes(hashlib.md5(padded[i:i + 3].encode("utf-8")).digest()[:4], "little")
+            vector[bucket % HASH_EMBEDDING_DIM] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder:
+    semantic = True
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, text: str) -> np.ndarray:
+        return self.model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+def create_embedder(model_name: Optional[str]):
+    if model_name:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить модель эмбеддингов {model_name} для кеша ответов, "
+                           f"семантический поиск — только по явному use_cache: {e}")
+    return HashingEmbedder()
+
+
+class ResponseCache:
+    """Кеш ответов модели с двумя уровнями.
+
+    1. Точный: ключ — sha256 от (отпечаток файла модели, параметры сэмплирования,
+       токены нормализованного промпта).
+    2. Семантический (только если lookup вызван с semantic=True): среди записей с той же моделью, параметрами и *точно такой же*
+       историей до последнего сообщения ищем последнее сообщение пользователя с
+       косинусной близостью не ниже порога. История сравнивается точно, иначе
+       длинный общий контекст делал бы похожими любые два разных вопроса.
+
+    Вытеснение LRU по числу записей и по суммарному размеру.
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 32 * 1024 * 1024,
+                 similarity_threshold: float = 0.95, embedder=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder or HashingEmbedder()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def make_scope(model_fingerprint: str, sampling_params: Dict) -> str:
+        payload = json.dumps({"model": model_fingerprint, "params": sampling_params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(scope: str, prompt_tokens: List[int]) -> str:
+        digest = hashlib.sha256(scope.encode("utf-8"))
+        digest.update(np.asarray(prompt_tokens, dtype=np.int32).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def make_context_key(scope: str, history_prefix: str) -> str:
+        return hashlib.sha256(f"{scope}\n{normalize_prompt(history_prefix)}".encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str, context_key: str, last_message: str, semantic: bool = False) -> Optional[Dict]:
+        """Возвращает {"response", "tier", "similarity"} или None. Без semantic — только точный ключ.
+
+        Кодирует сообщение и перебирает записи — вызывать в потоке, а не в event loop.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return {"response": entry["response"], "tier": "exact", "similarity": 1.0}
+            candidates = [(k, e) for k, e in self._entries.items()
+                          if semantic and e["context_key"] == context_key]
+
+        if candidates:
+            query = self.embedder.encode(normalize_prompt(last_message))
+            best_key, best_entry, best_similarity = None, None, -1.0
+            for candidate_key, candidate in candidates:
+                similarity = float(np.dot(query, candidate["embedding"]))
+                if similarity > best_similarity:
+                    best_key, best_entry, best_similarity = candidate_key, candidate, similarity
+            if best_similarity >= self.similarity_threshold:
+                with self._lock:
+                    if best_key in self._entries:
+                        self._entries.move_to_end(best_key)
+                    self._stats["semantic_hits"] += 1
+                return {"response": best_entry["response"], "tier": "semantic", "similarity": best_similarity}
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def store(self, key: str, context_key: str, last_message: str, response: str):
+        embedding = self.embedder.encode(normalize_prompt(last_message))
+        size = len(response.encode("utf-8")) + embedding.nbytes + 256  # + накладные расходы на запись
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._total_bytes -= old["size"]
+            self._entries[key] = {"response": response, "context_key": context_key,
+                                  "embedding": embedding, "size": size}
+            self._total_bytes += size
+            self._stats["stores"] += 1
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted["size"]
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["exact_hits"] + self._stats["semantic_hits"] + self._stats["misses"]
+            hits = self._stats["exact_hits"] + self._stats["semantic_hits"]
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
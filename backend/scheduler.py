@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from backend.generation import CancellationToken
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: меньше — важнее. Интерактивные ходы пользователя всегда идут раньше фоновых задач
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+PREEMPTED = "preempted"  # Причина отмены фоновой генерации, уступившей модель интерактивному запросу
+WAIT_SAMPLES = 512
+MAX_CLIENT_TAGS = 1024
+
+
+class SlotTicket:
+    """Выданный слот: сколько ждали в очереди и оценка стоимости, которую потом уточняют по факту."""
+    __slots__ = ("scheduler", "resource", "client_id", "weight", "cost", "waited")
+
+    def __init__(self, scheduler: "GenerationScheduler", resource: str, client_id: Optional[str], weight: float,
+                 cost: float):
+        self.scheduler = scheduler
+        self.resource = resource
+        self.client_id = client_id
+        self.weight = weight
+        self.cost = cost
+        self.waited = 0.0
+
+    def charge(self, actual_cost: float):
+        """Фактическая стоимость (токены промпта и ответа) вместо оценки: разница сдвигает очередь клиента."""
+        self.scheduler._settle(self, actual_cost)
+
+
+class GenerationScheduler:
+    """Очередь к модели с приоритетами вместо "кто первый захватил lock".
+
+    Ресурс — то, что может генерировать один запрос за раз: единственная модель в процессе
+    или процесс-воркер конкретной модели. Ждущие получают ресурс в порядке (приоритет, время прихода).
+    Если интерактивный запрос приходит, пока ресурс держит фоновая генерация, ее токен отмены
+    получает причину PREEMPTED: генерация останавливается на границе токена, а задача потом
+    продолжает с того же места (см. api.run_background_generation).
+
+    Внутри класса приоритета очередь справедливая по клиентам (self-clocked fair queuing): запрос
+    получает метку окончания = max(виртуальное время, метка предыдущего запроса клиента) + стоимость / вес.
+    Стоимость — токены (оценка по max_tokens, потом по факту), поэтому клиент с длинными ответами
+    не занимает модель целиком: короткие запросы других клиентов обгоняют его очередь.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiters: Dict[str, List] = {}
+        self._holders: Dict[str, tuple] = {}  # ресурс -> (приоритет, токен отмены)
+        self._virtual_time: Dict[str, float] = {}  # ресурс -> метка окончания запроса, который сейчас генерирует
+        self._client_finish: Dict[tuple, float] = {}  # (ресурс, клиент) -> метка окончания последнего запроса
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITY_NAMES}
+        self._stats = {priority: {"jobs": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+                       for priority in PRIORITY_NAMES}
+        self._preemptions = 0
+        self._resumes = 0
+
+    def _preempt_background(self, resource: str):
+        holder = self._holders.get(resource)
+        if holder and holder[0] == BACKGROUND and holder[1] is not None and not holder[1].cancelled:
+            holder[1].cancel(PREEMPTED)
+            self._preemptions += 1
+
+    @contextmanager
+    def slot(self, resource: str, priority: int, cancel_token: Optional[CancellationToken] = None,
+             client_id: Optional[str] = None, weight: float = 1.0, cost: float = 1.0):
+        """Держит ресурс на время блока. cancel_token фоновой задачи нужен, чтобы ее можно было вытеснить."""
+        enqueued = time.perf_counter()
+        ticket = SlotTicket(self, resource, client_id, weight, cost)
+        with self._cond:
+            virtual_time = self._virtual_time.get(resource, 0.0)
+            finish = max(virtual_time, self._client_finish.get((resource, client_id), 0.0)) + cost / weight
+            self._client_finish[(resource, client_id)] = finish
+            entry = (priority, finish, next(self._seq))
+            waiters = self._waiters.setdefault(resource, [])
+            heapq.heappush(waiters, entry)
+            if priority == INTERACTIVE:
+                self._preempt_background(resource)
+            while resource in self._holders or waiters[0] != entry:
+                self._cond.wait()
+            heapq.heappop(waiters)
+            self._holders[resource] = (priority, cancel_token)
+            self._virtual_time[resource] = max(virtual_time, finish)
+            if len(self._client_finish) > MAX_CLIENT_TAGS:
+                # Метки позади виртуального времени ничего не решают: клиент и так начнет с него
+                self._client_finish = {key: tag for key, tag in self._client_finish.items()
+                                       if tag > self._virtual_time.get(key[0], 0.0)}
+            waited = time.perf_counter() - enqueued
+            ticket.waited = waited
+            stats = self._stats[priority]
+            stats["jobs"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+            self._waits[priority].append(waited)
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                del self._holders[resource]
+                self._cond.notify_all()
+
+    def _settle(self, ticket: SlotTicket, actual_cost: float):
+        with self._cond:
+            key = (ticket.resource, ticket.client_id)
+            if key in self._client_finish:
+                adjusted = self._client_finish[key] + (actual_cost - ticket.cost) / ticket.weight
+                self._client_finish[key] = max(adjusted, self._virtual_time.get(ticket.resource, 0.0))
+
+    def record_resume(self):
+        with self._cond:
+            self._resumes += 1
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            classes = {}
+            for priority, name in PRIORITY_NAMES.items():
+                stats = self._stats[priority]
+                waits = sorted(self._waits[priority])
+                classes[name] = {
+                    "waiting": sum(1 for waiters in self._waiters.values() for entry in waiters
+                                   if entry[0] == priority),
+                    "running": sum(1 for holder in self._holders.values() if holder[0] == priority),
+                    "jobs": stats["jobs"],
+                    "avg_wait_ms": round(stats["wait_seconds"] / stats["jobs"] * 1000, 1) if stats["jobs"] else 0.0,
+                    "p95_wait_ms": round(waits[round(0.95 * (len(waits) - 1))] * 1000, 1) if waits else 0.0,
+                    "max_wait_ms": round(stats["max_wait_seconds"] * 1000, 1),
+                }
+            return {"classes": classes, "preemptions": self._preemptions, "resumes": self._resumes}
+
+
+class BackgroundJobs:
+    """Фоновые задачи (названия чатов, в будущем — сводки, эмбеддинги) в одном потоке.
+
+    Очередь ограничена: если модель занята интерактивной работой так долго, что задачи копятся,
+    новые отбрасываются — это улучшения, без которых можно обойтись.
+    """
+
+    def __init__(self, max_queued: int = 64):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"completed": 0, "failed": 0, "dropped": 0}
+
+    def submit(self, name: str, func: Callable, *args) -> bool:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="background-jobs", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((name, func, args))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+            logger.warning(f"Очередь фоновых задач заполнена, задача {name} отброшена.")
+            return False
+
+    def _run(self):
+        while True:
+            name, func, args = self._queue.get()
+            try:
+                func(*args)
+                outcome = "completed"
+            except Exception as e:
+                logger.exception(f"Ошибка фоновой задачи {name}: {e}")
+                outcome = "failed"
+            with self._lock:
+                self._stats[outcome] += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"queued": self._queue.qsize(), **self._stats}
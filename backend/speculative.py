@@ -0,0 +1,164 @@
+import os
+import json
+import threading
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from backend.model_manager import USER_DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+SPECULATIVE_MODES = ("off", "prompt_lookup", "draft_model")
+DEFAULT_CONFIG = {"mode": "off", "num_pred_tokens": 10, "max_ngram_size": 2, "draft_model": None}
+
+
+class DraftModelDecoding(LlamaDraftModel):
+    """Черновик от маленькой GGUF-модели с тем же словарем, что и основная.
+
+    Маленькая модель жадно генерирует num_pred_tokens токенов продолжения, а основная
+    проверяет их одним батчем. Собственный KV-кеш маленькой модели переиспользуется
+    между вызовами: generate сам находит общий префикс с прошлым контекстом.
+    """
+
+    def __init__(self, draft_llm: Llama, num_pred_tokens: int = 10):
+        self.draft_llm = draft_llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft_tokens = []
+        for token in self.draft_llm.generate(input_ids.tolist(), temp=0.0):
+            if token == self.draft_llm.token_eos():
+                break
+            draft_tokens.append(token)
+            if len(draft_tokens) >= self.num_pred_tokens:
+                break
+        return np.array(draft_tokens, dtype=np.intc)
+
+
+class TrackedDraftModel(LlamaDraftModel):
+    """Обертка над любым черновиком, считающая предложенные и принятые токены.
+
+    llama-cpp-python не сообщает, сколько черновых токенов принято, но это видно по
+    следующему вызову: его контекст — прошлый контекст плюс принятые токены черновика
+    плюс один токен основной модели. Совпадающий префикс черновика и есть принятая часть.
+    """
+
+    def __init__(self, inner: LlamaDraftModel):
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._pending_context_len = 0
+        self._pending_draft = None
+        self.stats = {"rounds": 0, "proposed": 0, "accepted": 0}
+
+    def _resolve_pending(self, input_ids):
+        if self._pending_draft is None or len(input_ids) <= self._pending_context_len:
+            return
+        produced = input_ids[self._pending_context_len:]
+        accepted = 0
+        for draft_token, real_token in zip(self._pending_draft, produced):
+            if draft_token != real_token:
+                break
+            accepted += 1
+        self.stats["rounds"] += 1
+        self.stats["proposed"] += len(self._pending_draft)
+        self.stats["accepted"] += accepted
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = self.inner(input_ids, **kwargs)
+        with self._lock:
+            self._resolve_pending(input_ids)
+            self._pending_context_len = len(input_ids)
+            self._pending_draft = draft.tolist()
+        return draft
+
+    def reset_pending(self):
+        """Вызывается перед новой генерацией: последний черновик прошлой генерации не проверялся."""
+        with self._lock:
+            self._pending_draft = None
+            self._pending_context_len = 0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+class SpeculativeConfigStore:
+    """Настройки спекулятивного декодирования по имени модели (speculative.json)."""
+    STORE_PATH = os.path.join(USER_DATA_DIR, "speculative.json")
+
+    def __init__(self, store_path: str | None = None):
+        self.store_path = store_path or self.STORE_PATH
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict] = {}
+        if os.path.exists(self.store_path):
+            try:
+                with open(self.store_path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать настройки спекулятивного декодирования {self.store_path}: {e}")
+
+    def get(self, model_name: str) -> Dict:
+        with self._lock:
+            return {**DEFAULT_CONFIG, **self._data.get(model_name, {})}
+
+    def put(self, model_name: str, config: Dict):
+        with self._lock:
+            self._data[model_name] = config
+            tmp_path = self.store_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_path, self.store_path)
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить настройки спекулятивного декодирования {self.store_path}: {e}")
+
+    def all(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: {**DEFAULT_CONFIG, **config} for name, config in self._data.items()}
+
+
+def create_draft_model(config: Dict, models_dir: str, llama_kwargs: Dict) -> Optional[TrackedDraftModel]:
+    """Создает черновик по настройкам модели; None, если спекулятивное декодирование выключено."""
+    mode = config.get("mode", "off")
+    if mode == "prompt_lookup":
+        inner = LlamaPromptLookupDecoding(
+            max_ngram_size=config.get("max_ngram_size", 2),
+            num_pred_tokens=config.get("num_pred_tokens", 10),
+        )
+    elif mode == "draft_model":
+        draft_path = os.path.join(models_dir, config["draft_model"])
+        if not os.path.exists(draft_path):
+            raise FileNotFoundError(f"Черновая модель {config['draft_model']} не найдена в {models_dir}")
+        draft_llm = Llama(model_path=draft_path, **llama_kwargs)
+        inner = DraftModelDecoding(draft_llm, num_pred_tokens=config.get("num_pred_tokens", 10))
+    else:
+        return None
+    return TrackedDraftModel(inner)
+
+
+def create_llama_with_draft(model_path: str, llama_kwargs: Dict, speculative_config: Dict,
+                            models_dir: str, draft_kwargs: Dict) -> Llama:
+    """Создает Llama с черновиком по настройкам модели (если они есть).
+
+    Используется и в процессе API, и в процессах-воркерах (backend/model_worker.py).
+    """
+    draft_model = None
+    if speculative_config.get("mode", "off") != "off":
+        try:
+            draft_model = create_draft_model(speculative_config, models_dir, draft_kwargs)
+            logger.info(f"Спекулятивное декодирование включено: {speculative_config}")
+        except Exception as e:
+            # Без черновика модель все равно работает, просто медленнее
+            logger.warning(f"Не удалось создать черновик для спекулятивного декодирования: {e}")
+    llm = Llama(model_path=model_path, draft_model=draft_model, **llama_kwargs)
+    if draft_model and speculative_config["mode"] == "draft_model":
+        draft_vocab = draft_model.inner.draft_llm.n_vocab()
+        if draft_vocab != llm.n_vocab():
+            logger.warning(f"Словарь черновой модели ({draft_vocab}) не совпадает с основной ({llm.n_vocab()}), "
+                           f"спекулятивное декодирование отключено.")
+            llm.draft_model = None
+    return llm
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+import pytest
+
+from backend.scheduler import GenerationScheduler
+
+TOKEN_DELAY = 0.05
+BACKGROUND_TOKENS = 40
+
+
+class FakeLlama:
+    """Модель в процессе API без llama.cpp: по чанку на токен с задержкой, как настоящий поток."""
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.n_tokens = 0
+        self.generating = threading.Event()
+
+    def tokenize(self, data: bytes):
+        return data.split()
+
+    def __call__(self, prompt, echo=False, stream=True, max_tokens=16, **params):
+        def chunks():
+            self.n_tokens = len(prompt.split())
+            for i in range(max_tokens):
+                self.generating.set()
+                time.sleep(TOKEN_DELAY)
+                self.n_tokens += 1
+                yield {"choices": [{"text": " t", "finish_reason": "length" if i == max_tokens - 1 else None}]}
+        return chunks()
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    pytest.importorskip("llama_cpp")
+    # Папка данных пользователя (БД, индексы моделей) — временная, а не настоящая %APPDATA%
+    os.environ["XDG_DATA_HOME"] = str(tmp_path_factory.mktemp("data"))
+    from backend.api import api
+    return api
+
+
+@pytest.fixture
+def inprocess_model(api, tmp_path, monkeypatch):
+    llm = FakeLlama(str(tmp_path / "model.gguf"))
+    monkeypatch.setattr(api, "WORKER_MODE", "inprocess")
+    monkeypatch.setattr(api, "llm_instance", llm)
+    monkeypatch.setattr(api, "generation_scheduler", GenerationScheduler())
+    return llm
+
+
+def completion_spec(max_tokens: int):
+    return {"kind": "completion", "prompt": "User: hi\n\nAssistant:",
+            "params": {"max_tokens": max_tokens, "temperature": 0, "top_p": 1.0, "stop": []}}
+
+
+def test_interactive_turn_preempts_background_generation(api, inprocess_model):
+    model_path = inprocess_model.model_path
+    background = {}
+
+    def run_background():
+        background["text"] = api.run_background_generation("fake", model_path, completion_spec(BACKGROUND_TOKENS))
+        background["finished"] = time.monotonic()
+
+    thread = threading.Thread(target=run_background)
+    thread.start()
+    assert inprocess_model.generating.wait(5)
+
+    # Подготовка хода не ждет llm_lock, который держит фоновая генерация
+    start = time.monotonic()
+    api.load_model_for_turn("fake", model_path)
+    assert api.tokenize_prompt("fake", model_path, "User: hello") == [b"User:", b"hello"]
+    assert time.monotonic() - start < 1.0
+
+    result = api.run_model_stream("fake", model_path, completion_spec(3), api.CancellationToken())
+    interactive_finished = time.monotonic()
+    thread.join(10)
+
+    assert result["completion_tokens"] == 3 and result["cancelled"] is None
+    # Интерактивный ход закончился раньше фоновой задачи, а она потом продолжила с места остановки
+    assert interactive_finished < background["finished"]
+    assert background["text"] == " t" * BACKGROUND_TOKENS
+    snapshot = api.generation_scheduler.snapshot()
+    assert snapshot["preemptions"] == 1
+    assert snapshot["resumes"] == 1
+
+
+def test_calibration_yields_to_interactive_turn_and_resumes(api, inprocess_model, monkeypatch):
+    model_path = inprocess_model.model_path
+    measured = []
+
+    def fake_benchmark(llama_cls, path, base_kwargs, params):
+        measured.append(dict(params))
+        time.sleep(0.1)
+        return {"params": params, "prompt_tps": 100.0 + len(measured), "decode_tps": 10.0, "turn_seconds": 1.0}
+
+    monkeypatch.setattr(api.inference_tuning, "benchmark_config", fake_benchmark)
+    monkeypatch.setattr(api, "get_base_llama_kwargs", lambda: {"n_gpu_layers": 0})
+    monkeypatch.setattr(api.tuning_store, "put", lambda path, result: None)
+    # Калибровка выгружает модель; интерактивный ход загрузит ее заново
+    monkeypatch.setattr(api, "load_model", lambda name: setattr(api, "llm_instance", FakeLlama(model_path)))
+
+    thread = threading.Thread(target=api.calibrate_model, args=("fake", model_path, True))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not measured and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert measured
+
+    result = api.run_model_stream("fake", model_path, completion_spec(3), api.CancellationToken())
+    assert result["completion_tokens"] == 3
+    thread.join(10)
+
+    assert api.calibration_status["state"] == "done"
+    assert api.calibration_status["preemptions"] == 1
+    # После вытеснения калибровка продолжила с места остановки, не повторяя замеры
+    measured_keys = [tuple(sorted(params.items())) for params in measured]
+    assert len(set(measured_keys)) == len(measured_keys)
+    trial_keys = {tuple(sorted(trial["params"].items())) for trial in api.calibration_status["result"]["trials"]}
+    assert trial_keys == set(measured_keys)
+
+
+def test_background_job_is_dropped_if_model_changed_while_queued(api, inprocess_model, tmp_path, monkeypatch):
+    model_path = inprocess_model.model_path
+    held, release = threading.Event(), threading.Event()
+    background = {}
+
+    def hold():
+        with api.generation_scheduler.slot(api.generation_resource(model_path), api.INTERACTIVE):
+            held.set()
+            release.wait(5)
+
+    def run_background():
+        background["text"] = api.run_background_generation("fake", model_path, completion_spec(3))
+
+    def load_model(model_name):
+        raise AssertionError("фоновая задача не должна загружать модель")
+
+    monkeypatch.setattr(api, "load_model", load_model)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    assert held.wait(5)
+    thread = threading.Thread(target=run_background)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while api.generation_scheduler.snapshot()["classes"]["background"]["waiting"] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # Пока задача ждала очередь, пользователь переключился на другую модель
+    other = FakeLlama(str(tmp_path / "other.gguf"))
+    monkeypatch.setattr(api, "llm_instance", other)
+    release.set()
+    holder.join(5)
+    thread.join(5)
+    assert background == {"text": None}
+    assert api.llm_instance is other
@@ -0,0 +1,108 @@
+from backend.chat_cache import MESSAGE_OVERHEAD_BYTES, ChatCache
+
+
+def make_messages(count: int, start: int = 1):
+    return [{"message_id": i, "sender": "user", "content": f"m{i}", "timestamp": ""}
+            for i in range(start, start + count)]
+
+
+class FakeDB:
+    """Сообщения чатов и счетчик чтений: по нему видно, попал ли запрос в кеш."""
+
+    def __init__(self, chats):
+        self.chats = chats
+        self.loads = []
+
+    def loader(self, chat_id: str):
+        def load(limit):
+            self.loads.append((chat_id, limit))
+            messages = self.chats.get(chat_id)
+            if messages is None:
+                return None
+            return [dict(m) for m in (messages if limit is None else messages[-limit:])]
+        return load
+
+
+def ids(messages):
+    return [message["message_id"] for message in messages]
+
+
+def test_limited_read_fills_window_and_serves_later_reads():
+    db = FakeDB({"c": make_messages(10)})
+    cache = ChatCache(window_size=5)
+    assert ids(cache.messages("c", db.loader("c"), limit=3)) == [8, 9, 10]
+    assert db.loads == [("c", 5)]  # Сразу окно целиком, а не 3
+    assert ids(cache.messages("c", db.loader("c"), limit=5)) == [6, 7, 8, 9, 10]
+    assert len(db.loads) == 1
+    # Окно неполное: вся история читается из БД
+    assert ids(cache.messages("c", db.loader("c"))) == list(range(1, 11))
+    assert db.loads[-1] == ("c", None)
+
+
+def test_short_chat_window_is_complete():
+    db = FakeDB({"c": make_messages(3)})
+    cache = ChatCache(window_size=5)
+    cache.messages("c", db.loader("c"), limit=2)
+    assert ids(cache.messages("c", db.loader("c"))) == [1, 2, 3]
+    assert cache.messages_version("c", lambda: None) is None  # Без списка чатов версия не из кеша
+    assert len(db.loads) == 1
+
+
+def test_add_message_keeps_window_ordered_and_bounded():
+    db = FakeDB({"c": make_messages(4)})
+    cache = ChatCache(window_size=4)
+    cache.messages("c", db.loader("c"))
+    cache.add_message("c", make_messages(1, start=6)[0])
+    cache.add_message("c", make_messages(1, start=5)[0])  # Параллельная запись пришла позже
+    cache.add_message("c", make_messages(1, start=6)[0])  # Повтор уже известного
+    assert ids(cache.messages("c", db.loader("c"), limit=4)) == [3, 4, 5, 6]
+    assert len(db.loads) == 1
+    cache.messages("c", db.loader("c"))  # Старые сообщения вытеснены из окна — снова БД
+    assert len(db.loads) == 2
+
+
+def test_load_overlapping_a_write_is_not_cached():
+    db = FakeDB({"c": make_messages(2)})
+    cache = ChatCache(window_size=5)
+
+    def load_racing_with_write(limit):
+        rows = db.loader("c")(limit)
+        # Пока читали, другой запрос записал сообщение: прочитанное уже устарело
+        db.chats["c"].append(make_messages(1, start=3)[0])
+        cache.add_message("c", db.chats["c"][-1])
+        return rows
+
+    assert ids(cache.messages("c", load_racing_with_write)) == [1, 2]
+    assert ids(cache.messages("c", db.loader("c"))) == [1, 2, 3]
+    assert ids(cache.messages("c", db.loader("c"))) == [1, 2, 3]
+    assert len(db.loads) == 2
+
+
+def test_windows_are_evicted_lru_by_size():
+    message_bytes = len("m1") + MESSAGE_OVERHEAD_BYTES
+    db = FakeDB({name: make_messages(2) for name in ("a", "b", "c")})
+    cache = ChatCache(max_bytes=5 * message_bytes, window_size=2)
+    cache.messages("a", db.loader("a"))
+    cache.messages("b", db.loader("b"))
+    cache.messages("a", db.loader("a"))  # a свежее b
+    cache.messages("c", db.loader("c"))
+    assert cache.stats()["windows"] == 2 and cache.stats()["evictions"] == 1
+    cache.messages("a", db.loader("a"))
+    assert db.loads == [("a", None), ("b", None), ("c", None)]
+    cache.messages("b", db.loader("b"))
+    assert db.loads[-1] == ("b", None)
+
+
+def test_chat_list_order_and_unknown_chat():
+    cache = ChatCache()
+    rows = [{"chat_id": "b", "title": "B", "last_modified_at": "2026-01-02"},
+            {"chat_id": "a", "title": "A", "last_modified_at": "2026-01-01"}]
+    assert cache.chats(lambda: rows) == rows
+    cache.add_message("a", {"message_id": 1, "content": "hi"}, last_modified_at="2026-01-03")
+    assert [chat["chat_id"] for chat in cache.chats(lambda: [])] == ["a", "b"]
+    assert cache.chats_version(lambda: (0, None)) == (2, "2026-01-03")
+    # Список полный: чата нет — None без обращения к БД
+    assert cache.messages("missing", lambda limit: 1 / 0) is None
+    cache.add_chat({"chat_id": "c", "title": "C", "last_modified_at": "2026-01-04"})
+    assert cache.messages("c", lambda limit: 1 / 0) == []
+    assert cache.messages_version("c", lambda: 1 / 0) == ("2026-01-04", None)
@@ -0,0 +1,102 @@
+import pytest
+
+from backend import client_limits
+from backend.client_limits import MIN_PRUNE_BUCKETS, ClientIdentity, ClientLimiter, ClientRejected, parse_api_keys
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(client_limits, "time", fake)
+    return fake
+
+
+def test_parse_api_keys_with_weights():
+    keys = parse_api_keys("alice:key-a:2, bob:key-b, broken, eve:key-e:heavy")
+    assert {key: (client.client_id, client.weight) for key, client in keys.items()} == {
+        "key-a": ("alice", 2.0), "key-b": ("bob", 1.0), "key-e": ("eve", 1.0)}
+
+
+def test_identify_by_key_header_or_address():
+    limiter = ClientLimiter(parse_api_keys("alice:key-a"))
+    assert limiter.identify({"Authorization": "Bearer key-a"}).client_id == "alice"
+    client = limiter.identify({"X-Client-Id": "tab-1"}, remote_host="10.0.0.2")
+    assert (client.client_id, client.label) == ("ip:10.0.0.2", "tab-1")
+    assert limiter.identify({}).client_id == "anonymous"
+    with pytest.raises(ClientRejected) as error:
+        ClientLimiter({}, require_api_key=True).identify({"X-API-Key": "wrong"})
+    assert error.value.status_code == 401
+
+
+def test_request_bucket_refills_over_time(clock):
+    limiter = ClientLimiter({}, requests_per_minute=2)
+    client = ClientIdentity("a")
+    limiter.admit(client).release()
+    limiter.admit(client).release()
+    with pytest.raises(ClientRejected) as error:
+        limiter.admit(client)
+    assert error.value.reason == "requests" and error.value.headers() == {"Retry-After": "30"}
+    limiter.admit(ClientIdentity("b")).release()  # У другого клиента свое ведро
+    clock.now += 30
+    limiter.admit(client).release()
+
+
+def test_token_debt_blocks_until_repaid(clock):
+    limiter = ClientLimiter({}, tokens_per_minute=600)
+    client = ClientIdentity("a")
+    limiter.admit(client).release()
+    limiter.charge_tokens("a", 1200)  # Один длинный ответ: 600 токенов долга
+    with pytest.raises(ClientRejected) as error:
+        limiter.admit(client)
+    assert error.value.reason == "tokens" and error.value.retry_after == pytest.approx(60.1)
+    clock.now += 61
+    limiter.admit(client).release()
+
+
+def test_concurrency_limit_is_freed_by_release():
+    limiter = ClientLimiter({}, max_concurrent=1)
+    client = ClientIdentity("a")
+    lease = limiter.admit(client)
+    with pytest.raises(ClientRejected) as error:
+        limiter.admit(client)
+    assert error.value.reason == "concurrency"
+    lease.release()
+    lease.release()  # Повторный release не освобождает чужой слот
+    assert limiter.snapshot()["in_flight"] == {}
+    limiter.admit(client)
+    assert limiter.snapshot()["in_flight"] == {"a": 1}
+
+
+def test_rotating_client_id_does_not_bypass_limits(clock):
+    limiter = ClientLimiter({}, requests_per_minute=2, max_concurrent=1)
+    lease = limiter.admit(limiter.identify({"X-Client-Id": "first"}, remote_host="10.0.0.2"))
+    with pytest.raises(ClientRejected):
+        limiter.admit(limiter.identify({"X-Client-Id": "second"}, remote_host="10.0.0.2"))
+    lease.release()
+    limiter.admit(limiter.identify({"X-Client-Id": "third"}, remote_host="10.0.0.2")).release()
+    with pytest.raises(ClientRejected) as error:
+        limiter.admit(limiter.identify({"X-Client-Id": "fourth"}, remote_host="10.0.0.2"))
+    assert error.value.reason == "requests"
+
+
+def test_refilled_buckets_are_pruned(clock):
+    limiter = ClientLimiter({}, requests_per_minute=60, tokens_per_minute=1000)
+    limiter.admit(ClientIdentity("ip:debtor")).release()
+    limiter.charge_tokens("ip:debtor", 5000)  # Долг на 4 минуты
+    for batch in range(2):
+        for i in range(MIN_PRUNE_BUCKETS):
+            limiter.admit(ClientIdentity(f"ip:{batch}-{i}")).release()
+        clock.now += 2  # Ведра клиентов с одним запросом пополнились
+    # Без чистки было бы 2 ведра на каждого из 2049 клиентов
+    assert limiter.snapshot()["tracked_buckets"] <= 2 * MIN_PRUNE_BUCKETS
+    with pytest.raises(ClientRejected) as error:
+        limiter.admit(ClientIdentity("ip:debtor"))  # Непополненное ведро с долгом не выброшено
+    assert error.value.reason == "tokens"
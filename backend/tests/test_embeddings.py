@@ -0,0 +1,83 @@
+import asyncio
+import os
+import pickle
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from backend.client_limits import ClientLimiter
+from backend.scheduler import GenerationScheduler
+
+
+class FakeEmbeddingLlama:
+    """Модель в режиме эмбеддингов: токен — слово, вектор — число слов."""
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+
+    def tokenize(self, data: bytes):
+        return data.split()
+
+    def embed(self, inputs, normalize=True, return_count=True):
+        return [[float(len(text.split()))] for text in inputs], sum(len(text.split()) for text in inputs)
+
+
+@pytest.fixture(scope="module")
+def compat(tmp_path_factory):
+    pytest.importorskip("llama_cpp")
+    os.environ["XDG_DATA_HOME"] = str(tmp_path_factory.mktemp("data"))
+    from backend.api import openai_compat
+    return openai_compat
+
+
+@pytest.fixture
+def model_path(compat, tmp_path, monkeypatch):
+    path = tmp_path / "model.gguf"
+    path.write_bytes(b"gguf")
+    monkeypatch.setattr(compat.core, "WORKER_MODE", "inprocess")
+    monkeypatch.setattr(compat.core, "resolve_model_path", lambda model_name: str(path))
+    monkeypatch.setattr(compat.core, "generation_scheduler", GenerationScheduler())
+    monkeypatch.setattr(compat.core, "client_limiter", ClientLimiter({}))
+    monkeypatch.setattr(compat, "embedding_instance", None)
+    return str(path)
+
+
+def embed(compat, inputs):
+    request = Request({"type": "http", "method": "POST", "path": "/v1/embeddings", "query_string": b"",
+                       "headers": [], "client": ("10.0.0.2", 1234)})
+    return asyncio.run(compat.create_embeddings(compat.EmbeddingRequestBody(model="model.gguf", input=inputs),
+                                                request))
+
+
+def test_embeddings_go_through_client_limits_and_reject_long_input(compat, model_path, monkeypatch):
+    monkeypatch.setattr(compat.embeddings, "create_embedding_llama",
+                        lambda path, kwargs: FakeEmbeddingLlama(path))
+    response = embed(compat, ["one two", "three"])
+    assert [item["embedding"] for item in response["data"]] == [[2.0], [1.0]]
+    assert response["usage"]["total_tokens"] == 3
+
+    with pytest.raises(HTTPException) as error:
+        embed(compat, ["short", "word " * (compat.embeddings.EMBEDDING_CTX + 1)])
+    assert error.value.status_code == 400
+    assert error.value.detail["error"]["type"] == "invalid_request_error"
+    assert error.value.detail["error"]["param"] == "input"
+    # Слот клиента освобожден, оба запроса прошли через очередь модели
+    assert compat.core.client_limiter.snapshot()["in_flight"] == {}
+    assert compat.core.generation_scheduler.snapshot()["classes"]["interactive"]["jobs"] == 2
+
+
+def test_embedding_model_that_does_not_fit_frees_generation_model(compat, model_path, monkeypatch):
+    monkeypatch.setattr(compat.core, "llm_instance", FakeEmbeddingLlama(model_path))
+    monkeypatch.setattr(compat.embeddings, "get_available_memory_bytes", lambda: 1024)
+    with pytest.raises(HTTPException) as error:
+        embed(compat, "hello")
+    assert error.value.status_code == 503
+    assert error.value.detail["error"]["code"] == "insufficient_memory"
+    assert compat.core.llm_instance is None and compat.embedding_instance is None
+
+
+def test_embedding_error_survives_worker_pipe(compat):
+    error = pickle.loads(pickle.dumps(compat.embeddings.EmbeddingError(
+        400, "too long", "invalid_request_error", "context_length_exceeded", "input")))
+    assert (error.status_code, str(error), error.param) == (400, "too long", "input")
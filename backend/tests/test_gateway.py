@@ -0,0 +1,129 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from backend import gateway
+from backend.gateway import MODEL_LOAD_PENALTY, NodePool
+
+URLS = ["http://node-a", "http://node-b", "http://node-c"]
+
+
+def make_pool(max_tracked_chats: int = 100) -> NodePool:
+    pool = NodePool(URLS, max_tracked_chats=max_tracked_chats)
+    for node in pool.nodes:
+        node.healthy = True
+    return pool
+
+
+def test_rank_prefers_resident_model_over_idle_node():
+    pool = make_pool()
+    a, b, c = pool.nodes
+    a.resident_models = ["qwen"]
+    a.active_generations = 2
+    ranked = pool.rank(model="qwen")
+    assert ranked[0] is a  # 2 запроса в очереди дешевле загрузки модели
+    a.active_generations = int(MODEL_LOAD_PENALTY) + 1
+    assert pool.rank(model="qwen")[0] is not a
+
+
+def test_rank_spreads_new_chats_deterministically():
+    pool = make_pool()
+    first = [pool.rank(chat_id=f"chat-{i}")[0].url for i in range(30)]
+    assert first == [pool.rank(chat_id=f"chat-{i}")[0].url for i in range(30)]
+    assert len(set(first)) > 1
+
+
+def test_rank_skips_unhealthy_nodes():
+    pool = make_pool()
+    pool.nodes[0].healthy = False
+    assert pool.nodes[0] not in pool.rank(model="qwen")
+
+
+def test_known_chat_goes_only_to_its_node():
+    pool = make_pool()
+    a, b, c = pool.nodes
+    b.resident_models = ["qwen"]
+    pool.remember_chat("chat-1", a.url)
+    a.active_generations = 10
+    assert pool.rank(chat_id="chat-1", model="qwen") == [a]
+    a.healthy = False
+    assert pool.rank(chat_id="chat-1", model="qwen") == []
+
+
+def test_chat_affinity_is_bounded_lru():
+    pool = make_pool(max_tracked_chats=2)
+    pool.remember_chat("chat-1", URLS[0])
+    pool.remember_chat("chat-2", URLS[1])
+    assert pool.chat_owner("chat-1") == URLS[0]  # chat-1 теперь свежее chat-2
+    pool.remember_chat("chat-3", URLS[2])
+    assert list(pool.chat_affinity) == ["chat-1", "chat-3"]
+    pool.forget_chat("chat-1")
+    assert pool.chat_owner("chat-1") is None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_request(method: str) -> Request:
+    return Request({"type": "http", "method": method, "path": "/api/query", "query_string": b"", "headers": []})
+
+
+async def proxy_with_nodes(method: str, first_node: str):
+    """Прокси через два узла: первый рвет соединение после запроса ("drop") или не принимает его ("refuse"),
+    второй отвечает 200. Возвращает ответ (или HTTPException) и число запросов, дошедших до второго."""
+    served = []
+
+    async def drop(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.close()
+
+    async def answer(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        served.append(1)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}")
+        await writer.drain()
+        writer.close()
+
+    dropping = await asyncio.start_server(drop, "127.0.0.1", 0)
+    answering = await asyncio.start_server(answer, "127.0.0.1", 0)
+    first_port = dropping.sockets[0].getsockname()[1] if first_node == "drop" else free_port()
+    pool = NodePool([f"http://127.0.0.1:{first_port}", f"http://127.0.0.1:{answering.sockets[0].getsockname()[1]}"])
+    pool.session = aiohttp.ClientSession()
+    gateway.pool = pool
+    try:
+        response = await gateway.proxy(make_request(method), "/api/query", list(pool.nodes), b"{}")
+        return response, len(served)
+    except HTTPException as e:
+        return e, len(served)
+    finally:
+        await pool.session.close()
+        dropping.close()
+        answering.close()
+
+
+@pytest.fixture(autouse=True)
+def restore_pool(monkeypatch):
+    monkeypatch.setattr(gateway, "pool", None)
+
+
+def test_post_is_not_retried_after_connection_drop():
+    result, served = asyncio.run(proxy_with_nodes("POST", "drop"))
+    assert isinstance(result, HTTPException) and result.status_code == 502
+    assert served == 0
+
+
+def test_get_is_retried_after_connection_drop():
+    result, served = asyncio.run(proxy_with_nodes("GET", "drop"))
+    assert result.status_code == 200 and served == 1
+
+
+def test_post_is_retried_when_node_refuses_connection():
+    result, served = asyncio.run(proxy_with_nodes("POST", "refuse"))
+    assert result.status_code == 200 and served == 1
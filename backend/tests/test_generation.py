@@ -0,0 +1,46 @@
+from backend.generation import CancellationToken, generate_on_llm
+
+SPEC = {"kind": "completion", "prompt": "one two three", "params": {"max_tokens": 4}}
+
+
+class FakeLlama:
+    """n_tokens как у llama.cpp: обновляется, только когда поток действительно читают."""
+
+    def __init__(self, stale_tokens: int = 0):
+        self.n_tokens = stale_tokens
+
+    def __call__(self, prompt, echo=False, stream=True, max_tokens=16, **params):
+        def chunks():
+            self.n_tokens = len(prompt.split())
+            for i in range(max_tokens):
+                self.n_tokens += 1
+                yield {"choices": [{"text": f" t{i}", "finish_reason": "length" if i == max_tokens - 1 else None}]}
+        return chunks()
+
+
+def test_prompt_and_completion_tokens_are_counted():
+    result = generate_on_llm(FakeLlama(stale_tokens=500), SPEC, CancellationToken())
+    assert result["text"] == " t0 t1 t2 t3"
+    assert (result["prompt_tokens"], result["completion_tokens"]) == (3, 4)
+
+
+def test_cancelled_before_start_bills_no_prompt_tokens():
+    token = CancellationToken()
+    token.cancel("disconnect")
+    result = generate_on_llm(FakeLlama(stale_tokens=500), SPEC, token)
+    assert result["cancelled"] == "disconnect" and not result["started"]
+    assert (result["prompt_tokens"], result["completion_tokens"]) == (0, 0)
+
+
+def test_cancelled_mid_stream_keeps_partial_text():
+    token = CancellationToken()
+    pieces = []
+
+    def on_token(piece):
+        pieces.append(piece)
+        if len(pieces) == 2:
+            token.cancel("stop")
+
+    result = generate_on_llm(FakeLlama(), SPEC, token, on_token)
+    assert result["text"] == " t0 t1" and result["cancelled"] == "stop"
+    assert result["completion_tokens"] == 2
@@ -0,0 +1,94 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from backend import lora
+from backend.lora import LoraAdapterSet, apply_adapter
+
+
+class FakeLoraApi:
+    """Функции llama.cpp для LoRA: хэндл — имя файла адаптера, вызовы записываются."""
+
+    def __init__(self):
+        self.loaded = []
+        self.freed = []
+        self.attached = set()
+
+    def api(self):
+        return {"init": self.init, "set": self.set, "remove": self.remove, "free": self.free}
+
+    def init(self, model, path: bytes):
+        self.loaded.append(os.path.basename(path.decode("utf-8")))
+        return self.loaded[-1]
+
+    def set(self, ctx, handle, scale):
+        self.attached.add(handle)
+        return 0
+
+    def remove(self, ctx, handle):
+        self.attached.discard(handle)
+
+    def free(self, handle):
+        assert handle not in self.attached  # Активный адаптер нельзя освобождать, не сняв его с контекста
+        self.freed.append(handle)
+
+
+class FakeLlama:
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self._model = SimpleNamespace(model="model")
+        self._ctx = SimpleNamespace(ctx="ctx")
+
+    def reset(self):
+        pass
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    fake = FakeLoraApi()
+    monkeypatch.setattr(lora, "_lora_api", fake.api)
+    return fake
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "base.gguf"
+    path.write_bytes(b"gguf")
+    os.makedirs(lora.adapters_dir(str(path)))
+    for name in ("a", "b", "c"):
+        (tmp_path / "base.lora" / f"{name}.gguf").write_bytes(b"lora")
+    return str(path)
+
+
+def test_switching_past_cache_frees_least_recent_adapter(fake_api, model_path):
+    adapter_set = LoraAdapterSet(FakeLlama(model_path), cache_size=2)
+    for name in ("a", "b", "a", "c"):
+        adapter_set.apply(name)
+    assert fake_api.loaded == ["a.gguf", "b.gguf", "c.gguf"]  # a взят из кеша
+    assert fake_api.freed == ["b.gguf"] and fake_api.attached == {"c.gguf"}
+    adapter_set.apply(None)
+    assert fake_api.attached == set() and adapter_set.active is None
+
+
+def test_release_frees_all_adapters_of_model(fake_api, model_path):
+    llm = FakeLlama(model_path)
+    apply_adapter(llm, "a")
+    apply_adapter(llm, "b")
+    lora.release_adapters(llm)
+    assert sorted(fake_api.freed) == ["a.gguf", "b.gguf"] and fake_api.attached == set()
+    lora.release_adapters(llm)  # Повторно освобождать нечего
+    assert len(fake_api.freed) == 2
+
+
+def test_unloading_model_frees_its_adapters(fake_api, model_path, tmp_path_factory, monkeypatch):
+    pytest.importorskip("llama_cpp")
+    os.environ["XDG_DATA_HOME"] = str(tmp_path_factory.mktemp("data"))
+    from backend.api import api
+
+    llm = FakeLlama(model_path)
+    monkeypatch.setattr(api, "llm_instance", llm)
+    apply_adapter(llm, "a")
+    api.unload_model_path(model_path)
+    assert api.llm_instance is None
+    assert fake_api.freed == ["a.gguf"] and fake_api.attached == set()
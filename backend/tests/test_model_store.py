@@ -0,0 +1,105 @@
+import json
+import os
+import time
+
+import pytest
+
+from backend.model_manager import ModelStore, ModelStoreQuotaError, ModelUsageLog
+
+KB = 1024
+
+
+@pytest.fixture
+def models_dir(tmp_path):
+    path = tmp_path / "models"
+    path.mkdir()
+    return path
+
+
+def write_model(models_dir, file_name: str, size: int):
+    path = models_dir / file_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"\0" * size)
+
+
+def make_store(models_dir, files, quota_bytes=None, auto_evict=False) -> ModelStore:
+    """Хранилище с файлами files (имя -> размер), использованными в порядке перечисления."""
+    for file_name, size in files.items():
+        write_model(models_dir, file_name, size)
+    store = ModelStore(str(models_dir), quota_bytes=quota_bytes, auto_evict=auto_evict,
+                       index_path=str(models_dir.parent / "model_store.json"))
+    for file_name in files:
+        store.touch(file_name)
+        time.sleep(0.01)
+    return store
+
+
+def test_eviction_candidates_are_least_recently_used(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB, "b.gguf": 4 * KB, "c.gguf": 4 * KB}, quota_bytes=12 * KB)
+    store.touch("a.gguf")  # Теперь самый давний — b
+    assert [c["file_name"] for c in store.eviction_candidates(needed_bytes=2 * KB)] == ["b.gguf"]
+    assert [c["file_name"] for c in store.eviction_candidates(needed_bytes=6 * KB)] == ["b.gguf", "c.gguf"]
+    assert store.eviction_candidates(needed_bytes=0) == []
+
+
+def test_pinned_and_protected_models_are_not_candidates(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB, "b.gguf": 4 * KB, "c.gguf": 4 * KB}, quota_bytes=12 * KB)
+    store.set_pinned("a.gguf", True)
+    candidates = store.eviction_candidates(needed_bytes=2 * KB, protected=["b.gguf"])
+    assert [c["file_name"] for c in candidates] == ["c.gguf"]
+
+
+def test_split_model_is_one_candidate_with_all_parts(models_dir):
+    files = {"big-00001-of-00002.gguf": 4 * KB, "big-00002-of-00002.gguf": 4 * KB, "small.gguf": 2 * KB}
+    store = make_store(models_dir, files, quota_bytes=10 * KB, auto_evict=True)
+    store.touch("small.gguf")
+    candidates = store.eviction_candidates(needed_bytes=1 * KB)
+    assert [(c["file_name"], c["size"], c["parts"]) for c in candidates] == [("big-00001-of-00002.gguf", 8 * KB, 2)]
+    assert store.make_room(1 * KB) == ["big-00001-of-00002.gguf"]
+    assert sorted(os.listdir(models_dir)) == ["small.gguf"]
+    assert store.installed_files() == ["small.gguf"]
+
+
+def test_hardlinked_copies_count_once(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB}, quota_bytes=5 * KB)
+    os.link(models_dir / "a.gguf", models_dir / "a-copy.gguf")
+    store.scan()
+    assert store.stats()["used_bytes"] == 4 * KB
+    assert store.eviction_candidates(needed_bytes=1 * KB) == []
+
+
+def test_make_room_without_auto_evict_suggests_candidates(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB, "b.gguf": 4 * KB}, quota_bytes=8 * KB)
+    with pytest.raises(ModelStoreQuotaError) as error:
+        store.make_room(2 * KB)
+    assert [s["file_name"] for s in error.value.suggestions] == ["a.gguf"]
+    assert sorted(os.listdir(models_dir)) == ["a.gguf", "b.gguf"]
+
+
+def test_make_room_fails_when_eviction_is_not_enough(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB, "b.gguf": 4 * KB}, quota_bytes=8 * KB, auto_evict=True)
+    store.set_pinned("a.gguf", True)
+    with pytest.raises(ModelStoreQuotaError):
+        store.make_room(6 * KB)
+    assert store.make_room(4 * KB) == ["b.gguf"]
+
+
+def test_touch_is_written_by_flush_not_on_every_call(models_dir):
+    store = make_store(models_dir, {"a.gguf": 4 * KB}, quota_bytes=8 * KB)
+    index_path = models_dir.parent / "model_store.json"
+    before = json.loads(index_path.read_text())["a.gguf"]["last_used"]
+    store.touch("a.gguf")
+    assert json.loads(index_path.read_text())["a.gguf"]["last_used"] == before
+    store.flush()
+    assert json.loads(index_path.read_text())["a.gguf"]["last_used"] > before
+
+
+def test_usage_log_record_is_written_by_flush(tmp_path):
+    log_path = tmp_path / "model_usage.json"
+    usage_log = ModelUsageLog(str(log_path))
+    usage_log.record("qwen", "/models/qwen.gguf")
+    assert not log_path.exists()
+    assert usage_log.recent()[0]["name"] == "qwen"
+    usage_log.flush()
+    assert json.loads(log_path.read_text())["qwen"]["use_count"] == 1
+    assert ModelUsageLog(str(log_path)).recent()[0]["model_path"] == "/models/qwen.gguf"
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from backend import model_worker
+from backend.generation import CancellationToken
+from backend.model_worker import WorkerCrashedError, WorkerNotRunningError, WorkerPool
+
+
+class FakeWorker(model_worker.ModelWorker):
+    """Воркер без процесса: "запущен" — флаг; stop запоминает, держали ли в этот момент lock пула."""
+    pool = None
+
+    def __init__(self, model_path, config_factory, models_dir):
+        super().__init__(model_path, config_factory, models_dir)
+        self.running = False
+        self.stopped_under_pool_lock = None
+        self.in_generate = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def is_alive(self):
+        return self.running
+
+    def ensure_running(self, warm_up=False):
+        if self.retired:
+            raise WorkerCrashedError("retired")
+        self.running = True
+
+    def generate(self, spec, cancel_token, on_token=None):
+        self.ensure_running()
+        self.in_generate.set()
+        self.release.wait(5)
+        return {"text": self.model_path}
+
+    def stop(self):
+        self.stopped_under_pool_lock = self.pool._lock.locked()
+        self.running = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(model_worker, "ModelWorker", FakeWorker)
+    monkeypatch.setattr(WorkerPool, "_monitor", lambda self: None)
+    worker_pool = WorkerPool(lambda path: ({}, {}, {}), "models", max_workers=1)
+    monkeypatch.setattr(FakeWorker, "pool", worker_pool)
+    return worker_pool
+
+
+def test_new_worker_evicts_idle_one_outside_pool_lock(pool):
+    first = pool.get("a.gguf")
+    second = pool.get("b.gguf")
+    assert list(pool.workers) == ["b.gguf"] and second.running
+    assert first.retired and not first.running
+    assert first.stopped_under_pool_lock is False
+
+
+def test_worker_in_use_is_not_evicted(pool):
+    first = pool.get("a.gguf")
+    first.release.clear()
+    thread = threading.Thread(target=pool.generate, args=("a.gguf", {}, CancellationToken()))
+    thread.start()
+    assert first.in_generate.wait(5)
+    pool.get("b.gguf")  # Больше лимита: занятый воркер вытеснять нельзя
+    assert list(pool.workers) == ["a.gguf", "b.gguf"] and not first.retired
+    first.release.set()
+    thread.join(5)
+    pool.get("c.gguf")
+    assert "a.gguf" not in pool.workers and first.retired
+
+
+def test_stopped_worker_is_not_restarted_outside_pool(pool):
+    worker = pool.get("a.gguf")
+    pool.stop("a.gguf")
+    with pytest.raises(WorkerCrashedError):
+        worker.ensure_running()
+    assert pool.get("a.gguf") is not worker  # Следующий запрос получает новый воркер из пула
+
+
+def test_generate_without_start_needs_running_worker(pool):
+    with pytest.raises(WorkerNotRunningError):
+        pool.generate("a.gguf", {}, CancellationToken(), start=False)
+    assert not pool.workers  # Воркер не создан
+    pool.get("a.gguf")
+    assert pool.generate("a.gguf", {}, CancellationToken(), start=False) == {"text": "a.gguf"}
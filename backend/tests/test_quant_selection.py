@@ -0,0 +1,60 @@
+from backend.quant_selection import (MEMORY_OVERHEAD_BYTES, group_variants, is_secondary_shard, parse_quant,
+                                     select_variant, shard_file_names)
+
+GB = 1024 ** 3
+REPO_FILES = [
+    ("qwen-7b-Q8_0.gguf", 8 * GB),
+    ("qwen-7b-Q4_K_M.gguf", 4 * GB),
+    ("qwen-7b-IQ2_XS.gguf", 2 * GB),
+    ("mmproj-qwen-7b-F16.gguf", 1 * GB),
+    ("README.md", 1000),
+    ("f16/qwen-7b-F16-00001-of-00002.gguf", 8 * GB),
+    ("f16/qwen-7b-F16-00002-of-00002.gguf", 7 * GB),
+    ("bf16/qwen-7b-BF16-00001-of-00003.gguf", 8 * GB),  # Неполный набор частей
+]
+
+
+def budget(target: str, memory_gb: float, ram_gb: float = 32) -> dict:
+    return {"target": target, "memory_bytes": memory_gb * GB, "ram_bytes": ram_gb * GB, "bandwidth_gbps": 100}
+
+
+def test_parse_quant_and_shards():
+    assert parse_quant("Qwen-7B-q4_k_m.gguf") == "Q4_K_M"
+    assert parse_quant("model-IQ4_XS.gguf") == "IQ4_XS"  # Не Q4_K_S внутри длинного имени
+    assert parse_quant("model.gguf") is None
+    assert shard_file_names("f16/m-00002-of-00002.gguf") == ["f16/m-00001-of-00002.gguf",
+                                                             "f16/m-00002-of-00002.gguf"]
+    assert is_secondary_shard("m-00002-of-00002.gguf") and not is_secondary_shard("m-00001-of-00002.gguf")
+
+
+def test_group_variants_joins_shards_and_skips_projectors():
+    variants = group_variants(REPO_FILES)
+    assert [(v["file_name"], v["quant"], v["size_bytes"] // GB) for v in variants] == [
+        ("f16/qwen-7b-F16-00001-of-00002.gguf", "F16", 15),
+        ("qwen-7b-Q8_0.gguf", "Q8_0", 8),
+        ("qwen-7b-Q4_K_M.gguf", "Q4_K_M", 4),
+        ("qwen-7b-IQ2_XS.gguf", "IQ2_XS", 2),
+    ]
+    assert len(variants[0]["files"]) == 2
+
+
+def test_select_best_quality_that_fits_vram():
+    chosen = select_variant(group_variants(REPO_FILES), budget("gpu", 10))
+    assert chosen["quant"] == "Q8_0" and chosen["fits"]
+    assert chosen["memory_bytes"] == int(8 * GB * 1.1 + MEMORY_OVERHEAD_BYTES)
+    assert chosen["estimated_tokens_per_second"] == 12.5
+    assert [v["quant"] for v in chosen["alternatives"]] == ["F16", "Q4_K_M", "IQ2_XS"]
+
+
+def test_select_falls_back_to_ram_then_to_smallest():
+    variants = group_variants(REPO_FILES)
+    # В 1 ГБ VRAM не влезает ничего: лучший вариант, помещающийся в RAM
+    assert select_variant(variants, budget("gpu", 1, ram_gb=10))["quant"] == "Q8_0"
+    assert select_variant(variants, budget("cpu", 1, ram_gb=1))["quant"] == "IQ2_XS"
+
+
+def test_explicit_quant_wins_and_unknown_one_is_ignored():
+    variants = group_variants(REPO_FILES)
+    assert select_variant(variants, budget("gpu", 10), quant="q4_k_m")["quant"] == "Q4_K_M"
+    assert select_variant(variants, budget("gpu", 10), quant="Q3_K_S")["quant"] == "Q8_0"
+    assert select_variant([], budget("gpu", 10)) is None
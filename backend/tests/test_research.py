@@ -0,0 +1,122 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from backend import research
+from backend.research import MinHashIndex, is_allowed_url, parse_plan, select_passages, split_passages
+
+ARTICLE = ("GGUF is the binary file format used by llama.cpp to store model weights together with the tokenizer "
+           "and metadata in a single file. It replaced the older GGML format in August 2023. A GGUF file starts "
+           "with a header, followed by key-value metadata such as the architecture, context length and "
+           "quantization type, and then the tensor data aligned for memory mapping.")
+
+
+def test_parse_plan_strips_numbering_and_duplicates():
+    plan = "1. GGUF format\n- Q4_K_M bits per weight\n\n2) \"gguf format\"\n* KV cache memory\n«llama.cpp speed»"
+    assert parse_plan(plan, "How does GGUF work?", limit=3) == [
+        "How does GGUF work?", "GGUF format", "Q4_K_M bits per weight", "KV cache memory"]
+
+
+def test_parse_plan_without_subqueries_keeps_question():
+    assert parse_plan("", "How does GGUF work?") == ["How does GGUF work?"]
+    assert parse_plan("how does gguf work?", "How does GGUF work?") == ["How does GGUF work?"]
+
+
+def test_split_passages_overlap():
+    words = [f"w{i}" for i in range(250)]
+    passages = split_passages(" ".join(words), words=100, stride=80)
+    assert [len(passage.split()) for passage in passages] == [100, 100, 90]
+    assert passages[1].split()[0] == "w80" and passages[-1].split()[-1] == "w249"
+
+
+def test_minhash_drops_near_duplicates_only():
+    index = MinHashIndex()
+    assert index.add(ARTICLE)
+    assert not index.add(ARTICLE.replace("August 2023", "August, 2023"))  # Перепечатка с правкой
+    assert index.add("The KV cache keeps attention keys and values of processed tokens so new tokens attend "
+                     "to cached state instead of recomputing the whole prompt.")
+
+
+def test_select_passages_ranks_and_limits_per_source():
+    passages = [{"url": "a", "title": "", "text": "Q4_K_M quantization"},
+                {"url": "a", "title": "", "text": "Q4_K_M uses about 4.8 bits per weight"},
+                {"url": "a", "title": "", "text": "Q4_K_M bits"},
+                {"url": "b", "title": "", "text": "Q4_K_M"},
+                {"url": "c", "title": "", "text": "speculative decoding with a draft model"}]
+    selected = select_passages("Q4_K_M bits per weight", passages, top_k=10, per_source=2)
+    # Третий фрагмент с "a" не проходит по лимиту на источник, "c" не релевантен
+    assert [passage["text"] for passage in selected] == ["Q4_K_M uses about 4.8 bits per weight", "Q4_K_M bits",
+                                                         "Q4_K_M"]
+    assert selected[0]["score"] > selected[1]["score"] > selected[2]["score"] > 0
+    assert len(select_passages("Q4_K_M bits per weight", passages, top_k=1)) == 1
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/", "http://10.0.0.5/admin", "http://192.168.1.1/", "http://169.254.169.254/latest/meta-data",
+    "http://[::1]:8000/", "http://[::ffff:127.0.0.1]/", "http://[fe80::1%25eth0]/", "http://0.0.0.0:11434/",
+    "http://100.64.0.1/", "ftp://example.com/", "file:///etc/passwd",
+])
+def test_internal_and_non_http_urls_are_rejected(url):
+    assert not is_allowed_url(url)
+
+
+def test_public_urls_are_allowed():
+    assert is_allowed_url("https://93.184.216.34/page")
+    assert is_allowed_url("https://example.com/page")  # Имя проверит резолвер при соединении
+
+
+async def fetch_with_servers(url_template: str):
+    """Два сервера: 127.0.0.1 переадресует на 127.0.0.2, тот отдает страницу.
+    Возвращает результат fetch_page и число запросов, дошедших до каждого."""
+    served = {"first": 0, "second": 0}
+
+    async def second(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        served["second"] += 1
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 2\r\n\r\nok")
+        await writer.drain()
+        writer.close()
+
+    second_server = await asyncio.start_server(second, "127.0.0.2", 0)
+    second_port = second_server.sockets[0].getsockname()[1]
+
+    async def first(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        served["first"] += 1
+        writer.write(f"HTTP/1.1 302 Found\r\nLocation: http://127.0.0.2:{second_port}/\r\n"
+                     "Content-Length: 0\r\n\r\n".encode())
+        await writer.drain()
+        writer.close()
+
+    first_server = await asyncio.start_server(first, "127.0.0.1", 0)
+    url = url_template.format(port=first_server.sockets[0].getsockname()[1])
+    try:
+        async with research.page_session(aiohttp.ClientTimeout(total=5)) as session:
+            return await research.fetch_page(session, url, asyncio.Semaphore(1)), served
+    finally:
+        first_server.close()
+        second_server.close()
+
+
+def test_private_ip_in_url_is_not_fetched():
+    html, served = asyncio.run(fetch_with_servers("http://127.0.0.1:{port}/"))
+    assert html is None and served == {"first": 0, "second": 0}
+
+
+def test_hostname_resolving_to_loopback_is_not_fetched():
+    html, served = asyncio.run(fetch_with_servers("http://localhost:{port}/"))
+    assert html is None and served == {"first": 0, "second": 0}
+
+
+def test_redirect_to_private_address_is_not_followed(monkeypatch):
+    # 127.0.0.1 здесь играет роль сайта в интернете, 127.0.0.2 — внутреннего сервиса
+    monkeypatch.setattr(research, "is_public_address", lambda address: address == "127.0.0.1")
+    html, served = asyncio.run(fetch_with_servers("http://127.0.0.1:{port}/"))
+    assert html is None and served == {"first": 1, "second": 0}
+
+
+def test_allow_private_hosts_follows_redirects(monkeypatch):
+    monkeypatch.setattr(research, "RESEARCH_ALLOW_PRIVATE_HOSTS", True)
+    html, served = asyncio.run(fetch_with_servers("http://127.0.0.1:{port}/"))
+    assert html == "ok" and served == {"first": 1, "second": 1}
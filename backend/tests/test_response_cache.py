@@ -0,0 +1,27 @@
+from backend.response_cache import ResponseCache, create_embedder
+
+QUESTION = "Please explain in detail how packet headers, ports, checksums and delivery guarantees differ between TCP and {}."
+
+
+def make_cache() -> ResponseCache:
+    cache = ResponseCache(embedder=create_embedder(None))
+    cache.store("key-udp", "context", QUESTION.format("UDP"), "UDP answer")
+    return cache
+
+
+def test_exact_key_hits():
+    assert make_cache().lookup("key-udp", "context", QUESTION.format("UDP"))["tier"] == "exact"
+
+
+def test_hashing_embedder_is_not_semantic_by_default():
+    cache = make_cache()
+    assert not cache.embedder.semantic
+    # Триграммы считают эти вопросы почти одинаковыми, хотя ответы у них разные
+    assert cache.lookup("key-ip", "context", QUESTION.format("IP")) is None
+    assert cache.stats()["semantic_hits"] == 0
+
+
+def test_semantic_tier_only_on_request_and_same_context():
+    cache = make_cache()
+    assert cache.lookup("key-ip", "context", QUESTION.format("UDP") + " ", semantic=True)["tier"] == "semantic"
+    assert cache.lookup("key-ip", "other context", QUESTION.format("UDP"), semantic=True) is None
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from backend.generation import CancellationToken
+from backend.scheduler import BACKGROUND, INTERACTIVE, PREEMPTED, BackgroundJobs, GenerationScheduler
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def waiting(scheduler: GenerationScheduler) -> int:
+    return sum(info["waiting"] for info in scheduler.snapshot()["classes"].values())
+
+
+def run_queued(scheduler: GenerationScheduler, requests):
+    """Ставит запросы (имя, приоритет, клиент, стоимость, вес) в очередь по одному, пока ресурс занят,
+    и возвращает порядок, в котором они получили слот."""
+    order = []
+    release = threading.Event()
+    held = threading.Event()
+
+    def hold():
+        with scheduler.slot("model", INTERACTIVE):
+            held.set()
+            release.wait(5)
+
+    def request(name, priority, client_id, cost, weight):
+        with scheduler.slot("model", priority, client_id=client_id, weight=weight, cost=cost):
+            order.append(name)
+
+    threads = [threading.Thread(target=hold)]
+    threads[0].start()
+    assert held.wait(5)
+    for count, args in enumerate(requests, start=1):
+        threads.append(threading.Thread(target=request, args=args))
+        threads[-1].start()
+        wait_until(lambda: waiting(scheduler) == count)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_interactive_goes_before_earlier_background():
+    scheduler = GenerationScheduler()
+    order = run_queued(scheduler, [("title", BACKGROUND, None, 1, 1.0), ("summary", BACKGROUND, None, 1, 1.0),
+                                   ("turn", INTERACTIVE, None, 1, 1.0)])
+    assert order == ["turn", "title", "summary"]
+    assert scheduler.snapshot()["classes"]["background"]["jobs"] == 2
+
+
+def test_fair_queue_lets_other_client_overtake_long_backlog():
+    scheduler = GenerationScheduler()
+    order = run_queued(scheduler, [("a1", INTERACTIVE, "a", 100, 1.0), ("a2", INTERACTIVE, "a", 100, 1.0),
+                                   ("a3", INTERACTIVE, "a", 100, 1.0), ("b1", INTERACTIVE, "b", 100, 1.0)])
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_weight_gives_client_larger_share():
+    scheduler = GenerationScheduler()
+    order = run_queued(scheduler, [("b1", INTERACTIVE, "b", 100, 1.0), ("b2", INTERACTIVE, "b", 100, 1.0),
+                                   ("a1", INTERACTIVE, "a", 100, 4.0), ("a2", INTERACTIVE, "a", 100, 4.0)])
+    assert order == ["a1", "a2", "b1", "b2"]  # Метки a: 25, 50; b: 100, 200
+
+
+def test_interactive_request_preempts_background_holder():
+    scheduler = GenerationScheduler()
+    token = CancellationToken()
+    in_background = threading.Event()
+
+    def background():
+        with scheduler.slot("model", BACKGROUND, token):
+            in_background.set()
+            wait_until(lambda: token.cancelled)
+
+    thread = threading.Thread(target=background)
+    thread.start()
+    assert in_background.wait(5)
+    with scheduler.slot("model", INTERACTIVE):
+        assert token.reason == PREEMPTED
+    thread.join(5)
+    scheduler.record_resume()
+    assert (scheduler.snapshot()["preemptions"], scheduler.snapshot()["resumes"]) == (1, 1)
+
+
+def test_interactive_holder_is_not_preempted_and_resources_are_independent():
+    scheduler = GenerationScheduler()
+    token = CancellationToken()
+    release = threading.Event()
+
+    def hold():
+        with scheduler.slot("a.gguf", INTERACTIVE, token):
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    wait_until(lambda: scheduler.snapshot()["classes"]["interactive"]["running"] == 1)
+    with scheduler.slot("b.gguf", INTERACTIVE):  # Другая модель не ждет первую
+        pass
+    release.set()
+    thread.join(5)
+    assert not token.cancelled and scheduler.snapshot()["preemptions"] == 0
+
+
+def test_background_jobs_drop_when_full_and_count_failures():
+    jobs = BackgroundJobs(max_queued=1)
+    started, release = threading.Event(), threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+
+    def failing():
+        raise RuntimeError("boom")
+
+    assert jobs.submit("blocking", blocking)
+    assert started.wait(5)
+    assert jobs.submit("failing", failing)
+    assert not jobs.submit("dropped", blocking)
+    release.set()
+    wait_until(lambda: jobs.snapshot()["queued"] == 0 and jobs.snapshot()["failed"] == 1)
+    assert jobs.snapshot() == {"queued": 0, "completed": 1, "failed": 1, "dropped": 1}
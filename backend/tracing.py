@@ -0,0 +1,241 @@
+import os
+import json
+import functools
+import time
+import atexit
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# TRACING_EXPORTER: off (по умолчанию) | file — JSONL-файл со спанами | otlp — OpenTelemetry-коллектор
+# (адрес берется из стандартной OTEL_EXPORTER_OTLP_ENDPOINT). Имена и поля спанов в файле совпадают
+# с моделью OpenTelemetry, так что их можно сконвертировать и загрузить в Jaeger/Tempo.
+TRACE_FILE_NAME = "traces.jsonl"
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value):
+        pass
+
+    def end(self, error: Optional[BaseException] = None, end_ns: Optional[int] = None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _NoopContext:
+    def __enter__(self):
+        return NOOP_SPAN
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_CONTEXT = _NoopContext()
+_current_span: contextvars.ContextVar = contextvars.ContextVar("neurabox_current_span", default=None)
+
+
+class FileSpan:
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_span_id", "start_ns", "attributes", "_ended")
+
+    def __init__(self, tracer: "FileTracer", name: str, parent: Optional["FileSpan"], attributes: Dict,
+                 start_ns: Optional[int] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.start_ns = start_ns or time.time_ns()
+        self.attributes = dict(attributes)
+        self._ended = False
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None, end_ns: Optional[int] = None):
+        if self._ended:
+            return
+        self._ended = True
+        self.tracer.export({
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": end_ns or time.time_ns(),
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": f"{type(error).__name__}: {error}"} if error else {"code": "OK"},
+            "thread": threading.current_thread().name,
+        }, root=self.parent_span_id is None)
+
+
+class FileTracer:
+    """Пишет законченные спаны в JSONL; буфер сбрасывается на диск по окончании корневого спана."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8", buffering=64 * 1024)
+        atexit.register(self.flush)
+
+    def start_span(self, name: str, attributes: Dict, start_ns: Optional[int] = None) -> FileSpan:
+        return FileSpan(self, name, _current_span.get(), attributes, start_ns)
+
+    def export(self, record: Dict, root: bool):
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            if root:
+                self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+
+class OtelSpan:
+    __slots__ = ("span",)
+
+    def __init__(self, span):
+        self.span = span
+
+    def set_attribute(self, key: str, value):
+        self.span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+
+    def end(self, error: Optional[BaseException] = None, end_ns: Optional[int] = None):
+        if error is not None:
+            from opentelemetry.trace import Status, StatusCode
+            self.span.record_exception(error)
+            self.span.set_status(Status(StatusCode.ERROR, str(error)))
+        self.span.end(end_time=end_ns)
+
+
+class OtelTracer:
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider = TracerProvider(resource=Resource.create({"service.name": "neurabox-backend"}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._trace = trace
+        self._tracer = provider.get_tracer("neurabox")
+        atexit.register(provider.shutdown)
+
+    def start_span(self, name: str, attributes: Dict, start_ns: Optional[int] = None) -> OtelSpan:
+        parent = _current_span.get()
+        context = self._trace.set_span_in_context(parent.span) if isinstance(parent, OtelSpan) else None
+        span = OtelSpan(self._tracer.start_span(name, context=context, start_time=start_ns))
+        for key, value in attributes.items():
+            span.set_attribute(key, value)
+        return span
+
+
+_tracer = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def _get_tracer():
+    """Создает трассировщик при первом спане — к этому моменту .env уже загружен."""
+    global _tracer, _configured
+    if _configured:
+        return _tracer
+    with _configure_lock:
+        if _configured:
+            return _tracer
+        exporter = os.getenv("TRACING_EXPORTER", "off").lower()
+        if exporter == "otlp":
+            try:
+                _tracer = OtelTracer()
+            except ImportError as e:
+                logger.warning(f"OpenTelemetry не установлен ({e}), спаны пишутся в файл.")
+                exporter = "file"
+        if exporter == "file":
+            path = os.getenv("TRACING_FILE")
+            if not path:
+                from backend.model_manager import USER_DATA_DIR
+                path = os.path.join(USER_DATA_DIR, TRACE_FILE_NAME)
+            _tracer = FileTracer(path)
+            logger.info(f"Трассировка включена, спаны пишутся в {path}")
+        _configured = True
+        return _tracer
+
+
+def enabled() -> bool:
+    return _get_tracer() is not None
+
+
+@contextmanager
+def _span_context(tracer, name: str, attributes: Dict):
+    span = tracer.start_span(name, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.end(error=e)
+        raise
+    else:
+        span.end()
+    finally:
+        _current_span.reset(token)
+
+
+def span(name: str, **attributes):
+    """Спан вокруг блока кода: with tracing.span("db.get_messages", chat_id=...) as s: ...
+
+    Когда трассировка выключена, возвращает общий пустой контекст — накладные расходы
+    сводятся к одной проверке.
+    """
+    tracer = _get_tracer()
+    if tracer is None:
+        return _NOOP_CONTEXT
+    return _span_context(tracer, name, attributes)
+
+
+def start_span(name: str, **attributes):
+    """Спан, который живет дольше одного блока (например, через весь стрим ответа). Закрыть через .end()."""
+    tracer = _get_tracer()
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start_span(name, attributes)
+
+
+@contextmanager
+def use_span(parent):
+    """Делает спан текущим родителем внутри блока, не закрывая его."""
+    if parent is NOOP_SPAN:
+        yield parent
+        return
+    token = _current_span.set(parent)
+    try:
+        yield parent
+    finally:
+        _current_span.reset(token)
+
+
+def record_span(name: str, start_ns: int, end_ns: int, **attributes):
+    """Задним числом добавляет дочерний спан с известными границами (например, обработка промпта)."""
+    tracer = _get_tracer()
+    if tracer is None:
+        return
+    tracer.start_span(name, attributes, start_ns=start_ns).end(end_ns=end_ns)
+
+
+def traced(name: str):
+    """Декоратор: весь вызов функции — один спан."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator